@@ -0,0 +1,76 @@
+'''
+asyncio runtime, chosen with RAFT_RUNTIME=asyncio. The default runtime,
+'threads', gives every Messenger, consensus module and apply loop threads
+of their own. Under asyncio one event loop on one thread serves the whole
+process instead: receiving, sending, timers, consensus events and the apply
+loop are callbacks and coroutines on it, so the thread count stays the same
+however many nodes, groups and robots a process hosts. Only calls that
+cannot be made asynchronous (the SQS client) borrow a thread from the
+runtime's executor of blocking_workers threads.
+
+	use_asyncio() -> bool : RAFT_RUNTIME=asyncio
+	shared_loop() -> asyncio event loop, started on first use
+	on_loop() -> bool : is the calling thread the loop's
+	call_soon(callback, *args) : run callback on the loop, from any thread
+	spawn(coroutine) -> concurrent.futures.Future : run a coroutine on the loop, from any thread
+	to_thread(function, *args) : await a blocking call on the loop's executor
+	run_forever() : block the calling thread while the loop runs
+'''
+
+from threading import Thread, Lock, current_thread
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, os
+
+# threads for blocking calls (SQS long polls and sends) on the asyncio runtime
+blocking_workers = 32
+
+loop = None
+loop_thread = None
+loop_lock = Lock()
+
+
+def use_asyncio() -> bool:
+	runtime = os.environ.get('RAFT_RUNTIME', 'threads')
+	if runtime not in ('threads', 'asyncio'):
+		raise ValueError(f'unknown runtime: {runtime}')
+	return runtime == 'asyncio'
+
+
+def shared_loop() -> asyncio.AbstractEventLoop:
+	'''the process-wide event loop, started on first use'''
+	global loop, loop_thread
+	with loop_lock:
+		if loop is None:
+			loop = asyncio.new_event_loop()
+			loop.set_default_executor(ThreadPoolExecutor(
+				max_workers=blocking_workers,
+				thread_name_prefix='asyncio Blocking Thread'
+				))
+			loop_thread = Thread(target=loop.run_forever, name='asyncio Runtime Thread', daemon=True)
+			loop_thread.start()
+		return loop
+
+
+def on_loop() -> bool:
+	return loop_thread is not None and current_thread() is loop_thread
+
+
+def call_soon(callback, *args):
+	'''on the loop itself, callback runs once the current callback returns'''
+	if on_loop():
+		loop.call_soon(callback, *args)
+	else:
+		shared_loop().call_soon_threadsafe(callback, *args)
+
+
+def spawn(coroutine):
+	return asyncio.run_coroutine_threadsafe(coroutine, shared_loop())
+
+
+async def to_thread(function, *args):
+	return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def run_forever():
+	shared_loop()
+	loop_thread.join()
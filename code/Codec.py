@@ -0,0 +1,136 @@
+'''
+Compact binary wire format for messages passed between nodes.
+
+Every frame starts with two bytes: the wire version and a message type code.
+The RAFT RPCs have fixed schemas: numeric and boolean fields are packed
+into one struct, then strings follow, each behind a length prefix. Bulk
+payloads (AppendEntries entries, InstallSnapshot data) come last and travel
+as a single blob, zlib compressed once it is long enough for that to pay
+off (the top bit of its length prefix marks a compressed blob). Any other
+message (replies to clients, admin requests) is encoded as a generic
+string -> string map. Every RPC names the Raft group it belongs to, so
+one node's groups can share a queue (see RaftNode in server_logic.py).
+
+	encode(message: dict) -> bytes
+	decode(data: bytes) -> dict
+'''
+
+import struct, zlib
+
+WIRE_VERSION = 9
+
+header = struct.Struct('!BB')
+short_length = struct.Struct('!H')
+blob_length = struct.Struct('!I')
+compressed_flag = 1 << 31
+compress_threshold = 512  # bytes
+
+# field kinds: 'q' int, '?' bool, 's' short string, 'b' blob (long string)
+fixed_kinds = ('q', '?')
+
+
+class MessageSchema:
+	def __init__(self, code: int, message_type: str, fields: list):
+		self.code = code
+		self.message_type = message_type
+		self.fixed = [name for name, kind in fields if kind in fixed_kinds]
+		self.strings = [(name, kind) for name, kind in fields if kind not in fixed_kinds]
+		self.struct = struct.Struct('!' + ''.join(kind for _, kind in fields if kind in fixed_kinds))
+
+	def encode(self, message: dict) -> bytes:
+		parts = [
+			header.pack(WIRE_VERSION, self.code),
+			self.struct.pack(*[message[name] for name in self.fixed])
+			]
+		for name, kind in self.strings:
+			data = message[name].encode()
+			if kind == 's':
+				parts.append(short_length.pack(len(data)))
+			elif len(data) >= compress_threshold:
+				data = zlib.compress(data, 1)
+				parts.append(blob_length.pack(len(data) | compressed_flag))
+			else:
+				parts.append(blob_length.pack(len(data)))
+			parts.append(data)
+		return b''.join(parts)
+
+	def decode(self, data: bytes, offset: int) -> dict:
+		message = {'messageType': self.message_type}
+		message.update(zip(self.fixed, self.struct.unpack_from(data, offset)))
+		offset += self.struct.size
+		for name, kind in self.strings:
+			length_struct = blob_length if kind == 'b' else short_length
+			length, = length_struct.unpack_from(data, offset)
+			offset += length_struct.size
+			if kind == 'b' and length & compressed_flag:
+				length &= ~compressed_flag
+				message[name] = zlib.decompress(data[offset:offset+length]).decode()
+			else:
+				message[name] = data[offset:offset+length].decode()
+			offset += length
+		return message
+
+
+schemas = [
+	MessageSchema(1, 'AppendEntriesRPC', [
+		('group', 'q'), ('term', 'q'), ('prevLogIndex', 'q'), ('prevLogTerm', 'q'),
+		('leaderCommit', 'q'), ('nextIndex', 'q'), ('sentAt', 'q'), ('heartbeatInterval', 'q'),
+		('leaderID', 's'), ('prevLogCommand', 's'), ('entries', 'b')]),
+	MessageSchema(2, 'AppendReply', [
+		('group', 'q'), ('term', 'q'), ('match', 'q'), ('success', '?'),
+		('conflictTerm', 'q'), ('conflictIndex', 'q'), ('sentAt', 'q'), ('senderID', 's')]),
+	MessageSchema(3, 'RequestVotesRPC', [
+		('group', 'q'), ('term', 'q'), ('lastLogIndex', 'q'), ('lastLogTerm', 'q'), ('preVote', '?'),
+		('candidateID', 's')]),
+	MessageSchema(4, 'VoteReply', [
+		('group', 'q'), ('term', 'q'), ('voteGranted', '?'), ('preVote', '?'),
+		('lastLogIndex', 'q'), ('lastLogTerm', 'q'), ('senderID', 's')]),
+	MessageSchema(5, 'InstallSnapshotRPC', [
+		('group', 'q'), ('term', 'q'), ('lastIncludedIndex', 'q'), ('lastIncludedTerm', 'q'),
+		('leaderID', 's'), ('data', 'b')]),
+	MessageSchema(6, 'TimeoutNowRPC', [
+		('group', 'q'), ('term', 'q'), ('leaderID', 's')]),
+	MessageSchema(7, 'ClientCommand', [
+		('command', 's')]),  # a Command.encode() string, stored in the log as is
+	MessageSchema(8, 'ReturnedCommands', [
+		('group', 'q'), ('term', 'q'),
+		('commands', 'b')]),  # ClientCommands a leader did not log, ';' separated
+	]
+schemas_by_type = {schema.message_type: schema for schema in schemas}
+schemas_by_code = {schema.code: schema for schema in schemas}
+
+GENERIC_CODE = 0
+
+
+def encode(message: dict) -> bytes:
+	schema = schemas_by_type.get(message.get('messageType'))
+	if schema is not None:
+		return schema.encode(message)
+	parts = [header.pack(WIRE_VERSION, GENERIC_CODE), short_length.pack(len(message))]
+	for key, value in message.items():
+		for text in (key, value):
+			data = text.encode()
+			parts.append(blob_length.pack(len(data)))
+			parts.append(data)
+	return b''.join(parts)
+
+
+def decode(data: bytes) -> dict:
+	version, code = header.unpack_from(data)
+	if version != WIRE_VERSION:
+		raise ValueError(f'unsupported wire version {version}, expected {WIRE_VERSION}')
+	offset = header.size
+	if code != GENERIC_CODE:
+		return schemas_by_code[code].decode(data, offset)
+	count, = short_length.unpack_from(data, offset)
+	offset += short_length.size
+	message = {}
+	for _ in range(count):
+		pair = []
+		for _ in range(2):
+			length, = blob_length.unpack_from(data, offset)
+			offset += blob_length.size
+			pair.append(data[offset:offset+length].decode())
+			offset += length
+		message[pair[0]] = pair[1]
+	return message
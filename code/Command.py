@@ -0,0 +1,82 @@
+'''
+Client commands as stored in the log, carried in AppendEntries and applied
+by the server.
+
+A command is a client, an action, the client's sequence number and the
+match it belongs to, encoded as one digit for the client, one for the
+action, the sequence number in decimal and, for any match but 0, '@' and
+the match id: Command('client-red', 'punch_left', 42) is "1042" and
+Command('client-red', 'punch_left', 42, 7) is "1042@7". The text has no
+tabs, newlines or semicolons, so it fits the log file and the entries field
+of AppendEntries unescaped.
+
+	Command(client, action, seq, match).encode() -> str
+	Command.decode(text) -> Command
+	client_endpoint(client, match) -> str : queue a robot in that match listens on
+	group_of(match, groups) -> int : Raft group whose log carries the match
+	leader_endpoint(group) -> str : queue the leader of that group reads commands from
+	group_count() -> int : number of Raft groups, from RAFT_GROUPS (default 1)
+'''
+
+import ast, os
+
+clients = ['client-blue', 'client-red']
+actions = ['punch_left', 'punch_right', 'block_left', 'block_right', 'exit']
+client_codes = {client: str(code) for code, client in enumerate(clients)}
+action_codes = {action: str(code) for code, action in enumerate(actions)}
+
+
+def client_endpoint(client: str, match: int) -> str:
+	'''match 0 uses the plain client queues, others get their own'''
+	return client if match == 0 else f'{client}-{match}'
+
+
+def group_of(match: int, groups: int) -> int:
+	'''matches are spread over the groups by id, every group keeps the match's whole history'''
+	return match % groups
+
+
+def leader_endpoint(group: int) -> str:
+	'''group 0 uses the plain leader queue, others get their own'''
+	return 'leader' if group == 0 else f'leader-{group}'
+
+
+def group_count() -> int:
+	return int(os.environ.get('RAFT_GROUPS', '1'))
+
+
+class Command:
+	def __init__(self, client: str, action: str, seq: int = 0, match: int = 0):
+		self.client = client
+		self.action = action
+		self.seq = seq
+		self.match = match
+
+	def __str__(self):
+		text = f'{self.client} {self.action} #{self.seq}'
+		return text + f' match {self.match}' if self.match else text
+
+	def __eq__(self, other):
+		return (isinstance(other, Command) and self.client == other.client
+			and self.action == other.action and self.seq == other.seq
+			and self.match == other.match)
+
+	def encode(self) -> str:
+		text = client_codes[self.client] + action_codes[self.action] + str(self.seq)
+		return text + '@' + str(self.match) if self.match else text
+
+	@staticmethod
+	def decode(text: str) -> 'Command':
+		if text.startswith('{'):  # written as a dict repr before commands had an encoding
+			fields = ast.literal_eval(text)
+			return Command(fields['_id'], fields['state'])
+		text, _, match = text.partition('@')
+		return Command(clients[int(text[0])], actions[int(text[1])], int(text[2:]), int(match or 0))
+
+	@staticmethod
+	def describe(text: str) -> str:
+		'''readable form of a log entry's command, placeholders are shown as they are'''
+		try:
+			return str(Command.decode(text))
+		except (ValueError, IndexError, KeyError, SyntaxError):
+			return text
@@ -1,21 +1,39 @@
 from ElectionTimer import Election_Timer
 from Heartbeat import Heartbeat
 from Messenger import Messenger
-from server_logic import *
+from QuorumTracker import QuorumTracker
+from RttEstimator import RttEstimator
+from Command import Command
+from TimerScheduler import shared_scheduler
+from EventLoop import make_event_loop
+from AsyncRuntime import use_asyncio, call_soon
 
-from time import sleep, clock
-from threading import Thread
-import boto3, argparse, random, math, csv, ast, os, re
-import numpy as np
+from time import sleep, monotonic
+from threading import Thread, Lock, Condition
+from collections import deque
+import argparse, math, json, struct, zlib, os, re, asyncio
+
+offset_record = struct.Struct('<Q')
 
 class LogEntry:
 	def __init__(self, term: int, command: str):
 		self.term = term
 		self.command = command
 		self.iterable = [self.term, self.command]
+		# entries never change, so serialize once for every AppendEntries
+		self.serialized = str(self.term) + '\t' + self.command
 
 	def __str__(self):
-		return str(self.term) + '\t' + self.command
+		return self.serialized
+
+	@staticmethod
+	def checksum(text: str) -> str:
+		return format(zlib.crc32(text.encode()), '08x')
+
+	def record(self) -> bytes:
+		"""this entry framed as one line of the log file"""
+		text = str(self)
+		return (text + '\t' + self.checksum(text) + '\n').encode()
 		
 	def from_string(self, _str: str):
 		values = re.split(r'\t+',_str)
@@ -31,100 +49,342 @@ class Log:
 	get_entry(index): get entry in log at index
 	rollback(index): delete entries after index
 	append_to_end(LogEntry): append log entry to log
+	make_durable(): make appended entries durable under the durability policy
+	durable_index: last index made durable so far
+	first_index_of_term(index): first index holding the same term as index
+	last_index_of_term(term): last index holding term, or None
+	compact(index): discard entries up to index, which a snapshot now covers
+	reset_to_snapshot(index, term): make the log start at an installed snapshot
 	print_log(): print log
 
+	Indices are absolute. After compaction the list only holds entries from
+	snapshot_index on; the entry at snapshot_index is a placeholder carrying
+	the snapshot's last term, and get_entry() returns None for anything older.
+	The base index is stored in the log file header. The list and its base
+	index live in one tuple, view, that compaction replaces in a single
+	assignment, so threads reading without the lock (the apply loop, the
+	status print) never pair the new list with the old base.
+
+	The file is a write-ahead log: one framed record per line,
+	"TERM<tab>COMMAND<tab>CRC", where CRC is the crc32 of the first two
+	fields. A torn or corrupt tail is cut off when the file is read back.
+	logIndex{id}.idx holds the byte offset of every record (8 bytes each), so
+	rollback can cut both files at the right place without rereading them.
+
+	durability policies:
+		'always':   fsync after every appended entry
+		'batch':    group commit, one fsync per make_durable() call
+		'interval': fsync every sync_interval seconds in the background;
+					make_durable() only hands buffered records to the OS
 	 '''
 
-	def __init__(self, nodeID: str):
+	def __init__(self, nodeID: str, durability: str = 'batch', sync_interval: float = 0.05):
 		"""
 		Log constructor
 		Attributes:
 		:var log: list of LogEntries
+		:var offsets: byte offset of each entry's record in the log file
 		:var file_path: filepath to read and write from
 		"""
-
-		self.log = []
-		self.header = ["TERM", "COMMAND"]
-		self.logfile = ''
+		if durability not in ('always', 'batch', 'interval'):
+			raise ValueError(f'unknown durability policy: {durability}')
+
+		self.view = (0, [])  # (snapshot_index, log), see log and snapshot_index
+		self.offsets = []
+		self.durability = durability
+		self.sync_interval = sync_interval
+		self.lock = Lock()
+		self.unsynced = False  # records written since the last fsync
+		self.durable_index = 0
 		if not os.path.isdir('../files'):
 			os.mkdir('../files')
 		self.file_path = f'../files/logOutput{nodeID}.tsv'
-		
-		#try:
-		#	os.remove(self.file_path)
-		#except:
-		#	pass
+		self.index_path = f'../files/logIndex{nodeID}.idx'
 
 		try:
-			with open(self.file_path, 'r') as read_file:
-				csv_reader = csv.reader(read_file, delimiter='\t')
-				next(csv_reader)
-				for line in csv_reader:
-					#print(line)
-					self.log.append(self.read_log_line(line))
-
+			self.end_offset = self.read_log_file()
+			with open(self.file_path, 'r+b') as log_file:
+				log_file.truncate(self.end_offset)  # drop a torn tail, if any
+			self.logfile = open(self.file_path, 'ab')
+			self.indexfile = self.open_index()
 		except FileNotFoundError:
-			with open(self.file_path, 'w+', newline='') as out_file:
-				log_writer = csv.writer(out_file, delimiter='\t')
-				log_writer.writerow(self.header)
+			self.logfile = open(self.file_path, 'ab')
+			header = self.header(self.snapshot_index)
+			self.logfile.write(header)
+			self.end_offset = len(header)
+			self.indexfile = open(self.index_path, 'wb')
 			# this might break things later, but something needs to exist at log[0]
 			self.append_to_end(LogEntry(0,'null'))
+			self.sync()
+		self.durable_index = len(self) - 1
+
+		if self.durability == 'interval':
+			Thread(
+				target=self.sync_periodically,
+				name=f'Log Sync Thread{nodeID}',
+				daemon=True
+				).start()
 
-	def read_log_line(self, line):
+	def read_log_file(self) -> int:
 		"""
-		Reading a single line in a log
+		Load every intact record from the log file.
+		Returns the length in bytes of the intact part of the file.
 		"""
-		return LogEntry(int(line[0]), line[1])
+		with open(self.file_path, 'rb') as read_file:
+			header = read_file.readline()
+			valid_length = len(header)
+			columns = header.decode().split('\t')
+			if len(columns) > 3:  # files written before compaction have no base index
+				self.view = (int(columns[3]), self.log)
+			for line in read_file:
+				entry = self.read_log_line(line)
+				if entry is None:
+					print(f'Log: discarding damaged records after entry {self.snapshot_index + len(self.log)-1}')
+					break
+				self.log.append(entry)
+				self.offsets.append(valid_length)
+				valid_length += len(line)
+		return valid_length
+
+	def open_index(self):
+		"""
+		Open the offset index for appending. It is only a cache of what the
+		log file says, so if it disagrees with the offsets just read (a crash
+		between the two writes) it is rewritten.
+		"""
+		expected = b''.join(offset_record.pack(offset) for offset in self.offsets)
+		try:
+			with open(self.index_path, 'rb') as index_file:
+				current = index_file.read()
+		except FileNotFoundError:
+			current = None
+		if current != expected:
+			with open(self.index_path, 'wb') as index_file:
+				index_file.write(expected)
+		return open(self.index_path, 'ab')
+
+	def read_log_line(self, line: bytes):
+		"""
+		Reading a single line in a log. Returns None for a torn or corrupt record.
+		"""
+		if not line.endswith(b'\n'):
+			return None
+		try:
+			# two columns: written by csv.writer, with \r\n, before records had a CRC
+			values = line.rstrip(b'\r\n').decode().split('\t')
+			if len(values) not in (2, 3):
+				return None
+			if len(values) == 3 and LogEntry.checksum(values[0] + '\t' + values[1]) != values[2]:
+				return None
+			return LogEntry(int(values[0]), values[1])
+		except (UnicodeDecodeError, ValueError):
+			return None
+
+	def header(self, base: int) -> bytes:
+		return f'TERM\tCOMMAND\tCRC\t{base}\n'.encode()
+
+	@property
+	def log(self) -> list:
+		return self.view[1]
+
+	@property
+	def snapshot_index(self) -> int:
+		return self.view[0]
+
+	def position(self, idx: int) -> int:
+		"""list position of absolute index idx (negative idx counts from the end)"""
+		return idx - self.snapshot_index if idx >= 0 else idx
 
 	def __len__(self):
-		return len(self.log)
+		snapshot_index, log = self.view
+		return snapshot_index + len(log)
 
 	def get_entry(self, idx) -> LogEntry:
+		snapshot_index, log = self.view
+		if idx >= 0 and idx < snapshot_index:
+			return None  # compacted into the snapshot
 		try:
 			#print(self.log[idx])
-			return self.log[idx]
+			return log[idx - snapshot_index if idx >= 0 else idx]
 		except IndexError:
 			#print(f"There is no entry at index {idx:d} in the log.")
 			pass
 	def idx_exist(self, idx):
+		snapshot_index, log = self.view
+		if idx >= 0 and idx < snapshot_index:
+			return False
 		try:
-			id = self.log[idx]
+			id = log[idx - snapshot_index if idx >= 0 else idx]
 			#print(f"index {idx:d} exists")
 			return True
 		except IndexError:
 			#print(f"index {idx:d} does not")
 			return False
 
+	def first_index_of_term(self, idx: int) -> int:
+		"""first index of the run of entries sharing the term of the entry at idx"""
+		with self.lock:
+			position = self.position(idx)
+			term = self.log[position].term
+			while position > 0 and self.log[position - 1].term == term:
+				position -= 1
+		return self.snapshot_index + position
+
+	def last_index_of_term(self, term: int) -> int:
+		"""last index holding an entry of term, None if there is none"""
+		with self.lock:
+			for position in range(len(self.log) - 1, -1, -1):
+				entry_term = self.log[position].term
+				if entry_term == term:
+					return self.snapshot_index + position
+				if entry_term < term:  # terms only grow along the log
+					return None
+		return None
+
 	def append_to_end(self, logentry: LogEntry):
 		"""
-		Insert new log entry and add to file.
+		Insert new log entry and add to file. The record is buffered until
+		the durability policy syncs it, see make_durable().
 		:type logentry: object LogEntry
 		"""
-		self.log.append(logentry)
+		record = logentry.record()
+		with self.lock:
+			self.log.append(logentry)
+			self.offsets.append(self.end_offset)
+			self.logfile.write(record)
+			self.indexfile.write(offset_record.pack(self.end_offset))
+			self.end_offset += len(record)
+			self.unsynced = True
+		if self.durability == 'always':
+			self.sync()
+
+	def sync(self):
+		"""Flush buffered records and fsync them, one fsync for the whole group."""
+		with self.lock:
+			if not self.unsynced:
+				return
+			self.logfile.flush()
+			os.fsync(self.logfile.fileno())
+			self.indexfile.flush()  # no fsync needed, the index is rebuilt if stale
+			self.unsynced = False
+			self.durable_index = len(self) - 1
+
+	def make_durable(self):
+		"""
+		Call before acknowledging appended entries to anyone. Returns once the
+		entries are as durable as the policy promises.
+		"""
+		if self.durability == 'interval':
+			with self.lock:
+				self.logfile.flush()
+				self.durable_index = len(self) - 1
+		else:
+			self.sync()
 
-		with open(self.file_path, 'a', newline='') as out_file:
-			log_writer = csv.writer(out_file, delimiter='\t')
-			log_writer.writerow(logentry.iterable)
+	def sync_periodically(self):
+		while True:
+			sleep(self.sync_interval)
+			self.sync()
 
 	def print_log(self):
 		for x in self.log:
 			print(str(x))
 
 	def rollback(self, idx):
-		to_delete = []
-		for i in range(idx, len(self.log)):
-			to_delete.append(i)
-		self.log = np.delete(self.log, to_delete).tolist()
-
-	def get_entries_string(self, idx: int) -> str:
-		entries = ''
-		for i in range(idx, len(self.log)):
-			entries += str(self.get_entry(i)) + ';'
-		entries = entries.strip(';')
-		return entries
+		"""Delete the entries from idx on, in memory and in the log file."""
+		with self.lock:
+			# the snapshot placeholder stays, snapshots only cover committed entries
+			idx = max(self.position(idx), 1)
+			if idx >= len(self.log):
+				return
+			self.logfile.flush()
+			self.indexfile.flush()
+			# both files are opened for appending, so later writes land at the new end
+			self.end_offset = self.offsets[idx]
+			os.ftruncate(self.logfile.fileno(), self.end_offset)
+			os.ftruncate(self.indexfile.fileno(), idx * offset_record.size)
+			del self.log[idx:]
+			del self.offsets[idx:]
+			self.unsynced = True
+			self.durable_index = min(self.durable_index, len(self) - 1)
+
+	def compact(self, idx: int):
+		"""Discard the entries before idx; idx becomes the snapshot placeholder."""
+		with self.lock:
+			pos = self.position(idx)
+			if pos <= 0 or pos >= len(self.log):
+				return
+			self.rewrite(idx, [LogEntry(self.log[pos].term, 'snapshot')] + self.log[pos+1:])
+
+	def reset_to_snapshot(self, idx: int, term: int):
+		"""
+		Start the log at an installed snapshot. Entries after it are kept only
+		if the log already holds the snapshot's last entry (§7).
+		"""
+		with self.lock:
+			pos = self.position(idx)
+			kept = []
+			if 0 <= pos < len(self.log) and self.log[pos].term == term:
+				kept = self.log[pos+1:]
+			self.rewrite(idx, [LogEntry(term, 'snapshot')] + kept)
+
+	def rewrite(self, base: int, entries: list):
+		"""
+		Replace the log file with entries starting at index base. The new file
+		is written and fsynced aside, then renamed over the old one. Caller
+		holds self.lock.
+		"""
+		header = self.header(base)
+		offsets = []
+		records = [header]
+		end_offset = len(header)
+		for entry in entries:
+			record = entry.record()
+			offsets.append(end_offset)
+			records.append(record)
+			end_offset += len(record)
+
+		temp_path = self.file_path + '.tmp'
+		with open(temp_path, 'wb') as temp_file:
+			temp_file.write(b''.join(records))
+			temp_file.flush()
+			os.fsync(temp_file.fileno())
+		self.logfile.close()
+		self.indexfile.close()
+		os.replace(temp_path, self.file_path)
+		with open(self.index_path, 'wb') as index_file:
+			index_file.write(b''.join(offset_record.pack(offset) for offset in offsets))
+
+		self.logfile = open(self.file_path, 'ab')
+		self.indexfile = open(self.index_path, 'ab')
+		self.view = (base, entries)
+		self.offsets = offsets
+		self.end_offset = end_offset
+		self.unsynced = False
+		self.durable_index = len(self) - 1
+
+	def get_entries_string(self, idx: int, max_entries: int = None, max_bytes: int = None) -> (str, int):
+		"""
+		Serialize entries from idx on for an AppendEntries request, stopping
+		at max_entries entries or max_bytes characters (at least one entry is
+		always included). Returns the string and the number of entries in it.
+		"""
+		with self.lock:
+			start = self.position(idx)
+			end = len(self.log)
+			if max_entries is not None:
+				end = min(end, start + max_entries)
+			entries = []
+			size = 0
+			for entry in self.log[start:end]:
+				size += len(entry.serialized) + 1
+				if entries and max_bytes is not None and size > max_bytes:
+					break
+				entries.append(entry.serialized)
+		return ';'.join(entries), len(entries)
 
 	def parse_entries_to_list(self, entries: str) -> list:
-		if entries == 'heartbeat':
+		if not entries:  # empty heartbeat
 			return []
 		else:
 			split_strings = entries.split(';')
@@ -139,41 +399,96 @@ class ConsensusModule:
 	''' Constructor. Takes id of node (str) and number of peers (int) as
 
 	:param peer_count: int. number of peers in cluster. 
+	:param durability: str. log durability policy, 'always', 'batch' or 'interval' (see Log)
+	:param pre_vote: bool. ask peers before starting an election, see campaign()
+	:param check_quorum: bool. a leader that has not heard from a majority for
+	                     an election timeout steps down
+	:param group: int. Raft group this module runs, 0 unless the node hosts several
+	:param node: RaftNode hosting this group, which lends it the node's messenger;
+	             None runs stand-alone
 
 	PERSISTENT STORAGE:
 
 	:var .term: int.       monotonic counter for cluster term. init at 0
 	:var .voted_for:       string. records who this node voted for in election.
 	:var .log:			   list. contains the replicated log. 
+	:var .snapshot:        dict. latest snapshot of the game state, covering the
+	                       log up to snapshot['lastIncludedIndex'] (None if none yet)
 
 	VOLITILE STATE ON ALL SERVERS
 
 	:var .id:              string. Takes id from list '0', '1', '2', '3', '4'
+	:var .group:           int. Raft group, carried in every message so groups can share queues
+	:var .name:            string. names this group's files: the node id, plus '-group' past group 0
 	:var .peers:           list of peer IDs in cluster.
 	:var .election_state:  string. 'leader' 'candidate' or 'follower'
-	:var .timer_length:    float. duration of election timer in seconds (default: .15)
+	:var .timer_length:    float. election timeout in seconds until a leader's heartbeat
+	                       interval is known, and the ceiling for it afterwards
+	:var .min_heartbeat / .max_heartbeat:
+	                       bounds on the heartbeat interval, which a leader sets to
+	                       heartbeat_rtos times the slowest peer's RTO
+	:var .min_election_timeout:
+	                       floor for the election timeout, which is
+	                       election_heartbeats times the leader's heartbeat interval
+	:var .replication_delay: float. seconds a new client command waits so a burst
+	                       of commands goes out in one AppendEntries round
+	:var .max_inflight:    int. AppendEntries requests with entries that may be
+	                       unacknowledged per follower at once
+	:var .max_append_entries / .max_append_bytes:
+	                       caps on one AppendEntries; a lagging follower catches
+	                       up over several requests
 	:var .vote_count:      int. Store number of votes received. Majority -> leader
+	:var .pre_votes:       set. peers (and self) that would vote for us next term
+	:var .pre_voting:      bool. a pre-vote round is running
+	:var .leader_contact:  float. monotonic time we last heard from the current leader
+	:var .newer_log_seen:  bool. a voter in the current election has a more up to date log
+	:var .elections_won:   int. elections this node has won
+	:var .stale_wins:      int. of those, elections won while a voter had a more
+	                       up to date log than ours
 	:var .reply_status:	   track which peers have replied to vote or append requests.
 	
 	:var .commitIndex: 	   int. index of highest log entry known to be committed.
+	                       Only advanced through set_commit_index(), which wakes
+	                       wait_for_commit() and wait_for_commit_async()
 	:var .lastApplied:     int. index of highest log entry applied to state machine. 
 
 	VOLITILE STATE ON LEADER (reinit after election):
 
-	:var .nextIndex: 	   int. As leader: index of next log entry to send to each server
+	:var .nextIndex: 	   int. As leader: index of next log entry to send to each server.
+	                       Advanced optimistically as entries are sent, not when acknowledged
+	:var .inflight:        deque. As leader: last index of each unacknowledged request per server
+	:var .probing:         bool. As leader: True while a server's log position is unknown;
+	                       only one request is sent at a time until it matches
 	:var .matchIndex:      int. As leader: index of highest log entry known to be relicated on each server
+	:var .quorum:          QuorumTracker. owns matchIndex, finds the majority-replicated index
+	:var .last_sent:       float. As leader: monotonic time of the last AppendEntries to each server
+	:var .last_heard:      float. As leader: monotonic time of the last reply from each server
+	:var .transfer_target: string. As leader: peer leadership is being handed to, or None
+	:var .rtt:             RttEstimator. As leader: AppendEntries round-trip times per server
 	
 	HELPER CLASSES:
 
+	:var .loop:            EventLoop. every state change runs on this one thread
+	                       (or as callbacks on the asyncio runtime's loop, see AsyncRuntime.py):
+	                       received messages, timer firings, client commands and
+	                       snapshots are posted to it, so the state above needs no locks
+	                       Client commands go in a bounded lane that runs after every
+	                       consensus event waiting (see EventLoop.Mailbox)
 	:var .messenger:       Messenger. takes care of all messaging between nodes
 	:var .election_timer:  ElectionTimer. Timer thread to start election
 	:var .heartbeat:       Heartbeat. Timer thread to send hearbeats when leader. 
 	'''
 
-	def __init__(self, id: str, peer_count: int, server: object):
+	def __init__(self, id: str, peer_count: int, server: object, durability: str = 'batch',
+			pre_vote: bool = True, check_quorum: bool = True, group: int = 0, node: object = None):
+		self.group = group
+		self.node = node
+		self.name = id if group == 0 else f'{id}-{group}'
 		# The following three variables need to survive on persistent storage.
 		self.voted_for = 'null'
-		self.log = Log(id)
+		self.log = Log(self.name, durability)
+		self.snapshot_path = f'../files/snapshot{self.name}.json'
+		self.snapshot = self.load_snapshot()
 		self.term = self.log.get_entry(len(self.log)-1).term
 
 		# volitile variables:
@@ -182,19 +497,53 @@ class ConsensusModule:
 		self.peers = [str(x) for x in range(0, peer_count) if x != int(self.id)]
 		self.election_state = 'follower'
 		self.timer_length = 4
+		self.min_heartbeat = 0.05
+		self.max_heartbeat = self.timer_length / 8
+		self.heartbeat_rtos = 2
+		self.min_election_timeout = 0.25
+		self.election_heartbeats = 5
+		self.max_append_entries = 64  # entries per AppendEntries request
+		self.max_append_bytes = 32 * 1024  # serialized size per AppendEntries request
+		self.replication_delay = 0.002
+		self.max_inflight = 4
+		self.replication_pending = False  # a replicate() round is scheduled
+		self.scheduler = shared_scheduler()
 		self.vote_count = 0
 		self.reply_status = {}
+		self.pending_replies = []  # AppendEntries replies waiting for the log to be durable
+		self.pre_vote = pre_vote
+		self.check_quorum = check_quorum
+		self.pre_votes = set()
+		self.pre_voting = False
+		self.leader_contact = 0.0
+		self.newer_log_seen = False
+		self.transfer_target = None
+		self.transfer_handle = None
+		self.elections_won = 0
+		self.stale_wins = 0
+		self.returned_commands = 0  # client commands put back on the leader queue
 
 		self.commitIndex = 0
+		self.commit_advanced = Condition()
+		self.commit_event = asyncio.Event() if use_asyncio() else None
 		self.lastApplied = 0
+		if self.snapshot is not None:  # a snapshot only ever holds committed entries
+			self.commitIndex = self.snapshot['lastIncludedIndex']
+			self.lastApplied = self.snapshot['lastIncludedIndex']
 
 		self.nextIndex = None
 		self.matchIndex = None
 		self.reset_next_and_match()
 
-		self.messenger = Messenger(self.id, self, run=True)
-		self.election_timer = Election_Timer(self.timer_length, self)
-		self.heartbeat = Heartbeat(self.timer_length, self)
+		# timers first: messages may arrive as soon as the messenger runs
+		self.loop = make_event_loop(f'Consensus Loop{self.name}')
+		self.election_timer = Election_Timer(self.timer_length, self, post=self.loop.post)
+		self.heartbeat = Heartbeat(self.timer_length, self, post=self.loop.post)
+		if node is None:
+			self.messenger = Messenger(self.id, self, run=False)
+			self.messenger.on()
+		else:
+			self.messenger = node.messenger  # the node turns it on once every group exists
 
 
 	def set_follower(self, term: int):
@@ -202,9 +551,12 @@ class ConsensusModule:
 		:param term: int, included for when an incoming term is discovered greater than own. 
 		'''
 		self.election_state = 'follower'
+		if term > self.term:
+			self.voted_for = 'null'  # a new term, this follower has yet to vote for another peer
 		self.term = term  # update term to newly discovered term
 		self.vote_count = 0  # followers do not have votes, reset to 0
-		self.voted_for = 'null'  # a new follwer has yet to vote for another peer
+		self.pre_voting = False
+		self.end_transfer()
 		self.election_timer.restart_timer()  # reset election countdown
 		self.heartbeat.stop_timer()  # stop the heartbeat, only leaders send them
 		self.server.turn_off_leader_queue()
@@ -214,17 +566,107 @@ class ConsensusModule:
 		'''Set the consensus module election state to 'leader', change timers '''
 		#print('\n', self.id, ' Set state to leader')
 		self.election_state = 'leader'
+		self.end_transfer()
 		self.election_timer.stop_timer()  # pause the election timer, leader will remain leader
 		self.reset_next_and_match()
+		self.server.turn_on_leader_queue()  # open before any follower hears of us
 		self.send_heartbeat()  # immediately send heartbeat to peers
 		self.heartbeat.restart_timer()  # continue sending heartbeat on interval
-		self.server.turn_on_leader_queue()
 
 	def reset_next_and_match(self):
 			#print("lenght of log: ", len(self.log))
 			self.nextIndex = dict.fromkeys(self.peers, len(self.log))
 			#print('nextIndex initialized to length of current log :', self.nextIndex)
-			self.matchIndex = dict.fromkeys(self.peers, 0)
+			self.quorum = QuorumTracker(self.peers)
+			self.matchIndex = self.quorum.match_index
+			self.last_sent = dict.fromkeys(self.peers, 0.0)
+			self.inflight = {peer: deque() for peer in self.peers}
+			self.probing = dict.fromkeys(self.peers, True)  # until the first reply says otherwise
+			self.last_heard = dict.fromkeys(self.peers, monotonic())  # a new leader gets a full window
+			self.rtt = {peer: RttEstimator() for peer in self.peers}
+
+	def transfer_leadership(self, target: str = None):
+		'''
+		Hand leadership to target (by default the most up to date follower),
+		e.g. before taking this node down. Client commands are left queued for
+		the next leader, target is brought up to date, then told to start an
+		election at once with TimeoutNow. If target has not taken over within
+		an election timeout, this node resumes serving clients.
+		'''
+		if self.election_state != 'leader' or self.transfer_target is not None:
+			return
+		if target not in self.peers:
+			target = max(self.peers, key=lambda peer: self.matchIndex[peer])
+		print('\n', self.id, ' transferring leadership to ', target)
+		self.transfer_target = target
+		self.server.turn_off_leader_queue()
+		self.transfer_handle = self.scheduler.schedule(
+			self.election_timer.duration, lambda: self.loop.post(self.abort_transfer))
+		self.log.make_durable()
+		self.pump(target)
+		self.send_timeout_now()
+
+	def send_timeout_now(self):
+		'''
+		tell the transfer target to campaign, once it holds our whole log and
+		the commands left in our client lane have come back to the server.
+		Those are handed to the target first, so as leader it logs them
+		before anything it reads off the leader queue.
+		'''
+		target = self.transfer_target
+		if target is None or self.matchIndex[target] < len(self.log) - 1:
+			return
+		if self.loop.mailbox.lanes['client'].events:
+			self.loop.post(self.send_timeout_now, lane='client')  # runs once they are returned
+			return
+		returned = self.server.take_returned_commands()
+		if returned:
+			self.messenger.send(self.make_message('returned commands', commands=returned), target)
+		self.messenger.send(self.make_message('timeout now'), target, flush=True)
+
+	def abort_transfer(self):
+		if self.election_state == 'leader' and self.transfer_target is not None:
+			print('\n', self.id, ' leadership transfer to ', self.transfer_target, ' timed out')
+			self.transfer_target = None
+			self.transfer_handle = None
+			self.server.turn_on_leader_queue()
+
+	def end_transfer(self):
+		self.transfer_target = None
+		if self.transfer_handle is not None:
+			self.transfer_handle.cancel()
+			self.transfer_handle = None
+
+	def receive_returned_commands(self, message: dict):
+		'''client commands a leader handing over to us read but did not log'''
+		for command in message['commands'].split(';'):
+			self.server.return_client_command(command)
+
+	def receive_timeout_now(self, message: dict):
+		'''Our leader is handing over: start an election now, skipping pre-vote'''
+		if message['term'] == self.term and self.election_state == 'follower':
+			self.start_election()
+
+	def campaign(self):
+		'''Election timeout: run a pre-vote round first if enabled, otherwise start an election'''
+		if self.pre_vote:
+			self.start_pre_vote()
+		else:
+			self.start_election()
+
+	def start_pre_vote(self):
+		'''
+		Ask peers whether they would vote for us in the next term, without
+		incrementing our own term (Raft thesis §9.6). Only a majority of yes
+		answers starts a real election, so a node that was cut off keeps its
+		term and cannot force a healthy leader to step down when it returns.
+		'''
+		self.heartbeat.stop_timer()  # a split-vote candidate stops re-requesting votes
+		self.pre_voting = True
+		self.pre_votes = {self.id}
+		request = self.make_message('request votes', pre_vote=True)
+		for peer in self.peers:
+			self.messenger.send(request, peer)
 
 	def start_election(self):  # this is equivalent to "set_candidate()"
 		'''Set election state to 'candidate', vote for self, and request votes
@@ -234,6 +676,8 @@ class ConsensusModule:
 			# print('\n', self.id, ' set state to candidate')
 		self.heartbeat.stop_timer()
 		self.election_state = 'candidate'
+		self.pre_voting = False
+		self.newer_log_seen = False
 		self.term+= 1 # starting an election increments the term
 		self.voted_for = self.id # vote for self
 		self.vote_count = 1 # count of self vote
@@ -252,19 +696,129 @@ class ConsensusModule:
 				#print(self.id, ' Requesting Vote from: ', peer, ' Term: ', self.term)
 		
 	def send_heartbeat(self):
-		'''Make a heartbeat message and send it to all peers. Used by leader'''	
+		'''
+		Make a heartbeat message and send it to every peer that has heard
+		nothing from us for half a heartbeat interval; a recent AppendEntries
+		already did the job. Used by leader. On a node hosting several groups
+		each group's own timer calls this for that group only; heartbeats of
+		groups firing close together still share the messenger's send batches.
+		'''
 		if self.election_state == 'leader':
+			if self.check_quorum and not self.has_quorum():
+				print('\n', self.id, ' lost contact with a majority, stepping down')
+				self.set_follower(self.term)
+				return
+			self.log.make_durable()  # the leader's own copy counts toward the majority
+			idle_since = monotonic() - self.heartbeat.duration / 2
 			for peer in self.peers:  # send to peers
-				entries_string = self.log.get_entries_string(self.nextIndex[peer])
-				if not entries_string:
-					entries_string = 'heartbeat'
-				heartbeat = self.make_message('heartbeat', entries=entries_string, destination=peer)
-				#print('Append entries: ', heartbeat)
-				self.messenger.send(heartbeat, peer)
+				if self.last_sent[peer] <= idle_since:
+					self.send_append_entries(peer)
+
+	def has_quorum(self) -> bool:
+		'''True if a majority, counting ourselves, replied within the last election timeout'''
+		heard_since = monotonic() - self.election_timer.duration
+		active = 1 + sum(1 for heard in self.last_heard.values() if heard >= heard_since)
+		return active > math.floor((len(self.peers) + 1) / 2)
+
+	def election_timeout(self, heartbeat_interval: float) -> float:
+		'''shortest election timeout for followers of a leader beating every heartbeat_interval'''
+		timeout = self.election_heartbeats * heartbeat_interval
+		return min(max(timeout, self.min_election_timeout), self.timer_length)
+
+	def adapt_timeouts(self):
+		'''
+		Derive the heartbeat interval from the slowest peer's RTO, so a quick
+		transport gets quick failover and a slow one is not flooded with
+		elections. Followers derive their election timeout from the interval
+		we advertise in every AppendEntries. Used by leader
+		'''
+		rtos = [estimator.rto() for estimator in self.rtt.values() if estimator.samples]
+		if not rtos:
+			return
+		interval = self.heartbeat_rtos * max(rtos)
+		interval = min(max(interval, self.min_heartbeat), self.max_heartbeat)
+		# followers shorten their timeouts as soon as they hear the new interval,
+		# so a tick still scheduled on a much longer one must not wait it out
+		shrunk = interval < self.heartbeat.duration / 2
+		grown = interval > self.heartbeat.duration
+		self.heartbeat.duration = interval
+		self.election_timer.duration = self.election_timeout(interval)
+		if shrunk and self.election_state == 'leader':
+			self.heartbeat.restart_timer()
+		if grown and self.election_state == 'leader':
+			# followers still time out on the old interval, so the tick already
+			# scheduled on it must reach every peer, however recently sent to
+			for peer in self.peers:
+				self.last_sent[peer] = 0.0
+
+	def schedule_replication(self):
+		'''
+		Replicate new entries after replication_delay instead of waiting for
+		the next heartbeat. Commands arriving in the meantime join that round.
+		'''
+		if self.replication_pending:
+			return
+		self.replication_pending = True
+		self.scheduler.schedule(self.replication_delay, lambda: self.loop.post(self.replicate))
+
+	def replicate(self):
+		'''Send new entries to every peer that does not have them yet. Used by leader'''
+		self.replication_pending = False
+		if self.election_state == 'leader':
+			self.log.make_durable()
+			for peer in self.peers:
+				self.pump(peer)
+
+	def pump(self, peer: str):
+		'''
+		Stream new entries to peer without waiting for replies, up to
+		max_inflight requests ahead of its acknowledgements (one while probing).
+		'''
+		while self.nextIndex[peer] < len(self.log):
+			window = 1 if self.probing[peer] else self.max_inflight
+			if len(self.inflight[peer]) >= window:
+				break
+			self.send_append_entries(peer)
+
+	def send_append_entries(self, peer: str):
+		'''Send peer the entries from its nextIndex on, or the snapshot if those are gone'''
+		self.last_sent[peer] = monotonic()
+		if self.log.get_entry(self.nextIndex[peer] - 1) is None:
+			# the entries this peer needs next were compacted away
+			self.probing[peer] = True
+			self.inflight[peer].clear()
+			self.inflight[peer].append(self.snapshot['lastIncludedIndex'])
+			self.messenger.send(self.make_message('install snapshot'), peer)
+			return
+		entries_string, count = self.log.get_entries_string(
+			self.nextIndex[peer], self.max_append_entries, self.max_append_bytes)
+		heartbeat = self.make_message('heartbeat', entries=entries_string, destination=peer)
+		#print('Append entries: ', heartbeat)
+		if count:
+			last_index = self.nextIndex[peer] + count - 1
+			self.inflight[peer].append(last_index)
+			if not self.probing[peer]:  # assume it arrives; a rejection rewinds
+				self.nextIndex[peer] = last_index + 1
+		self.messenger.send(heartbeat, peer)
 
 	def handle_incoming_message(self, message: dict):
+		'''Messenger interface, called on the receive thread: queue the message for the loop'''
+		self.loop.post(self.receive_message, message, kind=message['messageType'])
+
+	def handle_batch_end(self):
+		'''Messenger interface, called on the receive thread after each batch'''
+		self.loop.post(self.send_pending_replies)
+
+	def receive_message(self, message: dict):
 		message_type = message['messageType']
-		incoming_term = int(message['term'])
+		incoming_term = message['term']
+		# a pre-vote carries the term an election would use, not a real one
+		if message_type in ('RequestVotesRPC', 'VoteReply') and message['preVote']:
+			if message_type == 'RequestVotesRPC':
+				self.receive_pre_vote_request(message)
+			else:
+				self.receive_pre_vote_reply(message)
+			return
 		if (incoming_term > self.term):
 			self.set_follower(incoming_term)
 			#print(self.id, ' greater term detected, setting state to follower.')
@@ -276,6 +830,12 @@ class ConsensusModule:
 			self.receive_append_entry_request(message)
 		elif message_type == 'AppendReply':
 			self.receive_append_entry_reply(message)
+		elif message_type == 'InstallSnapshotRPC':
+			self.receive_install_snapshot(message)
+		elif message_type == 'TimeoutNowRPC':
+			self.receive_timeout_now(message)
+		elif message_type == 'ReturnedCommands':
+			self.receive_returned_commands(message)
 		elif message_type == 'RequestVotesRPC':
 			self.receive_vote_request(message)
 		elif message_type == 'VoteReply':
@@ -292,15 +852,22 @@ class ConsensusModule:
 		new entry). 
 		
 		more details to follow later'''
-		self.election_timer.duration = self.timer_length/4
 		leader = message['leaderID']
-		incoming_term = int(message['term'])
+		incoming_term = message['term']
+		if incoming_term < self.term:
+			# a deposed leader: refuse before touching the log or the timer, our
+			# term in the reply makes it step down (§5.1)
+			reply = self.make_message('reply to append request', success=False)
+			reply['sentAt'] = message['sentAt']
+			self.pending_replies.append((reply, leader))
+			return
+		self.election_timer.duration = self.election_timeout(message['heartbeatInterval'] / 1000)
 		#print("****HEREHEREHRER ***", message['entries'])
 		entries = self.log.parse_entries_to_list(message['entries'])
 
-		leaderCommit = int(message['leaderCommit'])
-		prevLogIndex = int(message['prevLogIndex'])
-		prevLogTerm = int(message['prevLogTerm'])
+		leaderCommit = message['leaderCommit']
+		prevLogIndex = message['prevLogIndex']
+		prevLogTerm = message['prevLogTerm']
 		prevLogCommand = message['prevLogCommand']
 		# special scenario for converting to follower: 
 		if incoming_term == self.term and self.election_state == 'candidate':
@@ -311,6 +878,9 @@ class ConsensusModule:
 		#print('\n', self.id, ' received append entry request from ', leader, ': \n',  message)
 		if (self.election_state == 'follower'):
 			self.election_timer.restart_timer()
+		if incoming_term == self.term:
+			self.leader_contact = monotonic()
+			self.server.release_returned_commands()  # its leader queue is open now
 
 		success, match = self.process_AppendRPC(
 			entries=entries, 
@@ -320,11 +890,27 @@ class ConsensusModule:
 			prevLogCommand=prevLogCommand
 			)
 		#print(success, match, '=================================')
-		reply = self.make_message('reply to append request', success=success)
-		self.messenger.send(reply, leader)
+		conflict_term, conflict_index = -1, 0
+		if not success:
+			conflict_term, conflict_index = self.conflict_hint(prevLogIndex)
+		reply = self.make_message('reply to append request', success=success, match=match,
+			conflict_term=conflict_term, conflict_index=conflict_index)
+		reply['sentAt'] = message['sentAt']  # lets the leader time the round trip
+		self.pending_replies.append((reply, leader))  # sent by send_pending_replies()
 			
 		#print('\n', self.id, ' replied to append request')
 
+	def send_pending_replies(self):
+		'''
+		Every message of a receive batch has been handled: make the entries
+		they appended durable with one fsync, then acknowledge them all.
+		'''
+		if self.pending_replies:
+			self.log.make_durable()  # never acknowledge entries that could still be lost
+			replies, self.pending_replies = self.pending_replies, []
+			for reply, leader in replies:
+				self.messenger.send(reply, leader)
+
 	def process_AppendRPC(self, entries: list, leaderCommit: int, prevLogIndex: int,
 								prevLogTerm: int, prevLogCommand: str)-> (bool, int):
 		# if logs are inconsistent or out of term, reply false
@@ -335,77 +921,223 @@ class ConsensusModule:
 		# elif (self.log.get_entry(prevLogIndex).command != prevLogCommand):
 		# 	print("command at prev log index does not match incoming")
 
+		# entries already covered by our snapshot are committed, so they match
+		if prevLogIndex < self.log.snapshot_index:
+			entries = entries[self.log.snapshot_index - prevLogIndex:]
+			prevLogIndex = self.log.snapshot_index
+			prevLogTerm = self.log.get_entry(prevLogIndex).term
+
 		#reply false if log doesn’t contain an entry at prevLogIndex whose 
 		# term matches prevLogTerm (§5.3)
 		if ((not self.log.idx_exist(prevLogIndex))
 			or (self.log.get_entry(prevLogIndex).term != prevLogTerm)):
 			#or (self.log.get_entry(prevLogIndex).command != prevLogCommand)): 
 			return False, 0
-		# otherwise, check if outdated entry exists in initial append spot. 
-		# if so, delete that entry and all following
+		# otherwise, check if an outdated entry conflicts with an incoming one.
+		# if so, delete that entry and all following. Entries past the end of
+		# this request are left alone: requests are capped, so a shorter one
+		# says nothing about what follows it (§5.3)
 		else:
-			if self.log.idx_exist(prevLogIndex+1):
-				self.log.rollback(prevLogIndex+1)
-			# Append the new entries to the log
-			for entry in entries:
-				self.log.append_to_end(entry)
-			#update the commit index of this server, equal to leader or last applied
+			for i, entry in enumerate(entries):
+				existing = self.log.get_entry(prevLogIndex + 1 + i)
+				if existing is not None and existing.term == entry.term:
+					continue  # already have it
+				if existing is not None:
+					self.log.rollback(prevLogIndex + 1 + i)
+				# Append the new entries to the log
+				for new_entry in entries[i:]:
+					self.log.append_to_end(new_entry)
+				break
+			last_new_entry = prevLogIndex + len(entries)
+			#update the commit index of this server, equal to leader or last new entry
 			# whichever is smaller
 			if leaderCommit > self.commitIndex:
-				self.commitIndex = min(leaderCommit, len(self.log)-1)
-			# return True and tell leader index of last applied to update match
-			return True, len(self.log)-1
+				self.set_commit_index(min(leaderCommit, last_new_entry))
+			# return True and tell leader index of last new entry to update match
+			return True, last_new_entry
 
 
 
+	def conflict_hint(self, prevLogIndex: int) -> (int, int):
+		'''
+		Tell the leader where our log diverges so it can skip back a whole
+		term per round trip instead of one entry. Returns (conflictTerm,
+		conflictIndex): the term we hold at prevLogIndex and the first index
+		of that term, or (-1, length of our log) if we have no entry there.
+		'''
+		if not self.log.idx_exist(prevLogIndex):
+			return -1, len(self.log)
+		return self.log.get_entry(prevLogIndex).term, self.log.first_index_of_term(prevLogIndex)
+
+	def set_commit_index(self, index: int):
+		'''raise commitIndex to index (it never goes down) and wake the apply loop'''
+		with self.commit_advanced:
+			if index > self.commitIndex:
+				self.commitIndex = index
+				self.commit_advanced.notify_all()
+				if self.commit_event is not None:
+					call_soon(self.commit_event.set)
+
+	def wait_for_commit(self, applied: int, timeout: float = None) -> int:
+		'''
+		Block until commitIndex passes applied, or timeout seconds go by.
+		Returns commitIndex.
+		'''
+		with self.commit_advanced:
+			self.commit_advanced.wait_for(lambda: self.commitIndex > applied, timeout)
+			return self.commitIndex
+
+	async def wait_for_commit_async(self, applied: int, timeout: float = None) -> int:
+		'''wait_for_commit() for the asyncio runtime's apply loop'''
+		self.commit_event.clear()
+		if self.commitIndex <= applied:
+			try:
+				await asyncio.wait_for(self.commit_event.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+		return self.commitIndex
+
+	def receive_install_snapshot(self, message: dict):
+		'''
+		Replace the log prefix and the game state with the leader's snapshot
+		(§7). Replies with an AppendReply matching the snapshot's last index.
+		'''
+		leader = message['leaderID']
+		incoming_term = message['term']
+		if incoming_term < self.term:
+			reply = self.make_message('reply to append request', success=False)
+			self.messenger.send(reply, leader)
+			return
+		if self.election_state == 'candidate':
+			self.set_follower(incoming_term)
+		if self.election_state == 'follower':
+			self.election_timer.restart_timer()
+		self.leader_contact = monotonic()
+
+		last_index = message['lastIncludedIndex']
+		if last_index > self.commitIndex:
+			snapshot = json.loads(message['data'])
+			self.save_snapshot(snapshot)
+			# the apply loop must move past last_index before those entries go
+			self.server.restore_snapshot(snapshot)
+			self.log.reset_to_snapshot(last_index, message['lastIncludedTerm'])
+			self.set_commit_index(last_index)
+		reply = self.make_message('reply to append request', success=True, match=last_index)
+		self.messenger.send(reply, leader)
+
+	def take_snapshot(self, state: dict):
+		'''
+		Save the game state as applied up to state['lastApplied'] and discard
+		the log entries it covers.
+		'''
+		last_index = state['lastApplied']
+		if last_index <= self.log.snapshot_index:
+			return  # a snapshot installed meanwhile already covers it
+		snapshot = {
+			'lastIncludedIndex': last_index,
+			'lastIncludedTerm': self.log.get_entry(last_index).term,
+			'state': state
+		}
+		self.save_snapshot(snapshot)
+		self.log.compact(last_index)
+
+	def save_snapshot(self, snapshot: dict):
+		temp_path = self.snapshot_path + '.tmp'
+		with open(temp_path, 'w') as snapshot_file:
+			json.dump(snapshot, snapshot_file)
+			snapshot_file.flush()
+			os.fsync(snapshot_file.fileno())
+		os.replace(temp_path, self.snapshot_path)
+		self.snapshot = snapshot
+
+	def load_snapshot(self) -> dict:
+		try:
+			with open(self.snapshot_path, 'r') as snapshot_file:
+				snapshot = json.load(snapshot_file)
+		except FileNotFoundError:
+			return None
+		# a crash between saving a snapshot and compacting leaves a longer log
+		if snapshot['lastIncludedIndex'] > self.log.snapshot_index:
+			self.log.reset_to_snapshot(snapshot['lastIncludedIndex'], snapshot['lastIncludedTerm'])
+		return snapshot
+
 	def receive_append_entry_reply(self, message: dict):
 		'''
-		This method processes replies from followers. If successful, update nextIndex
-		and matchIndex for follower. If failed, decrement nextIndex for follower
-		and try again. 
+		This method processes replies from followers. If successful, update
+		matchIndex for follower, retire the requests it covers and keep the
+		stream going. If failed, move nextIndex back past the conflicting term
+		the follower reported and probe again right away.
 		'''
 	
-		incoming_term = int(message['term'])
+		incoming_term = message['term']
 		if incoming_term > self.term:
 			self.set_follower(incoming_term)  # set state to follower
 			#print(self.id, ' greater term/leader detected, setting state to follower.')
 
 		follower = message['senderID']
-		success = bool(message['success'])
-		incoming_match = int(message['match'])
+		success = message['success']
+		incoming_match = message['match']
 		# only do the following if we are currently leader. 
 		if self.election_state == 'leader':
+			if incoming_term == self.term:
+				self.last_heard[follower] = monotonic()
+				if message['sentAt']:
+					self.rtt[follower].record(monotonic() - message['sentAt'] / 1e6)
+					self.adapt_timeouts()
 			if success: # follower is up to date
-				self.matchIndex[follower] = incoming_match
-				self.nextIndex[follower] = incoming_match + 1
-			else: # follower is not up to date, decrement index for next time
-				if self.nextIndex[follower] > 1: # next index should never be less than 1
-					self.nextIndex[follower] -= 1
+				self.quorum.update(follower, incoming_match)
+				inflight = self.inflight[follower]
+				while inflight and inflight[0] <= incoming_match:
+					inflight.popleft()
+				if self.probing[follower]:  # found the follower's position, stream from here
+					self.probing[follower] = False
+					inflight.clear()
+					self.nextIndex[follower] = incoming_match + 1
+				else:
+					self.nextIndex[follower] = max(self.nextIndex[follower], incoming_match + 1)
+				if self.nextIndex[follower] < len(self.log):
+					self.log.make_durable()  # only hand out entries we hold durably ourselves
+				self.pump(follower)
+				if follower == self.transfer_target:
+					self.send_timeout_now()
+			elif incoming_term == self.term: # follower is not up to date, back off and retry
+				next_index = self.backtrack_index(message['conflictTerm'], message['conflictIndex'])
+				# the rest of a rejected window carries the same hint, one probe is enough
+				duplicate = (self.probing[follower] and self.inflight[follower]
+					and next_index == self.nextIndex[follower])
+				if not duplicate:
+					self.probing[follower] = True
+					self.inflight[follower].clear()
+					self.nextIndex[follower] = next_index
+					self.send_append_entries(follower)
 
 			#############################
 			# Commit available entries: #
 			#############################
-			N = self.commitIndex + 1
-			if self.log.idx_exist(N): # if an entry exists to commit
-				# print('log entry to be committed exists')
-				# collect the number of peers that have replicated entry N
-				match_count = 0
-				for peer in self.peers: 
-					if self.matchIndex[peer] >= N:
-						match_count += 1 
-				#print("match count: ", match_count, " log term: ", self.log.get_entry(N).term)
-				# If there exists an N such that N > commitIndex, a majority of 
-				# matchIndex[i] ≥ N, and log[N].term == currentTerm:
-				# set commitIndex = N (§5.3, §5.4).
-				if (self.log.get_entry(N).term == self.term 
-						and match_count + 1 > math.floor(len(self.peers) / 2)):
-					# if that entry is the correct term, and if a majority of 
-					# servers have replicated that entry, commit that entry. 
-					#print("increment commit index")
-					self.commitIndex = N
+			# If there exists an N such that N > commitIndex, a majority of 
+			# matchIndex[i] ≥ N, and log[N].term == currentTerm:
+			# set commitIndex = N (§5.3, §5.4). The quorum tracker finds the
+			# largest such N directly; entries below it commit with it. Our
+			# own copy only counts once it is durable.
+			N = self.quorum.majority_index(self.log.durable_index)
+			if N > self.commitIndex and self.log.get_entry(N).term == self.term:
+				self.set_commit_index(N)
 
 		#print('\n', self.id, ' received append entries reply :', message)
 
+	def backtrack_index(self, conflict_term: int, conflict_index: int) -> int:
+		'''
+		nextIndex for a follower that rejected AppendEntries (§5.3). If we
+		hold entries of the follower's conflicting term, resume just after our
+		last one; otherwise skip the follower's whole run of that term.
+		'''
+		next_index = conflict_index
+		if conflict_term != -1:
+			last_of_term = self.log.last_index_of_term(conflict_term)
+			if last_of_term is not None:
+				next_index = last_of_term + 1
+		return min(max(next_index, 1), len(self.log))  # next index should never be less than 1
+
 	def receive_vote_request(self, message: dict):
 		'''
 		this method processes RequestVoteRPCs. If the incomingTerm < self.term, 
@@ -413,19 +1145,15 @@ class ConsensusModule:
 		*and* the candidate's log is at least as up to date as self, grant vote. 
 		'''
 		candidate = message['candidateID']
-		incoming_term = int(message['term'])
+		incoming_term = message['term']
 		#print('\n', self.id, ' received vote request from ', candidate, ': \n')
 
 		if incoming_term > self.term:  # as always, check for greater term, set to follower if true
 			self.set_follower(incoming_term)  # set state to follower
 			#print(self.id, ' greater term detected, setting state to follower.')
 
-		# TODO: if candidate log shorter than self, reply false
-
-		if self.voted_for == 'null':  # && candidate log is at least as up to date as self:
-			# at least as up to date is defined as: 
-			# term of incoming last log entry is equal or greater than self. 
-			# if equal term, index of incoming last log entry is equal or greater than self. 
+		if (incoming_term == self.term and self.voted_for == 'null'
+			and self.log_up_to_date(message['lastLogIndex'], message['lastLogTerm'])):
 			self.voted_for = candidate
 			#print('\n', self.id, ' voted for ', self.voted_for)
 
@@ -434,34 +1162,84 @@ class ConsensusModule:
 			voteGranted = True
 
 		reply = self.make_message('reply to vote request', voteGranted= voteGranted)
-		self.messenger.send(reply, candidate)
+		self.messenger.send(reply, candidate, flush=True)  # elections wait on this
 		
 		#print('\n', self.id, ' replied ', reply['voteGranted'], ' to ', candidate, ' request for votes')
 
+	def receive_pre_vote_request(self, message: dict):
+		'''
+		Say whether we would vote for the candidate in the term it proposes.
+		Nothing changes here, not even our term. The answer is no while we
+		still hear from a leader: the candidate is the one out of touch.
+		'''
+		candidate = message['candidateID']
+		leader_recent = monotonic() - self.leader_contact < self.election_timer.duration
+		granted = (message['term'] > self.term and self.election_state != 'leader'
+			and not leader_recent
+			and self.log_up_to_date(message['lastLogIndex'], message['lastLogTerm']))
+		reply = self.make_message('reply to vote request', voteGranted=granted, pre_vote=True)
+		if granted:
+			reply['term'] = message['term']  # ties the answer to the round it belongs to
+		self.messenger.send(reply, candidate, flush=True)
+
+	def last_log(self) -> (int, int):
+		'''(term, index) of our last log entry'''
+		return self.log.get_entry(-1).term, len(self.log) - 1
+
+	def log_up_to_date(self, last_index: int, last_term: int) -> bool:
+		'''
+		True if a log ending at last_index/last_term is at least as up to date
+		as ours (§5.4.1): the later last term wins, and with equal last terms
+		the longer log wins.
+		'''
+		return (last_term, last_index) >= self.last_log()
+
+	def receive_pre_vote_reply(self, message: dict):
+		incoming_term = message['term']
+		if not message['voteGranted']:
+			if incoming_term > self.term:  # a refusal carries the voter's real term
+				self.set_follower(incoming_term)
+			return
+		if self.pre_voting and incoming_term == self.term + 1:
+			self.pre_votes.add(message['senderID'])
+			if len(self.pre_votes) > math.floor((len(self.peers) + 1) / 2):
+				self.start_election()
+
 	def receive_vote_reply(self, message: dict):
 
 		vote_granted = message['voteGranted']  # store value of vote received
 		sender = message['senderID']
-		incoming_term = int(message['term'])
+		incoming_term = message['term']
 		#print(self.id, ' received vote reply: ', vote_granted, ' from ', sender)
 
 		if self.election_state == 'candidate' and incoming_term == self.term:
 			if not self.reply_status[sender]:
 				self.reply_status[sender] = True  # mark sender as having replied
-				if vote_granted == 'True':
+				if (message['lastLogTerm'], message['lastLogIndex']) > self.last_log():
+					self.newer_log_seen = True
+				if vote_granted:
 					self.vote_count += 1
 					#print('\n', self.id, ' vote count = ', self.vote_count)
 				#print('votes needed: ', math.floor(len(self.peers) / 2) + 1)
 				if self.vote_count > math.floor(len(self.peers) / 2):
+					self.elections_won += 1
+					if self.newer_log_seen:
+						self.stale_wins += 1
 					self.set_leader()
 					#print('\n', self.id, ' majority votes acquired')
 
 	def make_message(self, message_type: str, voteGranted:bool = False, 
-	success: bool = False, entries: str = '[]', destination = '') -> dict:
+	success: bool = False, entries: str = '', destination = '', match: int = None,
+	conflict_term: int = -1, conflict_index: int = 0, pre_vote: bool = False,
+	commands: list = ()) -> dict:
 		'''
 		options: 'heartbeat', 'reply to append request', 'request votes', 
-		'reply to vote request'. returns a dictionary
-		Include destination with reply to vote request. 
+		'reply to vote request', 'install snapshot', 'timeout now', 'returned commands'.
+		returns a dictionary of typed fields, see Codec.py for the wire format. Include destination
+		with heartbeat. match overrides the index a reply reports; a rejected
+		append reply carries the follower's conflict term and index. pre_vote
+		marks a vote request or reply as part of a pre-vote round. commands
+		are the client commands a 'returned commands' message hands on.
 		'''
 		if message_type == 'heartbeat':
 			prevLogIndex = self.nextIndex[destination]-1
@@ -469,60 +1247,122 @@ class ConsensusModule:
 			prevLog = self.log.get_entry(prevLogIndex)
 			message = {
 				'messageType': 	'AppendEntriesRPC',
+				'group':		self.group,
 				'leaderID': 	self.id,
-				'term': 		str(self.term),
+				'term': 		self.term,
 				'entries'		:	entries,
-				'prevLogIndex' : str(prevLogIndex), 
-				'prevLogTerm' : str(prevLog.term),
-				'prevLogCommand': str(prevLog.command),
-				'leaderCommit' : str(self.commitIndex),
-				'nextIndex' : str(self.nextIndex[destination])
+				'prevLogIndex' : prevLogIndex, 
+				'prevLogTerm' : prevLog.term,
+				'prevLogCommand': prevLog.command,
+				'leaderCommit' : self.commitIndex,
+				'nextIndex' : self.nextIndex[destination],
+				'sentAt' : int(monotonic() * 1e6),  # microseconds, echoed in the reply
+				'heartbeatInterval' : int(self.heartbeat.duration * 1000)  # milliseconds
 			}
 		elif message_type == 'reply to append request':
 			message = {
 				'messageType':	'AppendReply',
+				'group':		self.group,
 				'senderID':		self.id,
-				'term':			str(self.term),
-				'match':		str(len(self.log)-1), #return index of last appended entry if true
-				'success' : 	str(success)
+				'term':			self.term,
+				'match':		len(self.log)-1 if match is None else match, #return index of last appended entry if true
+				'success' : 	success,
+				'conflictTerm':	conflict_term,
+				'conflictIndex': conflict_index,
+				'sentAt':		0
 			}
 		elif message_type == 'request votes':
 			message = {
 				'messageType':	'RequestVotesRPC',
-				'term':			str(self.term),
-				'candidateID':	self.id
-				#'lastLogIndex': {'value': self.lastLogIndex},
-				#'lastLogTerm': {'value': self.lastLogTerm}
+				'group':		self.group,
+				'term':			self.term + 1 if pre_vote else self.term,
+				'candidateID':	self.id,
+				'preVote':		pre_vote,
+				'lastLogIndex': len(self.log) - 1,
+				'lastLogTerm':	self.log.get_entry(-1).term
+			}
+		elif message_type == 'install snapshot':
+			message = {
+				'messageType':	'InstallSnapshotRPC',
+				'group':		self.group,
+				'leaderID':		self.id,
+				'term':			self.term,
+				'lastIncludedIndex': self.snapshot['lastIncludedIndex'],
+				'lastIncludedTerm':	self.snapshot['lastIncludedTerm'],
+				'data':			json.dumps(self.snapshot)
+			}
+		elif message_type == 'timeout now':
+			message = {
+				'messageType':	'TimeoutNowRPC',
+				'group':		self.group,
+				'leaderID':		self.id,
+				'term':			self.term
+			}
+		elif message_type == 'returned commands':
+			message = {
+				'messageType':	'ReturnedCommands',
+				'group':		self.group,
+				'term':			self.term,
+				'commands':		';'.join(commands)
 			}
 		elif message_type == 'reply to vote request':
 			message = {
 				'messageType': 	'VoteReply',
+				'group':		self.group,
 				'senderID':		self.id,
-				'term':			str(self.term),
-				'voteGranted':	str(voteGranted)
+				'term':			self.term,
+				'voteGranted':	voteGranted,
+				'preVote':		pre_vote,
+				'lastLogIndex': len(self.log) - 1,
+				'lastLogTerm':	self.log.get_entry(-1).term
 			}
 		else:
 			print('you fucked up')
 		return message
 
-	def add_client_command_to_log(self, command: str):
+	def add_client_command_to_log(self, command: str, term: int):
+		'''
+		Append a client command read off the leader queue while we led term.
+		Client commands wait behind every consensus event, so by now we may
+		have stepped down (appending would slip the command into the next
+		leader's term as if that leader sent it) or be handing leadership
+		over. The command then goes back to the server, which hands it to
+		whoever leads next.
+		'''
+		if self.election_state != 'leader' or self.term != term or self.transfer_target is not None:
+			self.returned_commands += 1
+			self.server.return_client_command(command)
+			return
 		self.log.append_to_end(LogEntry(self.term, command))
+		self.schedule_replication()
 
-	def get_command(self, idx)-> dict:
-		command_str = self.log.get_entry(idx).command
-		command = ast.literal_eval(command_str)
-		return command
+	def get_command(self, idx)-> Command:
+		return Command.decode(self.log.get_entry(idx).command)
 	
 	def simulation_print(self):
-		node = f"Node:\t\t{self.id}\n"
+		node = f"Node:\t\t{self.id}\n" if self.group == 0 else f"Node:\t\t{self.id}, group {self.group}\n"
 		term = f"Term:\t\t{str(self.term)}\n"
 		commitIndex = f"Commit Index:\t{str(self.commitIndex)}\n"
+		snapshotIndex = f"Snapshot Index:\t{str(self.log.snapshot_index)}\n"
 		electionState = f"Election State:\t{self.election_state}\n"
 		votedFor = f"Voted For:\t{self.voted_for}\n"
 		voteCount = f"Vote Count:\t{str(self.vote_count)}\n"
+		pollStats = f"Receive Polls:\t{self.messenger.transport.poll_stats}\n"
+		timerJitter = f"Timer Jitter:\t{self.election_timer.scheduler.jitter}\n"
+		fanout = f"Send Fan-out:\t{self.messenger.fanout}\n"
+		timeouts = (f"Timeouts:\theartbeat {self.heartbeat.duration*1000:.0f} ms, "
+			f"election {self.election_timer.duration*1000:.0f} ms\n")
+		applied = f"Apply:\t\t{self.server.apply_stats}\n"
+		matches = f"Live Matches:\t{len(self.server.matches)}\n"
+		elections = f"Elections Won:\t{self.elections_won}, {self.stale_wins} with a stale log\n"
+		events = f"Events:\t\t{self.loop.stats}\n"
+		inbox = (f"Client Inbox:\t{self.loop.mailbox.lanes['client']}, "
+			f"{self.returned_commands} returned to the leader queue, "
+			f"{len(self.server.returned)} waiting for a leader\n")
 
 		
-		loglen = len(self.log)
+		snapshot_index, entries = self.log.view  # read once, compaction may swap it meanwhile
+		loglen = snapshot_index + len(entries)
 		display_width = 13
 		log_height = 7
 		log_contents = ''
@@ -531,12 +1371,9 @@ class ConsensusModule:
 			log_contents += '--------'*8 +'\n'
 			log_contents += "Index\tTerm\tCommand\n"
 			log_contents += '--------'*8 +'\n'
-			if loglen <= log_height:
-				for x in range(0, loglen):
-					log_contents += str(x) +'\t' + str(self.log.get_entry(x)) + '\n'
-			else:
-				for x in range(loglen-log_height, loglen):
-					log_contents += str(x) +'\t' + str(self.log.get_entry(x)) + '\n'
+			for x in range(max(loglen-log_height, snapshot_index), loglen):
+				entry = entries[x - snapshot_index]
+				log_contents += f'{x}\t{entry.term}\t{Command.describe(entry.command)}\n'
 
 		header1 = ''
 		header2 = ''
@@ -588,10 +1425,10 @@ class ConsensusModule:
 					ntab = '\t'*(next - match) + ' ^\n'
 					peerStatus2 += mtab + ' *' + ntab 
 
-		status = (node + term + commitIndex + electionState+  
+		status = (node + term + commitIndex + snapshotIndex + electionState+ pollStats + timerJitter + fanout + timeouts + applied + matches + elections + events + inbox +
 				 log_contents + peerStatusHeader + header1 + peerStatus + header2 + peerStatus2)
 		
-		file = open(f"../files/status{self.id}.txt", 'w')
+		file = open(f"../files/status{self.name}.txt", 'w')
 		file.write(status)
 		file.close()
 		
@@ -1,56 +1,63 @@
-from time import sleep, clock
-from threading import Thread, Timer
+from threading import Lock
+from TimerScheduler import shared_scheduler
 import random
 
 class Election_Timer:
-
-    def __init__(self, duration: float, target):
+    """
+    Randomized election countdown. Runs from construction; when it elapses
+    the target starts an election and the countdown begins again.
+    Deadlines are kept by the shared TimerScheduler, so no thread spins
+    while waiting. post, when given, runs each firing on the target's
+    event loop instead of the scheduler thread.
+    """
+
+    def __init__(self, duration: float, target, post=None):
         self.target = target
         self.duration = duration
-        self.running = True
-        self.restart = False
-        self.stop = False
-
-        t = Thread( 
-			target=self.run, 
-			name='Election Timer Thread'
-			)
-        t.start()
+        self.post = post
+        self.scheduler = shared_scheduler()
+        self.lock = Lock()
+        self.handle = None
+        self.generation = 0  # bumped on every restart/stop to spot stale firings
+        self.restart_timer()
 
     def kill_thread(self):
-        self.running = False
+        self.stop_timer()
 
     def stop_timer(self):
-        self.stop = True
+        with self.lock:
+            self.generation += 1
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
 
     def restart_timer(self):
-        self.restart = True
-        self.stop = False
+        # randomize timeouts to avoid conflicting elections
+        timeout = self.new_timeout()
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = self.scheduler.schedule(timeout, lambda: self.fire(timeout, generation))
 
     def new_timeout(self) -> float:
         return (self.duration + 2*self.duration * random.random())
 
-    def run(self):
-        # randomize timeouts to avoid conflicting elections
-        timeout = self.new_timeout()
-        #start the timer
-        start = clock()
-        count = 0
-        while self.running:
-            while not self.stop:
-                count += 1
-                if self.restart:
-                    timeout = self.new_timeout()
-                    start = clock()
-                    self.restart = False
-
-                elapsed_time = clock() - start
-                if elapsed_time > timeout:
-                    print('\nCountodwn elapsed ', timeout, ',', self.target.id, ' Starting Election       \n')
-                    self.target.start_election()
-                    self.restart_timer()
-                    break
-                else:
-                    if count > 20000: 
-                        print('Election Timer: ', timeout-elapsed_time)  
-                        count =0
+    def fire(self, timeout: float, generation: int):
+        if self.post is None:
+            self.elapsed(timeout, generation)
+        else:
+            self.post(self.elapsed, timeout, generation)
+
+    def elapsed(self, timeout: float, generation: int):
+        with self.lock:
+            if generation != self.generation:  # restarted or stopped meanwhile
+                return
+            self.handle = None
+        print('\nCountodwn elapsed ', timeout, ',', self.target.id, ' Starting Election       \n')
+        self.target.campaign()
+        with self.lock:
+            superseded = generation != self.generation
+        if not superseded:
+            self.restart_timer()
@@ -0,0 +1,240 @@
+from time import monotonic
+from threading import Thread, Condition, Lock
+from collections import deque
+from AsyncRuntime import use_asyncio, on_loop, call_soon
+import asyncio, traceback
+
+# mailbox lanes in priority order, with the number of events that fills
+# each one (None never fills). Consensus events are limited by the protocol
+# itself (max_inflight per peer, one heartbeat per interval) and must never
+# wait; client commands come as fast as robots send them
+lane_capacities = {'consensus': None, 'client': 1024}
+
+
+class EventStats:
+	'''
+	Per kind of event: how many ran, how long they took and how long the
+	longest one waited in the mailbox, all in seconds. Recorded on the loop
+	thread, read from any thread.
+	'''
+
+	def __init__(self):
+		self.kinds = {}  # kind -> [count, total busy, max busy, max wait]
+		self.count = 0
+		self.busy = 0.0
+		self.max_wait = 0.0
+		self.lock = Lock()  # a new kind must not appear while kinds is iterated
+
+	def record(self, kind: str, wait: float, busy: float):
+		with self.lock:
+			stats = self.kinds.get(kind)
+			if stats is None:
+				stats = self.kinds[kind] = [0, 0.0, 0.0, 0.0]
+			stats[0] += 1
+			stats[1] += busy
+			stats[2] = max(stats[2], busy)
+			stats[3] = max(stats[3], wait)
+			self.count += 1
+			self.busy += busy
+			self.max_wait = max(self.max_wait, wait)
+
+	def snapshot(self) -> dict:
+		'''a copy of kinds, consistent with itself'''
+		with self.lock:
+			return {kind: list(stats) for kind, stats in self.kinds.items()}
+
+	def mean(self, kind: str = None) -> float:
+		if kind is None:
+			return self.busy / self.count if self.count else 0.0
+		count, total, _, _ = self.kinds[kind]
+		return total / count
+
+	def waited(self, kind: str) -> float:
+		'''longest time an event of this kind sat in the mailbox'''
+		stats = self.kinds.get(kind)
+		return stats[3] if stats else 0.0
+
+	def slowest(self) -> str:
+		'''the kind with the longest single event, None before any ran'''
+		kinds = self.snapshot()
+		if not kinds:
+			return None
+		return max(kinds, key=lambda kind: kinds[kind][2])
+
+	def __str__(self):
+		kinds = self.snapshot()
+		if not kinds:
+			return '0 handled'
+		slowest = max(kinds, key=lambda kind: kinds[kind][2])
+		return (f'{self.count} handled, mean {self.mean()*1000:.2f} ms, slowest {slowest} '
+			f'{kinds[slowest][2]*1000:.2f} ms, waited up to {self.max_wait*1000:.2f} ms')
+
+
+class Lane:
+	'''Events of one priority, oldest first'''
+
+	def __init__(self, capacity: int = None):
+		self.events = deque()
+		self.capacity = capacity
+		self.high_water = 0
+		self.full_count = 0  # times a producer had to wait for room
+
+	def full(self) -> bool:
+		return self.capacity is not None and len(self.events) >= self.capacity
+
+	def __str__(self):
+		return f'{len(self.events)} queued, up to {self.high_water}, full {self.full_count} times'
+
+
+class Mailbox:
+	'''
+	Events waiting for a loop, in the lanes of lane_capacities. An event
+	runs after the earlier events of its own lane and after every event
+	waiting in a lane ahead of it, so a backlog of client commands never
+	holds up heartbeats, votes or replies.
+
+	A full lane still takes posts: a producer that can wait (a Messenger,
+	see wait_for_room()) is expected to stop receiving instead, leaving
+	the backlog in the transport.
+	'''
+
+	def __init__(self):
+		self.lanes = {name: Lane(capacity) for name, capacity in lane_capacities.items()}
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def put(self, lane: str, event: tuple, first: bool = False):
+		'''first puts the event ahead of everything waiting in its lane'''
+		lane = self.lanes[lane]
+		if first:
+			lane.events.appendleft(event)
+		else:
+			lane.events.append(event)
+		lane.high_water = max(lane.high_water, len(lane.events))
+		self.size += 1
+
+	def get(self) -> tuple:
+		'''(event, lane it came from); the mailbox must not be empty'''
+		for lane in self.lanes.values():
+			if lane.events:
+				self.size -= 1
+				return lane.events.popleft(), lane
+
+
+class EventLoop:
+	'''
+	Mailbox served by one thread (actor model). Other threads never touch the
+	owner's state directly, they post an event and the loop runs the events
+	one at a time, in the order they were posted within each lane (see
+	Mailbox), so that state needs no locks. Events should not block for
+	long: everything posted after them waits.
+
+	methods:
+		post(callback, *args, kind, lane, first) : run callback(*args) on the loop, from any thread
+		wait_for_room(lane) : block while lane is full
+		stats : EventStats per kind (kind defaults to the callback's name)
+		mailbox : Mailbox, its lanes count how often they filled up
+	'''
+
+	def __init__(self, name: str):
+		self.mailbox = Mailbox()
+		lock = Lock()
+		self.ready = Condition(lock)  # something was posted
+		self.room = Condition(lock)  # an event left a bounded lane
+		self.stats = EventStats()
+		self.thread = Thread(target=self.run, name=name, daemon=True)
+		self.thread.start()
+
+	def post(self, callback, *args, kind: str = None, lane: str = 'consensus', first: bool = False):
+		with self.ready:
+			self.mailbox.put(lane, (monotonic(), kind or callback.__qualname__, callback, args), first)
+			self.ready.notify()
+
+	def wait_for_room(self, lane: str):
+		lane = self.mailbox.lanes[lane]
+		with self.room:
+			if lane.full():
+				lane.full_count += 1
+			while lane.full():
+				self.room.wait()
+
+	def run(self):
+		while True:
+			with self.ready:
+				while not self.mailbox:
+					self.ready.wait()
+				event, lane = self.mailbox.get()
+				if lane.capacity is not None:
+					self.room.notify_all()
+			run_event(self.stats, *event)
+
+
+class AsyncEventLoop:
+	'''
+	EventLoop for the asyncio runtime (see AsyncRuntime.py). Events are
+	callbacks on the process's one asyncio loop instead of a thread per
+	owner, taken from the Mailbox one per callback so other owners and
+	the transports get their turn in between.
+
+	methods:
+		post(callback, *args, kind, lane, first) : run callback(*args) on the loop, from any thread
+		wait_for_room(lane) : coroutine, returns once lane is not full
+		stats : EventStats per kind (kind defaults to the callback's name)
+		mailbox : Mailbox, its lanes count how often they filled up
+	'''
+
+	def __init__(self, name: str):
+		self.name = name
+		self.mailbox = Mailbox()
+		self.room = asyncio.Event()  # an event left a bounded lane
+		self.scheduled = False  # run_next() is due on the loop
+		self.stats = EventStats()
+
+	def post(self, callback, *args, kind: str = None, lane: str = 'consensus', first: bool = False):
+		event = (monotonic(), kind or callback.__qualname__, callback, args)
+		if on_loop():
+			self.put(lane, event, first)
+		else:
+			call_soon(self.put, lane, event, first)
+
+	def put(self, lane: str, event: tuple, first: bool = False):
+		self.mailbox.put(lane, event, first)
+		if not self.scheduled:
+			self.scheduled = True
+			call_soon(self.run_next)
+
+	async def wait_for_room(self, lane: str):
+		lane = self.mailbox.lanes[lane]
+		if lane.full():
+			lane.full_count += 1
+		while lane.full():
+			self.room.clear()
+			await self.room.wait()
+
+	def run_next(self):
+		event, lane = self.mailbox.get()
+		if lane.capacity is not None:
+			self.room.set()
+		run_event(self.stats, *event)
+		if self.mailbox:
+			call_soon(self.run_next)
+		else:
+			self.scheduled = False
+
+
+def run_event(stats: EventStats, posted: float, kind: str, callback, args: tuple):
+	start = monotonic()
+	try:
+		callback(*args)
+	except Exception:
+		traceback.print_exc()
+	stats.record(kind, start - posted, monotonic() - start)
+
+
+def make_event_loop(name: str):
+	'''an EventLoop, or an AsyncEventLoop with RAFT_RUNTIME=asyncio'''
+	if use_asyncio():
+		return AsyncEventLoop(name)
+	return EventLoop(name)
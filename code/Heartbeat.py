@@ -1,57 +1,60 @@
-from time import sleep, clock
-from threading import Thread, Timer
-import random
+from threading import Lock
+from TimerScheduler import shared_scheduler
 
 class Heartbeat:
-
-    def __init__(self, duration: float, target):
+    """
+    Fires every duration/8 seconds while running: a leader sends heartbeats,
+    a candidate re-requests votes. Starts stopped. Deadlines are kept by
+    the shared TimerScheduler, so no thread spins while waiting. post, when
+    given, runs each firing on the target's event loop instead of the
+    scheduler thread.
+    """
+
+    def __init__(self, duration: float, target, post=None):
         self.target = target
+        self.post = post
         self.duration = duration/8
-        self.running = True
-        self.restart = False
-        self.stop = True
-
-        t = Thread( 
-			target=self.run, 
-			name='Heartbeat Thread'
-			)
-        t.start()
+        self.scheduler = shared_scheduler()
+        self.lock = Lock()
+        self.handle = None
+        self.generation = 0  # bumped on every restart/stop to spot stale firings
 
     def kill_thread(self):
-        self.running = False
+        self.stop_timer()
 
     def stop_timer(self):
-        self.stop = True
+        with self.lock:
+            self.generation += 1
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
 
     def restart_timer(self):
-        self.restart = True
-        self.stop = False
-
-    #def new_timeout(self) -> float:
-    #   return (self.duration + self.duration * random.random())
-
-    def run(self):
-        #start the timer
-        start = clock()
-        count = 0
-        while self.running:
-            while not self.stop:
-                count+=1
-                if self.restart:
-                    start = clock()
-                    self.restart = False
-
-                elapsed_time = clock() - start
-                if elapsed_time > self.duration:
-                    if self.target.election_state == 'leader':
-                        print('\nSending Heartbeat ........       \n')
-                        self.target.send_heartbeat()
-                    elif self.target.election_state == 'candidate':
-                        print('Re-requesting votes ........')
-                        self.target.request_votes()
-                    self.restart = True
-                    break
-                else:
-                    if count > 10000:  
-                        print('Heartbeat Timer: ', self.duration-elapsed_time)  
-                        count = 0
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = self.scheduler.schedule(self.duration, lambda: self.fire(generation))
+
+    def fire(self, generation: int):
+        if self.post is None:
+            self.elapsed(generation)
+        else:
+            self.post(self.elapsed, generation)
+
+    def elapsed(self, generation: int):
+        with self.lock:
+            if generation != self.generation:  # restarted or stopped meanwhile
+                return
+            self.handle = None
+        if self.target.election_state == 'leader':
+            print('\nSending Heartbeat ........       \n')
+            self.target.send_heartbeat()
+        elif self.target.election_state == 'candidate':
+            print('Re-requesting votes ........')
+            self.target.request_votes()
+        with self.lock:
+            superseded = generation != self.generation
+        if not superseded:
+            self.restart_timer()
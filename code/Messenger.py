@@ -1,50 +1,112 @@
-from time import sleep, clock
-from datetime import datetime
-from threading import Thread
-import boto3, botocore
-
-message_queue_URLs = {
-	'0': 'https://sqs.us-east-1.amazonaws.com/622058021374/0.fifo',
-	'1': 'https://sqs.us-east-1.amazonaws.com/622058021374/1.fifo',
-	'2': 'https://sqs.us-east-1.amazonaws.com/622058021374/2.fifo',
-	'3': 'https://sqs.us-east-1.amazonaws.com/622058021374/3.fifo',
-	'4': 'https://sqs.us-east-1.amazonaws.com/622058021374/4.fifo',
-	'leader': 'https://sqs.us-east-1.amazonaws.com/622058021374/leader.fifo',
-	'client-blue': 'https://sqs.us-east-1.amazonaws.com/622058021374/client-blue.fifo',
-	'client-red': 'https://sqs.us-east-1.amazonaws.com/622058021374/client-red.fifo'
-	}
+from threading import Thread, Event, Condition, Lock
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from Transport import make_transport
+from AsyncRuntime import use_asyncio, shared_loop, on_loop, call_soon, spawn
+import Codec, asyncio, traceback
+
+# seconds an outgoing message may wait for others to the same destination
+send_batch_window = 0.005
+# threads sending batches to different destinations at the same time
+send_workers = 4
+
+
+class FanoutStats:
+	'''Seconds from a message being queued until its batch was handed to the transport'''
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, latency: float):
+		self.count += 1
+		self.total += latency
+		self.max = max(self.max, latency)
+
+	def mean(self) -> float:
+		return self.total / self.count if self.count else 0.0
+
+	def __str__(self):
+		return f'{self.count} batches, mean {self.mean()*1000:.2f} ms, max {self.max*1000:.2f} ms'
+
 
 class Messenger:
 	"""
-	This class is a generic message handler for the RAFT system, using hardcoded
-	SQS queues to communicate with other nodes. The nodes accessible using this
-	class are  '0', '1', '2', '3', '4', 'leader', 'client-blue', and 'client-red'.
-	This class requires the handle_received_message(message) interface
+	This class is a generic message handler for the RAFT system. The nodes
+	accessible using this class are  '0', '1', '2', '3', '4', 'leader',
+	'client-blue', and 'client-red'. Messages travel over a pluggable
+	Transport (SQS queues, in-process queues or TCP sockets, see Transport.py).
+	This class requires the handle_received_message(message) interface;
+	a target may also implement handle_batch_end(), which is called once
+	every message of one receive has been handled, and wait_for_room(),
+	which is called before each receive and returns once the target can
+	take more messages (backpressure: the rest wait in the transport). With RAFT_RUNTIME=asyncio
+	(see AsyncRuntime.py) the receive loop and the sends are tasks on the
+	runtime's loop instead of threads, the target is called on the loop and
+	wait_for_room() returns a coroutine.
 
 	methods:
 		__init__(id, target) : constructor
 		start_incoming_message_thread() : starts a 'receive message' thread
 		listen_for_messages() : receive messages, pass to parent target
 
-		send(message: dict, destination: str) : <-must be formatted correctly for SQS
+		send(message: dict, destination: str, flush: bool) : <-encoded with Codec
+		flush(destination: str) : send anything queued for destination now
+		fanout : FanoutStats for every batch sent so far
 	"""
 
-	def __init__(self, id: str, target, run: bool=True):
+	def __init__(self, id: str, target, run: bool=True, transport: str=None,
+			batch_window: float=send_batch_window):
 		'''
 		Messenger constructor. Takes id from list
 		'0', '1', '2', '3', '4', 'leader', 'client-blue', 'client-red'.
 		Constructor must be passed a reference to the class that is using it.
 		That class must implement handle_incoming_message(message: dict)
+		transport names the backend ('sqs', 'local', 'tcp'); when omitted the
+		RAFT_TRANSPORT environment variable decides, defaulting to SQS.
+		Outgoing messages to the same destination are held for up to
+		batch_window seconds and sent together; 0 sends every message at once.
+		Batches for different destinations are sent by a pool of send_workers
+		threads (tasks on the asyncio runtime), so one slow send does not hold
+		up the other peers.
 		'''
 		self.id = id #id of self in system
-		self.run = run
-		self.sqs = boto3.client('sqs') # make a new SQS object
-		self.incoming_queue_URL = message_queue_URLs[self.id] # store URL of queue for self
+		self.transport = make_transport(self.id, transport)
 		self.target = target    # store class that is using this messenger
+		self.batch_end = getattr(target, 'handle_batch_end', None)
+		self.wait_for_room = getattr(target, 'wait_for_room', None)
+		self.running = Event()
+		self.asyncio = use_asyncio()
+		self.listener = None  # asyncio runtime: the receive task while on
+		self.listen_lock = asyncio.Lock()
+		if run:
+			self.on()
+
+		# destination -> (time first message was queued, [messages])
+		self.batch_window = batch_window
+		self.outbound = {}
+		self.outbound_ready = Condition()
+		self.destination_locks = {}
+		self.sending = set()  # destinations a pool thread is sending to
+		self.fanout = FanoutStats()
+		if self.asyncio:
+			self.sending = {}  # destination -> task sending its batches
+			self.urgent = set()  # destinations with a flush waiting
+		else:
+			if self.batch_window > 0:
+				self.senders = ThreadPoolExecutor(
+					max_workers=send_workers,
+					thread_name_prefix=('Sender Thread'+self.id)
+					)
+				Thread(
+					target=self.flush_outbound,
+					name=('Outgoing Message Thread'+self.id),
+					daemon=True
+					).start()
 
-		# start a thread to pull incoming messages from queue
-		self.incoming_message_thread = self.start_incoming_message_thread()
-		self.msg_count = 0
+			# start a thread to pull incoming messages from queue
+			self.incoming_message_thread = self.start_incoming_message_thread()
 
 
 	def start_incoming_message_thread(self):
@@ -57,90 +119,212 @@ class Messenger:
 		t.start()
 		return t
 
+	@property
+	def run(self) -> bool:
+		return self.running.is_set()
+
 	def off(self):
-		self.run = False
+		self.running.clear()
+		if self.asyncio:
+			call_soon(self.stop_listening)
+			return
+		self.transport.close()
 
 	def on(self):
-		self.run = True
+		if self.asyncio:
+			self.running.set()
+			call_soon(self.start_listening)
+			return
+		self.transport.open()
+		self.running.set()
+
+	def start_listening(self):
+		if self.listener is None:
+			self.listener = asyncio.ensure_future(self.listen_async())
+
+	def stop_listening(self):
+		if self.listener is not None:
+			self.listener.cancel()
+			self.listener = None
 
 	def listen_for_messages(self):
-		''' loop that pulls messages from given SQS queue
+		''' loop that pulls messages from the transport
 
-		messages attributes are kept in dictionary form and represent the
+		messages are kept in dictionary form and represent the
 		message intended to be received. Messages are then passed to the
 		target class via the target.handle_incoming_message(message) interface
 		'''
 		while True:
-			while self.run:
-				# response stores results of receive call from SQS
-				response = self.sqs.receive_message(
-					QueueUrl=self.incoming_queue_URL,
-					MaxNumberOfMessages=1,
-					MessageAttributeNames=['All'],
-					WaitTimeSeconds=0
-				)
-
-				# check if a message was received. if no message, try again
-				if 'Messages' not in response:
-					continue
-				else:
-					message = response['Messages'][0]['MessageAttributes']
-
-				# this receipt handle is required to delete the  message from queue
-				receipt_handle = response['Messages'][0]['ReceiptHandle']
-				# delete the message after receiving
-				try:
-					self.sqs.delete_message(
-						QueueUrl=self.incoming_queue_URL,
-						ReceiptHandle=receipt_handle
-					)
-				except botocore.exceptions.ClientError:
-					print("Receipt Handle Expired")
-				# print('\n',self.id,' Received and deleted message : \n\"{}\"'.format(message))
-
+			self.running.wait()
+			if self.wait_for_room is not None:
+				self.wait_for_room()
+			self.deliver(self.transport.receive())
+
+	async def listen_async(self):
+		'''listen_for_messages() as a task on the asyncio runtime, cancelled by off()'''
+		async with self.listen_lock:  # lets a cancelled listener close first
+			await self.transport.open_async()
+			try:
+				while True:
+					if self.wait_for_room is not None:
+						await self.wait_for_room()
+					self.deliver(await self.transport.receive_async())
+			finally:
+				await self.transport.close_async()
+
+	def deliver(self, messages: list):
+		for data in messages:
+			try:
+				message = Codec.decode(data)
+			except Exception as error:  # a peer on another wire version, or a damaged frame
+				print(f'Dropped a message that could not be decoded: {error!r}')
+				continue
+			try:
 				# this calls on the holding class to handle the messages,
+				self.target.handle_incoming_message(message)
+			except Exception:  # one bad message must not stop the receive loop
+				traceback.print_exc()
+		if messages and self.batch_end is not None:
+			self.batch_end()
 
-				msg = self.reduce_message(message)
-
-				self.target.handle_incoming_message(msg)
-
-
-	def reduce_message(self, SQSmessage:dict) -> dict:
-		msg = {}
-		for key, value in SQSmessage.items():
-			msg[key] = value['StringValue']
-		return msg
-
-	def format_for_SQS(self, message:dict) -> dict:
-		SQSmsg = {}
-		for key, value in message.items():
-			SQSmsg[key] = {
-				'DataType': 'String',
-				'StringValue': value
-				}
-		return SQSmsg
-
-	def send(self, message: dict, destination: str):
+	def send(self, message: dict, destination: str, flush: bool=False):
 		'''
-		send a message to the given destination queue.
+		send a message to the given destination.
 		destination string should exist in the queue_suffixes list.
+		The message is queued behind anything else waiting for the same
+		destination; flush=True sends the queue right away instead of waiting
+		out the batch window (used for latency-critical replies).
 		'''
-		# used to uniquely identify messages:
-		self.msg_count += 1
-		# included to ensure all messages have a different non-duplication hash:
-		timestamp = str(datetime.now())
-
-		message_body = 'Message # {} from {}. {}'.format(self.msg_count, self.id, timestamp)
-		#print("message from {} to {}: ".format(self.id, destination), message)
-		SQSmsg = self.format_for_SQS(message)
+		message = Codec.encode(message)
+		if self.asyncio:
+			if flush and not on_loop():  # like a threads runtime flush, return once sent
+				spawn(self.send_async(message, destination)).result()
+			else:
+				call_soon(self.enqueue, message, destination, flush)
+			return
+		if self.batch_window <= 0:
+			queued_at = monotonic()
+			self.transport.send(message, destination)
+			self.fanout.record(monotonic() - queued_at)
+			return
+		with self.outbound_ready:
+			if destination not in self.outbound:
+				self.outbound[destination] = (monotonic(), [])
+				self.outbound_ready.notify()
+			self.outbound[destination][1].append(message)
+		if flush:
+			self.flush(destination)
+
+	def destination_lock(self, destination: str) -> Lock:
+		with self.outbound_ready:
+			if destination not in self.destination_locks:
+				self.destination_locks[destination] = Lock()
+			return self.destination_locks[destination]
+
+	def flush(self, destination: str):
+		'''send everything queued for destination as one batch'''
+		if self.asyncio:
+			call_soon(self.enqueue, None, destination, True)
+			return
+		# held across the send so two flushes cannot reorder a destination
+		with self.destination_lock(destination):
+			with self.outbound_ready:
+				queued = self.outbound.pop(destination, None)
+			if queued:
+				try:
+					self.transport.send_batch(queued[1], destination)
+				except KeyError as error:  # not in the queue list or RAFT_ENDPOINTS
+					print(f'Unknown destination {error}, message dropped')
+				self.fanout.record(monotonic() - queued[0])
+
+	def send_queued(self, destination: str):
+		'''pool task: flush destination, then let the flusher schedule it again'''
+		try:
+			self.flush(destination)
+		except Exception:  # nothing reads the pool's futures, so report it here
+			traceback.print_exc()
+		finally:
+			with self.outbound_ready:
+				self.sending.discard(destination)
+				self.outbound_ready.notify()
+
+	def flush_outbound(self):
+		'''
+		loop that hands each destination to the sender pool once its batch
+		window has passed. A destination already being sent to waits for that
+		send to finish, which keeps its messages in order.
+		'''
+		while True:
+			with self.outbound_ready:
+				while True:
+					now = monotonic()
+					waiting = {
+						destination: first for destination, (first, _) in self.outbound.items()
+						if destination not in self.sending
+						}
+					due = [
+						destination for destination, first in waiting.items()
+						if now - first >= self.batch_window
+						]
+					if due:
+						self.sending.update(due)
+						break
+					if waiting:
+						oldest = min(waiting.values())
+						self.outbound_ready.wait(oldest + self.batch_window - now)
+					else:
+						self.outbound_ready.wait()
+			for destination in due:
+				self.senders.submit(self.send_queued, destination)
+
+	# asyncio runtime: the outbound queues are only touched on the loop
+
+	def enqueue(self, message: bytes, destination: str, flush: bool):
+		'''queue message (None queues nothing) and start its batch's window'''
+		if message is not None:
+			if destination not in self.outbound:
+				self.outbound[destination] = (monotonic(), [])
+				if self.batch_window > 0:
+					shared_loop().call_later(self.batch_window, self.start_sending, destination)
+			self.outbound[destination][1].append(message)
+		if flush or self.batch_window <= 0:
+			self.urgent.add(destination)
+			self.start_sending(destination)
+
+	def start_sending(self, destination: str):
+		if destination in self.outbound and destination not in self.sending:
+			self.sending[destination] = asyncio.ensure_future(self.send_queued_async(destination))
+
+	def due(self, destination: str) -> bool:
+		first, _ = self.outbound[destination]
+		return destination in self.urgent or monotonic() - first >= self.batch_window
+
+	async def send_queued_async(self, destination: str):
+		'''
+		send destination's batches one after another, which keeps them in
+		order; sends to other destinations run meanwhile
+		'''
+		try:
+			while destination in self.outbound:
+				if not self.due(destination):  # queued during the last send
+					first, _ = self.outbound[destination]
+					shared_loop().call_at(first + self.batch_window, self.start_sending, destination)
+					return
+				self.urgent.discard(destination)
+				first, messages = self.outbound.pop(destination)
+				try:
+					await self.transport.send_batch_async(messages, destination)
+				except KeyError as error:
+					print(f'Unknown destination {error}, message dropped')
+				except Exception:
+					traceback.print_exc()
+				self.fanout.record(monotonic() - first)
+		finally:
+			del self.sending[destination]
 
-		# response stores confirmation data from SQS
-		response = self.sqs.send_message(
-			QueueUrl=message_queue_URLs[destination],
-			MessageAttributes=SQSmsg,
-			MessageGroupId='queue',
-			MessageBody=message_body
-		)
+	async def send_async(self, message: bytes, destination: str):
+		self.enqueue(message, destination, True)
+		await asyncio.shield(self.sending[destination])
 
 
 if __name__ == '__main__':
@@ -152,17 +336,14 @@ if __name__ == '__main__':
 		}
 
 	print(message)
-	SQSmsg = {}
-	for key, value in message.items():
-		SQSmsg[key] = {
-			'DataType': 'String',
-			'StringValue': value
-			}
-
-	print(SQSmsg)
+	encoded = Codec.encode(message)
+	print(encoded)
+	print(Codec.decode(encoded))
 
 
 	'''
+	(the binary layout of each of these lives in Codec.schemas)
+
 	Append Entries message attributes:
 	{
 		'messageType' : 'AppendEntriesRPC',
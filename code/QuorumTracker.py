@@ -0,0 +1,28 @@
+class QuorumTracker:
+	'''
+	Tracks matchIndex for every follower and answers "what is the highest log
+	index stored on a majority of the cluster?" in one step, so a leader can
+	commit a whole burst of acknowledged entries at once instead of one per
+	reply.
+
+	:var .match_index: dict. peer id -> highest index known replicated there
+	'''
+
+	def __init__(self, peers: list):
+		self.match_index = dict.fromkeys(peers, 0)
+		self.cluster_size = len(peers) + 1  # followers plus the leader
+
+	def update(self, peer: str, index: int):
+		'''record an acknowledgement; matchIndex never moves backwards'''
+		if index > self.match_index[peer]:
+			self.match_index[peer] = index
+
+	def majority_index(self, leader_index: int) -> int:
+		'''
+		Highest N such that a majority of servers (counting the leader, whose
+		own log reaches leader_index) have replicated entry N.
+		'''
+		indices = list(self.match_index.values())
+		indices.append(leader_index)
+		indices.sort(reverse=True)
+		return indices[self.cluster_size // 2]
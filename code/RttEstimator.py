@@ -0,0 +1,30 @@
+class RttEstimator:
+	'''
+	Smoothed round-trip time to one peer, estimated the way TCP does it
+	(RFC 6298): an exponentially weighted mean and mean deviation of the
+	samples. rto() is a round-trip time the peer should almost always beat.
+
+	methods:
+		record(rtt) : add a sample, in seconds
+		rto() -> float : srtt + 4 * rttvar, 0.0 before the first sample
+	'''
+
+	alpha = 1/8  # weight of a new sample in srtt
+	beta = 1/4  # weight of a new sample in rttvar
+
+	def __init__(self):
+		self.samples = 0
+		self.srtt = 0.0
+		self.rttvar = 0.0
+
+	def record(self, rtt: float):
+		if self.samples == 0:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+			self.srtt += self.alpha * (rtt - self.srtt)
+		self.samples += 1
+
+	def rto(self) -> float:
+		return self.srtt + 4 * self.rttvar
@@ -0,0 +1,154 @@
+import unittest, threading, time, os
+from TimerScheduler import AsyncioScheduler
+from EventLoop import AsyncEventLoop
+from Messenger import Messenger
+import AsyncRuntime, Transport
+
+
+class Collector:
+    def __init__(self):
+        self.received = []
+        self.threads = set()
+
+    def handle_incoming_message(self, msg: dict):
+        self.received.append(msg)
+        self.threads.add(threading.get_ident())
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestAsyncioScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.scheduler = AsyncioScheduler()
+        self.fired = []
+
+    def test_fires_in_deadline_order_on_the_loop(self):
+        self.scheduler.schedule(0.06, lambda: self.fired.append(('late', threading.current_thread())))
+        self.scheduler.schedule(0.02, lambda: self.fired.append(('early', threading.current_thread())))
+        time.sleep(0.15)
+        self.assertEqual([name for name, _ in self.fired], ['early', 'late'])
+        self.assertEqual({thread for _, thread in self.fired}, {AsyncRuntime.loop_thread})
+        self.assertEqual(self.scheduler.jitter.count, 2)
+
+    def test_cancelled_timer_does_not_fire(self):
+        handle = self.scheduler.schedule(0.02, lambda: self.fired.append('x'))
+        handle.cancel()
+        time.sleep(0.06)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.scheduler.cancelled_count, 0)
+
+
+class TestAsyncEventLoop(unittest.TestCase):
+    def test_runs_events_in_order(self):
+        loop = AsyncEventLoop('test loop')
+        done = threading.Event()
+        seen = []
+        for number in range(20):
+            loop.post(seen.append, number)
+        loop.post(lambda: 1 / 0, kind='broken')
+        loop.post(done.set)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(seen, list(range(20)))
+        self.assertEqual(loop.stats.count, 22)
+
+    def test_consensus_lane_first_and_full_lane_waits(self):
+        loop = AsyncEventLoop('test loop')
+        loop.mailbox.lanes['client'].capacity = 2
+        seen = []
+        async def post_and_wait():
+            # posted from the loop, so nothing runs before the waiting starts
+            loop.post(seen.append, 'client 0', lane='client')
+            loop.post(seen.append, 'client 1', lane='client')
+            loop.post(seen.append, 'vote')
+            await loop.wait_for_room('client')
+            return list(seen)
+        seen_when_room = AsyncRuntime.spawn(post_and_wait()).result(1)
+        self.assertEqual(seen_when_room, ['vote', 'client 0'])
+        self.assertEqual(loop.mailbox.lanes['client'].full_count, 1)
+
+
+class TestAsyncMessenger(unittest.TestCase):
+    count = 0
+
+    def setUp(self) -> None:
+        self.runtime = os.environ.get('RAFT_RUNTIME')
+        os.environ['RAFT_RUNTIME'] = 'asyncio'
+        # local queues outlive a test, so give every test its own endpoint
+        TestAsyncMessenger.count += 1
+        self.endpoint = f'async-{self.count}'
+        self.target = Collector()
+
+    def tearDown(self) -> None:
+        if self.runtime is None:
+            del os.environ['RAFT_RUNTIME']
+        else:
+            os.environ['RAFT_RUNTIME'] = self.runtime
+
+    def test_local_messages_arrive_in_order_on_the_loop(self):
+        receiver = Messenger(self.endpoint, self.target, transport='local')
+        sender = Messenger('4', Collector(), run=False, transport='local')
+        for i in range(20):
+            sender.send({'n': str(i)}, self.endpoint)
+        wait_for(lambda: len(self.target.received) == 20)
+        receiver.off()
+        self.assertEqual([m['n'] for m in self.target.received], [str(i) for i in range(20)])
+        self.assertEqual(self.target.threads, {AsyncRuntime.loop_thread.ident})
+        self.assertFalse(hasattr(receiver, 'incoming_message_thread'))
+
+    def test_off_stops_delivery(self):
+        receiver = Messenger(self.endpoint, self.target, run=False, transport='local')
+        sender = Messenger('4', Collector(), run=False, transport='local')
+        sender.send({'n': '0'}, self.endpoint, flush=True)
+        time.sleep(0.1)
+        self.assertEqual(self.target.received, [])
+        receiver.on()
+        wait_for(lambda: len(self.target.received) == 1)
+        receiver.off()
+        self.assertEqual(len(self.target.received), 1)
+
+    def test_window_coalesces_and_flush_returns_once_sent(self):
+        receiver = Messenger(self.endpoint, self.target, transport='local')
+        sender = Messenger('4', Collector(), run=False, transport='local', batch_window=0.05)
+        for i in range(4):
+            sender.send({'n': str(i)}, self.endpoint)
+        sender.send({'n': '4'}, self.endpoint, flush=True)
+        self.assertEqual(sender.fanout.count, 1)
+        wait_for(lambda: len(self.target.received) == 5)
+        receiver.off()
+        self.assertEqual([m['n'] for m in self.target.received], [str(i) for i in range(5)])
+
+    def test_tcp_messages_arrive_in_order(self):
+        Transport.tcp_addresses['client-blue'] = ('127.0.0.1', 0)
+        receiver = Messenger('client-blue', self.target, transport='tcp')
+        wait_for(lambda: receiver.transport.server is not None)
+        # port 0 asked the OS for a free port, point senders at it
+        Transport.tcp_addresses['client-blue'] = receiver.transport.server.sockets[0].getsockname()
+        # kept, like a node's messenger, so its connection is not collected mid-test
+        self.sender = Messenger('leader', Collector(), run=False, transport='tcp')
+        for i in range(20):
+            self.sender.send({'msg': str(i)}, 'client-blue')
+        wait_for(lambda: len(self.target.received) == 20)
+        receiver.off()
+        self.assertEqual([m['msg'] for m in self.target.received], [str(i) for i in range(20)])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestAsyncioScheduler('test_fires_in_deadline_order_on_the_loop'))
+    suite.addTest(TestAsyncioScheduler('test_cancelled_timer_does_not_fire'))
+    suite.addTest(TestAsyncEventLoop('test_runs_events_in_order'))
+    suite.addTest(TestAsyncEventLoop('test_consensus_lane_first_and_full_lane_waits'))
+    suite.addTest(TestAsyncMessenger('test_local_messages_arrive_in_order_on_the_loop'))
+    suite.addTest(TestAsyncMessenger('test_off_stops_delivery'))
+    suite.addTest(TestAsyncMessenger('test_window_coalesces_and_flush_returns_once_sent'))
+    suite.addTest(TestAsyncMessenger('test_tcp_messages_arrive_in_order'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,69 @@
+import unittest
+import Codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_append_entries_round_trip(self):
+        message = {
+            'messageType': 'AppendEntriesRPC',
+            'group': 3,
+            'leaderID': '2',
+            'term': 7,
+            'entries': "7\t{'_id': 'client-red', 'state': 'punch_left'}",
+            'prevLogIndex': 41,
+            'prevLogTerm': 6,
+            'prevLogCommand': 'null',
+            'leaderCommit': 40,
+            'nextIndex': 42, 'sentAt': 123456789, 'heartbeatInterval': 500
+        }
+        self.assertEqual(Codec.decode(Codec.encode(message)), message)
+
+    def test_long_entries_are_compressed(self):
+        entries = ';'.join(["4\t{'_id': 'client-red', 'state': 'punch_left'}"] * 100)
+        message = {
+            'messageType': 'AppendEntriesRPC', 'group': 0, 'leaderID': '0', 'term': 4, 'entries': entries,
+            'prevLogIndex': 0, 'prevLogTerm': 0, 'prevLogCommand': 'null', 'leaderCommit': 0, 'nextIndex': 1,
+            'sentAt': 0, 'heartbeatInterval': 500
+        }
+        data = Codec.encode(message)
+        self.assertLess(len(data), len(entries) // 4)
+        self.assertEqual(Codec.decode(data)['entries'], entries)
+
+    def test_reply_fields_are_typed(self):
+        reply = {'messageType': 'AppendReply', 'group': 0, 'senderID': '1', 'term': 3, 'match': 12, 'success': False,
+                 'conflictTerm': 2, 'conflictIndex': 7, 'sentAt': 0}
+        decoded = Codec.decode(Codec.encode(reply))
+        self.assertIs(decoded['success'], False)
+        self.assertEqual(decoded['match'], 12)
+        self.assertEqual(decoded['conflictTerm'], 2)
+        self.assertEqual(decoded['conflictIndex'], 7)
+
+    def test_returned_commands_round_trip(self):
+        message = {'messageType': 'ReturnedCommands', 'group': 2, 'term': 5, 'commands': '1042;0317@5'}
+        self.assertEqual(Codec.decode(Codec.encode(message)), message)
+
+    def test_generic_message_round_trip(self):
+        message = {'_id': 'client-blue', 'state': 'block_right'}
+        self.assertEqual(Codec.decode(Codec.encode(message)), message)
+
+    def test_rejects_other_versions(self):
+        data = bytearray(Codec.encode({'msg': 'won'}))
+        data[0] = Codec.WIRE_VERSION + 1
+        with self.assertRaises(ValueError):
+            Codec.decode(bytes(data))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestCodec('test_append_entries_round_trip'))
+    suite.addTest(TestCodec('test_long_entries_are_compressed'))
+    suite.addTest(TestCodec('test_reply_fields_are_typed'))
+    suite.addTest(TestCodec('test_returned_commands_round_trip'))
+    suite.addTest(TestCodec('test_generic_message_round_trip'))
+    suite.addTest(TestCodec('test_rejects_other_versions'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
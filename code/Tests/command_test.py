@@ -0,0 +1,49 @@
+import unittest
+from Command import Command, group_of, leader_endpoint
+
+
+class TestCommand(unittest.TestCase):
+    def test_round_trip(self):
+        command = Command('client-red', 'punch_left', 42)
+        self.assertEqual(command.encode(), '1042')
+        self.assertEqual(Command.decode(command.encode()), command)
+
+    def test_match_id_round_trip(self):
+        command = Command('client-blue', 'exit', 3, match=1207)
+        self.assertEqual(command.encode(), '043@1207')
+        self.assertEqual(Command.decode(command.encode()), command)
+
+    def test_matches_spread_over_groups(self):
+        self.assertEqual(sorted(group_of(match, 4) for match in range(8)), [0, 0, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(leader_endpoint(group_of(5, 1)), 'leader')
+        self.assertEqual(leader_endpoint(group_of(5, 4)), 'leader-1')
+
+    def test_encoding_fits_log_records(self):
+        text = Command('client-blue', 'block_right', 7).encode()
+        for separator in ('\t', '\n', ';'):
+            self.assertNotIn(separator, text)
+
+    def test_reads_old_dict_commands(self):
+        command = Command.decode("{'_id': 'client-blue', 'state': 'exit'}")
+        self.assertEqual((command.client, command.action), ('client-blue', 'exit'))
+
+    def test_describe_leaves_placeholders(self):
+        self.assertEqual(Command.describe('null'), 'null')
+        self.assertEqual(Command.describe('snapshot'), 'snapshot')
+        self.assertEqual(Command.describe('032'), 'client-blue block_right #2')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestCommand('test_round_trip'))
+    suite.addTest(TestCommand('test_match_id_round_trip'))
+    suite.addTest(TestCommand('test_matches_spread_over_groups'))
+    suite.addTest(TestCommand('test_encoding_fits_log_records'))
+    suite.addTest(TestCommand('test_reads_old_dict_commands'))
+    suite.addTest(TestCommand('test_describe_leaves_placeholders'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,705 @@
+import unittest, threading, glob, json, os
+from time import monotonic
+from ConsensusModule import ConsensusModule, LogEntry
+from Command import Command
+
+
+class Outbox:
+    """stands in for the node's Messenger and keeps everything sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message: dict, destination: str, flush: bool = False):
+        self.sent.append((destination, message))
+
+    def to(self, peer: str, message_type: str) -> list:
+        return [m for d, m in self.sent if d == peer and m['messageType'] == message_type]
+
+
+class StubNode:
+    def __init__(self):
+        self.messenger = Outbox()
+
+
+class StubServer:
+    def __init__(self):
+        self.returned = []
+        self.restored = []
+
+    def turn_on_leader_queue(self):
+        pass
+
+    def turn_off_leader_queue(self):
+        pass
+
+    def return_client_command(self, command: str):
+        self.returned.append(command)
+
+    def release_returned_commands(self):
+        pass
+
+    def take_returned_commands(self) -> list:
+        returned, self.returned = self.returned, []
+        return returned
+
+    def restore_snapshot(self, snapshot: dict):
+        self.restored.append(snapshot)
+
+
+def append_entries(term: int, leader: str, prev_index: int, prev_term: int,
+        entries: list = (), leader_commit: int = 0) -> dict:
+    return {
+        'messageType': 'AppendEntriesRPC', 'group': 0, 'term': term, 'leaderID': leader,
+        'prevLogIndex': prev_index, 'prevLogTerm': prev_term, 'prevLogCommand': '',
+        'entries': ';'.join(entry.serialized for entry in entries),
+        'leaderCommit': leader_commit, 'nextIndex': prev_index + 1,
+        'sentAt': 0, 'heartbeatInterval': 50
+    }
+
+
+def vote_request(term: int, candidate: str, last_index: int, last_term: int,
+        pre_vote: bool = False) -> dict:
+    return {
+        'messageType': 'RequestVotesRPC', 'group': 0, 'term': term, 'candidateID': candidate,
+        'preVote': pre_vote, 'lastLogIndex': last_index, 'lastLogTerm': last_term
+    }
+
+
+def vote_reply(term: int, sender: str, granted: bool, pre_vote: bool = False,
+        last_index: int = 0, last_term: int = 0) -> dict:
+    return {
+        'messageType': 'VoteReply', 'group': 0, 'senderID': sender, 'term': term,
+        'voteGranted': granted, 'preVote': pre_vote, 'lastLogIndex': last_index,
+        'lastLogTerm': last_term
+    }
+
+
+def append_reply(term: int, sender: str, success: bool, match: int,
+        conflict_term: int = -1, conflict_index: int = 0) -> dict:
+    return {
+        'messageType': 'AppendReply', 'group': 0, 'senderID': sender, 'term': term,
+        'match': match, 'success': success, 'conflictTerm': conflict_term,
+        'conflictIndex': conflict_index, 'sentAt': 0
+    }
+
+
+def install_snapshot(term: int, leader: str, last_index: int, last_term: int) -> dict:
+    snapshot = {'lastIncludedIndex': last_index, 'lastIncludedTerm': last_term,
+        'state': {'matches': {}, 'lastApplied': last_index}}
+    return {
+        'messageType': 'InstallSnapshotRPC', 'group': 0, 'term': term, 'leaderID': leader,
+        'lastIncludedIndex': last_index, 'lastIncludedTerm': last_term,
+        'data': json.dumps(snapshot)
+    }
+
+
+def command(seq: int) -> str:
+    return Command('client-red', 'block_left', seq).encode()
+
+
+class ConsensusTestCase(unittest.TestCase):
+    """
+    Node '0' of a five node group with its timers stopped and its sends
+    collected, so a test drives it by calling its handlers directly.
+    """
+    group = 900
+
+    def setUp(self) -> None:
+        # each test gets its own group, so its own log and snapshot files
+        ConsensusTestCase.group += 1
+        self.remove_files()
+        self.node = StubNode()
+        self.cm = ConsensusModule('0', 5, StubServer(), group=self.group, node=self.node)
+        self.cm.election_timer.stop_timer()
+        self.cm.replication_pending = True  # tests call replicate() themselves
+
+    def tearDown(self) -> None:
+        self.cm.election_timer.stop_timer()
+        self.cm.heartbeat.stop_timer()
+        self.cm.end_transfer()
+        self.cm.log.logfile.close()
+        self.cm.log.indexfile.close()
+        self.remove_files()
+
+    def remove_files(self):
+        for path in glob.glob(f'../files/*0-{self.group}.*'):
+            os.remove(path)
+
+    def fill_log(self, *terms):
+        """append one entry per term given, after the placeholder at index 0"""
+        for term in terms:
+            self.cm.log.append_to_end(LogEntry(term, command(len(self.cm.log))))
+
+    def last_reply(self) -> dict:
+        """the AppendEntries reply waiting for the end of the receive batch"""
+        return self.cm.pending_replies[-1][0]
+
+    def make_leader(self, term: int):
+        self.cm.term = term
+        self.cm.set_leader()
+        self.cm.heartbeat.stop_timer()
+        self.node.messenger.sent.clear()
+
+    def run_on_loop(self, *events):
+        """post (callback, args, lane) events behind a held loop, then let them all run"""
+        release, done = threading.Event(), threading.Event()
+        self.cm.loop.post(release.wait, 1)
+        for callback, args, lane in events:
+            self.cm.loop.post(callback, *args, lane=lane)
+        self.cm.loop.post(done.set, lane='client')  # the client lane runs last
+        release.set()
+        self.assertTrue(done.wait(1))
+
+
+class TestClientCommands(ConsensusTestCase):
+    def test_leader_logs_commands_of_its_term(self):
+        self.make_leader(1)
+        self.run_on_loop((self.cm.add_client_command_to_log, (command(1), 1), 'client'))
+        self.assertEqual(len(self.cm.log), 2)
+        self.assertEqual(self.cm.log.get_entry(1).term, 1)
+
+    def test_command_queued_behind_a_new_leader_goes_back(self):
+        self.make_leader(1)
+        # posted first, but the new leader's AppendEntries runs before it
+        self.run_on_loop(
+            (self.cm.add_client_command_to_log, (command(1), 1), 'client'),
+            (self.cm.receive_message, (append_entries(2, '1', 0, 0),), 'consensus'))
+        self.assertEqual(self.cm.election_state, 'follower')
+        self.assertEqual(len(self.cm.log), 1)
+        self.assertEqual(self.cm.server.returned, [command(1)])
+        # so the new leader's entry is the one that commits at index 1
+        self.cm.receive_message(append_entries(2, '1', 0, 0, [LogEntry(2, command(5))], leader_commit=1))
+        self.assertEqual(self.cm.log.get_entry(1).command, command(5))
+        self.assertEqual(self.cm.commitIndex, 1)
+
+    def test_no_commands_during_a_leadership_transfer(self):
+        self.make_leader(1)
+        self.cm.transfer_target = '1'
+        self.cm.add_client_command_to_log(command(1), 1)
+        self.assertEqual(len(self.cm.log), 1)
+        self.assertEqual(self.cm.server.returned, [command(1)])
+
+
+class TestConflictHints(ConsensusTestCase):
+    def test_missing_entry_hints_our_log_length(self):
+        self.fill_log(1, 1)
+        self.cm.receive_message(append_entries(1, '1', 5, 1))
+        reply = self.last_reply()
+        self.assertFalse(reply['success'])
+        self.assertEqual((reply['conflictTerm'], reply['conflictIndex']), (-1, 3))
+
+    def test_conflicting_term_hints_its_first_index(self):
+        self.fill_log(1, 2, 2, 2)
+        self.cm.receive_message(append_entries(3, '1', 4, 3))
+        reply = self.last_reply()
+        self.assertFalse(reply['success'])
+        self.assertEqual((reply['conflictTerm'], reply['conflictIndex']), (2, 2))
+        self.assertEqual(len(self.cm.log), 5)  # nothing is cut on a rejection
+
+    def test_leader_resumes_after_its_last_entry_of_the_conflicting_term(self):
+        self.fill_log(1, 1, 3, 3)
+        self.assertEqual(self.cm.backtrack_index(1, 1), 3)
+
+    def test_leader_without_the_conflicting_term_skips_the_whole_run(self):
+        self.fill_log(1, 1, 3, 3)
+        self.assertEqual(self.cm.backtrack_index(2, 3), 3)
+
+    def test_backtrack_stays_inside_the_log(self):
+        self.fill_log(1, 1)
+        self.assertEqual(self.cm.backtrack_index(-1, 9), 3)
+        self.assertEqual(self.cm.backtrack_index(-1, 0), 1)
+
+    def test_one_round_trip_per_term(self):
+        # follower: 0 | 1 1 2 2 2, leader: 0 | 1 1 3 3 3 3
+        self.fill_log(1, 1, 2, 2, 2)
+        self.cm.receive_message(append_entries(3, '1', 6, 3))
+        hint = self.last_reply()
+        self.assertEqual((hint['conflictTerm'], hint['conflictIndex']), (-1, 6))
+        self.cm.receive_message(append_entries(3, '1', 5, 3))
+        hint = self.last_reply()
+        self.assertEqual((hint['conflictTerm'], hint['conflictIndex']), (2, 3))
+        # the leader holds no term 2, so it resumes at index 3 and the next
+        # request replaces the whole run
+        self.cm.receive_message(append_entries(3, '1', 2, 1, [LogEntry(3, command(i)) for i in range(4)]))
+        self.assertTrue(self.last_reply()['success'])
+        self.assertEqual([self.cm.log.get_entry(i).term for i in range(len(self.cm.log))], [0, 1, 1, 3, 3, 3, 3])
+
+    def test_stale_leader_is_refused_without_touching_the_log(self):
+        self.fill_log(1, 1, 3)
+        self.cm.term = 3
+        duration = self.cm.election_timer.duration
+        # a leader deposed in term 2 would overwrite index 3
+        self.cm.receive_message(append_entries(2, '1', 2, 1, [LogEntry(2, command(9))], leader_commit=3))
+        reply = self.last_reply()
+        self.assertFalse(reply['success'])
+        self.assertEqual(reply['term'], 3)  # makes the old leader step down
+        self.assertEqual([self.cm.log.get_entry(i).term for i in range(len(self.cm.log))], [0, 1, 1, 3])
+        self.assertEqual(self.cm.commitIndex, 0)
+        self.assertEqual(self.cm.election_timer.duration, duration)
+
+
+class TestPipelining(ConsensusTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.fill_log(*[1] * 10)
+        self.make_leader(1)
+        self.cm.max_append_entries = 2
+        self.cm.max_inflight = 3
+
+    def sent_ranges(self, peer: str) -> list:
+        """(prevLogIndex, entry count) of each AppendEntries sent to peer"""
+        return [(m['prevLogIndex'], len(m['entries'].split(';')) if m['entries'] else 0)
+            for m in self.node.messenger.to(peer, 'AppendEntriesRPC')]
+
+    def stream_to(self, peer: str, next_index: int):
+        """as if an earlier probe had found peer's log to end at next_index - 1"""
+        self.cm.probing[peer] = False
+        self.cm.nextIndex[peer] = next_index
+        self.cm.pump(peer)
+
+    def test_pump_fills_the_window(self):
+        self.stream_to('1', 1)
+        self.assertEqual(self.sent_ranges('1'), [(0, 2), (2, 2), (4, 2)])
+        self.assertEqual(list(self.cm.inflight['1']), [2, 4, 6])
+        self.assertEqual(self.cm.nextIndex['1'], 7)
+
+    def test_probe_sends_one_request_at_a_time(self):
+        self.cm.nextIndex['1'] = 1
+        self.cm.pump('1')
+        self.cm.pump('1')
+        self.assertEqual(self.sent_ranges('1'), [(0, 2)])
+        self.assertEqual(self.cm.nextIndex['1'], 1)  # only a reply moves a probe on
+
+    def test_acknowledgement_slides_the_window(self):
+        self.stream_to('1', 1)
+        self.node.messenger.sent.clear()
+        self.cm.receive_message(append_reply(1, '1', True, 2))
+        self.assertEqual(list(self.cm.inflight['1']), [4, 6, 8])
+        self.assertEqual(self.sent_ranges('1'), [(6, 2)])
+
+    def test_successful_probe_starts_streaming(self):
+        self.cm.nextIndex['1'] = 1
+        self.cm.pump('1')
+        self.node.messenger.sent.clear()
+        self.cm.receive_message(append_reply(1, '1', True, 2))
+        self.assertFalse(self.cm.probing['1'])
+        self.assertEqual(self.sent_ranges('1'), [(2, 2), (4, 2), (6, 2)])
+
+    def test_rejected_window_rewinds_to_a_single_probe(self):
+        self.stream_to('1', 5)
+        self.assertEqual(list(self.cm.inflight['1']), [6, 8, 10])
+        self.node.messenger.sent.clear()
+        # the follower only holds up to index 2, so all three requests fail alike
+        for _ in range(3):
+            self.cm.receive_message(append_reply(1, '1', False, 0, conflict_index=3))
+        self.assertTrue(self.cm.probing['1'])
+        self.assertEqual(self.sent_ranges('1'), [(2, 2)])
+        self.assertEqual(list(self.cm.inflight['1']), [4])
+        self.cm.receive_message(append_reply(1, '1', True, 4))
+        self.assertEqual(self.sent_ranges('1'), [(2, 2), (4, 2), (6, 2), (8, 2)])
+
+    def test_new_hint_while_probing_probes_again(self):
+        self.stream_to('1', 5)
+        self.cm.receive_message(append_reply(1, '1', False, 0, conflict_index=3))
+        self.node.messenger.sent.clear()
+        # the probe itself fails further back
+        self.cm.receive_message(append_reply(1, '1', False, 0, conflict_index=1))
+        self.assertEqual(self.sent_ranges('1'), [(0, 2)])
+        self.assertEqual(self.cm.nextIndex['1'], 1)
+
+    def test_commit_follows_the_majority(self):
+        for peer in ('1', '2'):
+            self.stream_to(peer, 1)
+        self.cm.receive_message(append_reply(1, '1', True, 4))
+        self.assertEqual(self.cm.commitIndex, 0)
+        self.cm.receive_message(append_reply(1, '2', True, 6))
+        self.assertEqual(self.cm.commitIndex, 4)
+
+
+class TestPreVote(ConsensusTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.fill_log(1, 1)
+        self.cm.term = 1
+
+    def answer_to(self, candidate: str) -> dict:
+        return self.node.messenger.to(candidate, 'VoteReply')[-1]
+
+    def test_granted_without_changing_anything(self):
+        self.cm.receive_message(vote_request(2, '1', 2, 1, pre_vote=True))
+        answer = self.answer_to('1')
+        self.assertTrue(answer['voteGranted'])
+        self.assertTrue(answer['preVote'])
+        self.assertEqual(answer['term'], 2)
+        self.assertEqual((self.cm.term, self.cm.voted_for), (1, 'null'))
+
+    def test_refused_while_a_leader_is_heard(self):
+        self.cm.leader_contact = monotonic()
+        self.cm.receive_message(vote_request(2, '1', 2, 1, pre_vote=True))
+        answer = self.answer_to('1')
+        self.assertFalse(answer['voteGranted'])
+        self.assertEqual(answer['term'], 1)
+
+    def test_refused_by_the_leader(self):
+        self.make_leader(1)
+        self.cm.receive_message(vote_request(2, '1', 2, 1, pre_vote=True))
+        self.assertFalse(self.answer_to('1')['voteGranted'])
+        self.assertEqual(self.cm.election_state, 'leader')
+
+    def test_refused_for_a_stale_log(self):
+        self.cm.receive_message(vote_request(2, '1', 1, 1, pre_vote=True))
+        self.assertFalse(self.answer_to('1')['voteGranted'])
+
+    def test_refused_for_a_term_not_ahead_of_ours(self):
+        self.cm.receive_message(vote_request(1, '1', 2, 1, pre_vote=True))
+        self.assertFalse(self.answer_to('1')['voteGranted'])
+
+    def test_majority_of_pre_votes_starts_the_election(self):
+        self.cm.start_pre_vote()
+        self.assertEqual(len(self.node.messenger.to('1', 'RequestVotesRPC')), 1)
+        self.assertEqual(self.cm.term, 1)
+        self.cm.receive_message(vote_reply(2, '1', True, pre_vote=True))
+        self.assertEqual(self.cm.election_state, 'follower')
+        self.cm.receive_message(vote_reply(2, '2', True, pre_vote=True))
+        self.assertEqual((self.cm.election_state, self.cm.term), ('candidate', 2))
+
+    def test_refusal_from_a_later_term_ends_the_pre_vote(self):
+        self.cm.start_pre_vote()
+        self.cm.receive_message(vote_reply(3, '1', False, pre_vote=True))
+        self.assertEqual(self.cm.term, 3)
+        self.assertFalse(self.cm.pre_voting)
+        self.cm.receive_message(vote_reply(4, '2', True, pre_vote=True))
+        self.cm.receive_message(vote_reply(4, '3', True, pre_vote=True))
+        self.assertEqual(self.cm.election_state, 'follower')
+
+
+class TestVoting(ConsensusTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.fill_log(1, 1, 2)  # last entry: index 3, term 2
+        self.cm.term = 2
+
+    def answer_to(self, candidate: str) -> dict:
+        return self.node.messenger.to(candidate, 'VoteReply')[-1]
+
+    def test_later_last_term_wins_even_if_shorter(self):
+        self.assertTrue(self.cm.log_up_to_date(1, 3))
+        self.assertFalse(self.cm.log_up_to_date(9, 1))
+
+    def test_equal_last_terms_compare_length(self):
+        self.assertTrue(self.cm.log_up_to_date(3, 2))
+        self.assertTrue(self.cm.log_up_to_date(4, 2))
+        self.assertFalse(self.cm.log_up_to_date(2, 2))
+
+    def test_candidate_with_a_stale_log_is_refused(self):
+        # a longer log does not help when its last term is older
+        self.cm.receive_message(vote_request(3, '1', 5, 1))
+        self.assertFalse(self.answer_to('1')['voteGranted'])
+        self.assertEqual((self.cm.term, self.cm.voted_for), (3, 'null'))
+
+    def test_up_to_date_candidate_gets_the_only_vote(self):
+        self.cm.receive_message(vote_request(3, '1', 3, 2))
+        self.assertTrue(self.answer_to('1')['voteGranted'])
+        self.cm.receive_message(vote_request(3, '2', 4, 2))
+        self.assertFalse(self.answer_to('2')['voteGranted'])
+        self.assertEqual(self.cm.voted_for, '1')
+
+    def test_win_over_a_newer_log_is_counted(self):
+        self.cm.start_election()
+        self.cm.receive_message(vote_reply(3, '1', True, last_index=3, last_term=2))
+        self.cm.receive_message(vote_reply(3, '2', True, last_index=5, last_term=2))
+        self.assertEqual(self.cm.election_state, 'leader')
+        self.assertEqual((self.cm.elections_won, self.cm.stale_wins), (1, 1))
+
+
+class TestLeadershipTransfer(ConsensusTestCase):
+    def timeout_now(self, term: int) -> dict:
+        return {'messageType': 'TimeoutNowRPC', 'group': 0, 'leaderID': '1', 'term': term}
+
+    def test_timeout_now_starts_a_real_election_at_once(self):
+        self.cm.term = 1
+        self.cm.receive_message(self.timeout_now(1))
+        self.assertEqual((self.cm.election_state, self.cm.term), ('candidate', 2))
+        request = self.node.messenger.to('1', 'RequestVotesRPC')[-1]
+        self.assertFalse(request['preVote'])  # pre-vote would be refused, the leader is alive
+
+    def test_stale_timeout_now_is_ignored(self):
+        self.cm.term = 2
+        self.cm.receive_message(self.timeout_now(1))
+        self.assertEqual((self.cm.election_state, self.cm.term), ('follower', 2))
+
+    def test_timeout_now_waits_for_the_target_to_catch_up(self):
+        self.fill_log(1, 1)
+        self.make_leader(1)
+        self.cm.transfer_leadership('1')
+        self.assertEqual(self.cm.transfer_target, '1')
+        self.assertEqual(self.node.messenger.to('1', 'TimeoutNowRPC'), [])
+        self.cm.receive_message(append_reply(1, '1', True, 1))
+        self.assertEqual(self.node.messenger.to('1', 'TimeoutNowRPC'), [])
+        self.cm.receive_message(append_reply(1, '1', True, 2))
+        self.assertEqual(len(self.node.messenger.to('1', 'TimeoutNowRPC')), 1)
+
+    def test_default_target_is_the_most_up_to_date_follower(self):
+        self.fill_log(1, 1)
+        self.make_leader(1)
+        for peer, match in (('1', 0), ('2', 2), ('3', 1)):
+            self.cm.quorum.update(peer, match)
+        self.cm.transfer_leadership()
+        self.assertEqual(self.cm.transfer_target, '2')
+        self.assertEqual(len(self.node.messenger.to('2', 'TimeoutNowRPC')), 1)
+
+    def test_transfer_that_times_out_resumes_leading(self):
+        self.make_leader(1)
+        self.cm.transfer_leadership('1')
+        self.cm.abort_transfer()
+        self.assertEqual((self.cm.election_state, self.cm.transfer_target), ('leader', None))
+        self.cm.add_client_command_to_log(command(1), 1)
+        self.assertEqual(len(self.cm.log), 2)
+
+    def test_new_leader_ends_the_transfer(self):
+        self.make_leader(1)
+        self.cm.transfer_leadership('1')
+        self.cm.receive_message(append_entries(2, '1', 0, 0))
+        self.assertEqual((self.cm.election_state, self.cm.transfer_target), ('follower', None))
+
+
+class TestCheckQuorum(ConsensusTestCase):
+    def test_leader_cut_off_from_the_majority_steps_down(self):
+        self.make_leader(1)
+        long_ago = monotonic() - 2 * self.cm.election_timer.duration
+        for peer in self.cm.peers:
+            self.cm.last_heard[peer] = long_ago
+        self.cm.last_heard['1'] = monotonic()
+        self.cm.send_heartbeat()
+        self.assertEqual((self.cm.election_state, self.cm.term), ('follower', 1))
+        self.assertEqual(self.node.messenger.to('2', 'AppendEntriesRPC'), [])
+
+    def test_leader_hearing_from_a_majority_stays(self):
+        self.make_leader(1)
+        long_ago = monotonic() - 2 * self.cm.election_timer.duration
+        self.cm.last_heard['3'] = self.cm.last_heard['4'] = long_ago
+        self.cm.send_heartbeat()
+        self.assertEqual(self.cm.election_state, 'leader')
+
+    def test_replies_count_as_contact(self):
+        self.make_leader(1)
+        long_ago = monotonic() - 2 * self.cm.election_timer.duration
+        for peer in self.cm.peers:
+            self.cm.last_heard[peer] = long_ago
+        self.cm.receive_message(append_reply(1, '1', True, 0))
+        self.cm.receive_message(append_reply(1, '2', True, 0))
+        self.assertTrue(self.cm.has_quorum())
+
+
+class TestLeaderDurability(ConsensusTestCase):
+    def test_unsynced_entries_do_not_count_toward_the_majority(self):
+        self.make_leader(1)
+        self.cm.log.append_to_end(LogEntry(1, command(1)))
+        self.assertEqual(self.cm.log.durable_index, 0)
+        # two followers plus our unsynced copy would make three of five
+        self.cm.receive_message(append_reply(1, '1', True, 1))
+        self.cm.receive_message(append_reply(1, '2', True, 1))
+        self.assertEqual(self.cm.commitIndex, 0)
+        self.cm.log.make_durable()
+        self.cm.receive_message(append_reply(1, '2', True, 1))
+        self.assertEqual(self.cm.commitIndex, 1)
+
+    def test_reply_path_syncs_before_sending_new_entries(self):
+        self.make_leader(1)
+        self.cm.log.append_to_end(LogEntry(1, command(1)))
+        self.cm.receive_message(append_reply(1, '1', True, 0))
+        self.assertEqual(self.cm.log.durable_index, 1)
+        self.assertEqual(len(self.node.messenger.to('1', 'AppendEntriesRPC')), 1)
+
+
+class TestAdaptiveTimeouts(ConsensusTestCase):
+    def test_recently_sent_peers_are_skipped(self):
+        self.make_leader(1)
+        self.cm.last_sent['1'] = monotonic()
+        self.cm.last_sent['2'] = 0.0
+        self.cm.send_heartbeat()
+        self.assertEqual(self.node.messenger.to('1', 'AppendEntriesRPC'), [])
+        self.assertEqual(len(self.node.messenger.to('2', 'AppendEntriesRPC')), 1)
+
+    def test_longer_interval_reaches_every_peer(self):
+        self.make_leader(1)
+        self.cm.rtt['1'].record(0.01)  # a quick peer brings the interval down
+        self.cm.adapt_timeouts()
+        old_interval = self.cm.heartbeat.duration
+        for peer in self.cm.peers:
+            self.cm.last_sent[peer] = monotonic()
+        self.cm.rtt['2'].record(old_interval)  # then a slow one pushes it back up
+        self.cm.adapt_timeouts()
+        self.assertGreater(self.cm.heartbeat.duration, old_interval)
+        # the next tick tells everyone, recently sent to or not
+        self.cm.send_heartbeat()
+        for peer in self.cm.peers:
+            heartbeats = self.node.messenger.to(peer, 'AppendEntriesRPC')
+            self.assertEqual(len(heartbeats), 1)
+            self.assertEqual(heartbeats[0]['heartbeatInterval'], int(self.cm.heartbeat.duration * 1000))
+
+
+class TestReplicationScheduling(ConsensusTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.make_leader(1)
+        self.cm.replication_pending = False
+        for peer in self.cm.peers:
+            self.cm.probing[peer] = False  # so separate rounds would show as separate sends
+
+    def entries_sent_to(self, peer: str, count: int, timeout: float) -> list:
+        """entry counts of the AppendEntries sent to peer, once count entries went out"""
+        deadline = monotonic() + timeout
+        while True:
+            sent = [len(m['entries'].split(';')) for m in self.node.messenger.to(peer, 'AppendEntriesRPC')]
+            if sum(sent) >= count or monotonic() > deadline:
+                return sent
+            threading.Event().wait(0.001)
+
+    def test_command_is_sent_before_the_next_heartbeat(self):
+        start = monotonic()
+        self.run_on_loop((self.cm.add_client_command_to_log, (command(1), 1), 'client'))
+        # the heartbeat timer is stopped, so only the scheduled round can send it
+        self.assertEqual(self.entries_sent_to('1', 1, self.cm.heartbeat.duration), [1])
+        self.assertLess(monotonic() - start, self.cm.heartbeat.duration)
+        self.assertFalse(self.cm.replication_pending)
+
+    def test_burst_of_commands_goes_out_in_one_request(self):
+        self.run_on_loop(*[(self.cm.add_client_command_to_log, (command(i), 1), 'client') for i in range(1, 6)])
+        for peer in self.cm.peers:
+            self.assertEqual(self.entries_sent_to(peer, 5, 1), [5])
+
+
+class TestCommitWaiters(ConsensusTestCase):
+    def test_waiter_wakes_when_an_entry_commits(self):
+        woke = []
+        waiter = threading.Thread(target=lambda: woke.append(self.cm.wait_for_commit(0, timeout=2)))
+        waiter.start()
+        self.fill_log(1, 1)
+        self.cm.receive_message(append_entries(1, '1', 2, 1, leader_commit=2))
+        waiter.join(1)
+        self.assertEqual(woke, [2])
+
+    def test_waiter_gives_up_after_its_timeout(self):
+        start = monotonic()
+        self.assertEqual(self.cm.wait_for_commit(0, timeout=0.05), 0)
+        self.assertGreaterEqual(monotonic() - start, 0.05)
+
+    def test_already_committed_returns_at_once(self):
+        self.fill_log(1, 1)
+        self.cm.set_commit_index(2)
+        self.assertEqual(self.cm.wait_for_commit(1), 2)
+
+
+class TestSnapshots(ConsensusTestCase):
+    def test_lagging_follower_installs_the_snapshot(self):
+        self.fill_log(1, 1)
+        self.cm.receive_message(install_snapshot(2, '1', 6, 2))
+        reply = self.node.messenger.to('1', 'AppendReply')[-1]
+        self.assertTrue(reply['success'])
+        self.assertEqual(reply['match'], 6)
+        self.assertEqual(self.cm.server.restored[0]['lastIncludedIndex'], 6)
+        self.assertEqual((self.cm.log.snapshot_index, len(self.cm.log)), (6, 7))
+        self.assertEqual(self.cm.commitIndex, 6)
+        self.assertEqual(self.cm.snapshot['lastIncludedTerm'], 2)
+
+    def test_entries_after_a_matching_snapshot_are_kept(self):
+        self.fill_log(1, 1, 2, 2)
+        self.cm.receive_message(install_snapshot(2, '1', 2, 1))
+        self.assertEqual(self.cm.log.snapshot_index, 2)
+        self.assertEqual([self.cm.log.get_entry(i).term for i in range(2, len(self.cm.log))], [1, 2, 2])
+        self.assertEqual(self.cm.log.get_entry(4).command, command(4))
+
+    def test_entries_after_a_conflicting_snapshot_are_dropped(self):
+        self.fill_log(1, 1, 2, 2)
+        self.cm.receive_message(install_snapshot(3, '1', 2, 3))
+        self.assertEqual((self.cm.log.snapshot_index, len(self.cm.log)), (2, 3))
+
+    def test_stale_snapshot_is_refused(self):
+        self.fill_log(1, 1)
+        self.cm.term = 3
+        self.cm.receive_message(install_snapshot(2, '1', 6, 2))
+        self.assertFalse(self.node.messenger.to('1', 'AppendReply')[-1]['success'])
+        self.assertEqual(self.cm.server.restored, [])
+        self.assertEqual(len(self.cm.log), 3)
+
+    def test_leader_sends_the_snapshot_once_the_entries_are_gone(self):
+        self.fill_log(1, 1, 1, 1)
+        self.make_leader(1)
+        self.cm.take_snapshot({'matches': {}, 'lastApplied': 3})
+        self.cm.nextIndex['1'] = 2  # needs entries 2 and 3, now in the snapshot
+        self.cm.send_append_entries('1')
+        self.cm.send_append_entries('2')  # still has what it needs in the log
+        request = self.node.messenger.to('1', 'InstallSnapshotRPC')[-1]
+        self.assertEqual((request['lastIncludedIndex'], request['lastIncludedTerm']), (3, 1))
+        self.assertEqual(json.loads(request['data'])['state']['lastApplied'], 3)
+        self.assertEqual(self.node.messenger.to('1', 'AppendEntriesRPC'), [])
+        self.assertEqual(self.node.messenger.to('2', 'InstallSnapshotRPC'), [])
+        self.assertEqual(len(self.node.messenger.to('2', 'AppendEntriesRPC')), 1)
+        # the follower's reply moves it past the snapshot
+        self.cm.receive_message(append_reply(1, '1', True, 3))
+        self.assertEqual(self.cm.matchIndex['1'], 3)
+        self.assertEqual(self.node.messenger.to('1', 'AppendEntriesRPC')[-1]['prevLogIndex'], 3)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestClientCommands('test_leader_logs_commands_of_its_term'))
+    suite.addTest(TestClientCommands('test_command_queued_behind_a_new_leader_goes_back'))
+    suite.addTest(TestClientCommands('test_no_commands_during_a_leadership_transfer'))
+    suite.addTest(TestConflictHints('test_missing_entry_hints_our_log_length'))
+    suite.addTest(TestConflictHints('test_conflicting_term_hints_its_first_index'))
+    suite.addTest(TestConflictHints('test_leader_resumes_after_its_last_entry_of_the_conflicting_term'))
+    suite.addTest(TestConflictHints('test_leader_without_the_conflicting_term_skips_the_whole_run'))
+    suite.addTest(TestConflictHints('test_backtrack_stays_inside_the_log'))
+    suite.addTest(TestConflictHints('test_one_round_trip_per_term'))
+    suite.addTest(TestConflictHints('test_stale_leader_is_refused_without_touching_the_log'))
+    suite.addTest(TestPipelining('test_pump_fills_the_window'))
+    suite.addTest(TestPipelining('test_probe_sends_one_request_at_a_time'))
+    suite.addTest(TestPipelining('test_acknowledgement_slides_the_window'))
+    suite.addTest(TestPipelining('test_successful_probe_starts_streaming'))
+    suite.addTest(TestPipelining('test_rejected_window_rewinds_to_a_single_probe'))
+    suite.addTest(TestPipelining('test_new_hint_while_probing_probes_again'))
+    suite.addTest(TestPipelining('test_commit_follows_the_majority'))
+    suite.addTest(TestPreVote('test_granted_without_changing_anything'))
+    suite.addTest(TestPreVote('test_refused_while_a_leader_is_heard'))
+    suite.addTest(TestPreVote('test_refused_by_the_leader'))
+    suite.addTest(TestPreVote('test_refused_for_a_stale_log'))
+    suite.addTest(TestPreVote('test_refused_for_a_term_not_ahead_of_ours'))
+    suite.addTest(TestPreVote('test_majority_of_pre_votes_starts_the_election'))
+    suite.addTest(TestPreVote('test_refusal_from_a_later_term_ends_the_pre_vote'))
+    suite.addTest(TestVoting('test_later_last_term_wins_even_if_shorter'))
+    suite.addTest(TestVoting('test_equal_last_terms_compare_length'))
+    suite.addTest(TestVoting('test_candidate_with_a_stale_log_is_refused'))
+    suite.addTest(TestVoting('test_up_to_date_candidate_gets_the_only_vote'))
+    suite.addTest(TestVoting('test_win_over_a_newer_log_is_counted'))
+    suite.addTest(TestLeadershipTransfer('test_timeout_now_starts_a_real_election_at_once'))
+    suite.addTest(TestLeadershipTransfer('test_stale_timeout_now_is_ignored'))
+    suite.addTest(TestLeadershipTransfer('test_timeout_now_waits_for_the_target_to_catch_up'))
+    suite.addTest(TestLeadershipTransfer('test_default_target_is_the_most_up_to_date_follower'))
+    suite.addTest(TestLeadershipTransfer('test_transfer_that_times_out_resumes_leading'))
+    suite.addTest(TestLeadershipTransfer('test_new_leader_ends_the_transfer'))
+    suite.addTest(TestCheckQuorum('test_leader_cut_off_from_the_majority_steps_down'))
+    suite.addTest(TestCheckQuorum('test_leader_hearing_from_a_majority_stays'))
+    suite.addTest(TestCheckQuorum('test_replies_count_as_contact'))
+    suite.addTest(TestLeaderDurability('test_unsynced_entries_do_not_count_toward_the_majority'))
+    suite.addTest(TestLeaderDurability('test_reply_path_syncs_before_sending_new_entries'))
+    suite.addTest(TestAdaptiveTimeouts('test_recently_sent_peers_are_skipped'))
+    suite.addTest(TestAdaptiveTimeouts('test_longer_interval_reaches_every_peer'))
+    suite.addTest(TestReplicationScheduling('test_command_is_sent_before_the_next_heartbeat'))
+    suite.addTest(TestReplicationScheduling('test_burst_of_commands_goes_out_in_one_request'))
+    suite.addTest(TestCommitWaiters('test_waiter_wakes_when_an_entry_commits'))
+    suite.addTest(TestCommitWaiters('test_waiter_gives_up_after_its_timeout'))
+    suite.addTest(TestCommitWaiters('test_already_committed_returns_at_once'))
+    suite.addTest(TestSnapshots('test_lagging_follower_installs_the_snapshot'))
+    suite.addTest(TestSnapshots('test_entries_after_a_matching_snapshot_are_kept'))
+    suite.addTest(TestSnapshots('test_entries_after_a_conflicting_snapshot_are_dropped'))
+    suite.addTest(TestSnapshots('test_stale_snapshot_is_refused'))
+    suite.addTest(TestSnapshots('test_leader_sends_the_snapshot_once_the_entries_are_gone'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,101 @@
+import unittest, threading, time
+from EventLoop import EventLoop, EventStats
+
+
+class TestEventLoop(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = EventLoop('test loop')
+        self.done = threading.Event()
+
+    def test_runs_events_in_order_on_one_thread(self):
+        seen = []
+        for number in range(20):
+            self.loop.post(lambda n: seen.append((n, threading.get_ident())), number)
+        self.loop.post(self.done.set)
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual([n for n, _ in seen], list(range(20)))
+        self.assertEqual({thread for _, thread in seen}, {self.loop.thread.ident})
+
+    def test_failing_event_does_not_stop_the_loop(self):
+        self.loop.post(lambda: 1 / 0, kind='broken')
+        self.loop.post(self.done.set)
+        self.assertTrue(self.done.wait(1))
+
+    def test_records_time_per_kind(self):
+        self.loop.post(time.sleep, 0.02, kind='slow')
+        self.loop.post(self.done.set, kind='fast')
+        self.assertTrue(self.done.wait(1))
+        stats = self.loop.stats
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.slowest(), 'slow')
+        self.assertGreaterEqual(stats.mean('slow'), 0.02)
+        self.assertGreaterEqual(stats.max_wait, 0.0)
+
+    def test_stats_can_be_printed_while_recorded(self):
+        stats = EventStats()
+        recording = threading.Thread(target=lambda: [stats.record(f'kind {n}', 0.0, n / 1e6) for n in range(100000)])
+        recording.start()
+        while recording.is_alive():
+            str(stats)  # a new kind appearing mid-iteration would raise here
+        recording.join()
+        self.assertEqual(stats.slowest(), 'kind 99999')
+        self.assertEqual(len(stats.snapshot()), 100000)
+
+    def test_consensus_lane_runs_before_client_backlog(self):
+        started = threading.Event()
+        release = threading.Event()
+        seen = []
+        self.loop.post(lambda: (started.set(), release.wait(1)))
+        self.assertTrue(started.wait(1))
+        for number in range(3):
+            self.loop.post(seen.append, f'client {number}', lane='client')
+        self.loop.post(seen.append, 'heartbeat')
+        self.loop.post(self.done.set, lane='client')
+        release.set()
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(seen, ['heartbeat', 'client 0', 'client 1', 'client 2'])
+
+    def test_full_lane_holds_back_the_producer(self):
+        lane = self.loop.mailbox.lanes['client']
+        lane.capacity = 2
+        release = threading.Event()
+        self.loop.post(release.wait, 1)
+        self.loop.post(lambda: None, lane='client')
+        self.loop.post(lambda: None, lane='client')
+        waited = threading.Event()
+        producer = threading.Thread(target=lambda: (self.loop.wait_for_room('client'), waited.set()))
+        producer.start()
+        self.assertFalse(waited.wait(0.05))
+        release.set()
+        self.assertTrue(waited.wait(1))
+        self.assertEqual(lane.full_count, 1)
+        self.assertEqual(lane.high_water, 2)
+
+    def test_first_goes_ahead_of_its_lane(self):
+        release = threading.Event()
+        seen = []
+        self.loop.post(release.wait, 1)
+        self.loop.post(seen.append, 'client 0', lane='client')
+        self.loop.post(seen.append, 'returned', lane='client', first=True)
+        self.loop.post(seen.append, 'heartbeat')
+        self.loop.post(self.done.set, lane='client')
+        release.set()
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(seen, ['heartbeat', 'returned', 'client 0'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestEventLoop('test_runs_events_in_order_on_one_thread'))
+    suite.addTest(TestEventLoop('test_failing_event_does_not_stop_the_loop'))
+    suite.addTest(TestEventLoop('test_records_time_per_kind'))
+    suite.addTest(TestEventLoop('test_stats_can_be_printed_while_recorded'))
+    suite.addTest(TestEventLoop('test_consensus_lane_runs_before_client_backlog'))
+    suite.addTest(TestEventLoop('test_full_lane_holds_back_the_producer'))
+    suite.addTest(TestEventLoop('test_first_goes_ahead_of_its_lane'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
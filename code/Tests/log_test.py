@@ -1,37 +1,146 @@
-import unittest, os
+import unittest, os, threading
 from ConsensusModule import Log, LogEntry
 
 
 class TestLog(unittest.TestCase):
+    file_path = "../files/logOutputtest.tsv"
+    index_path = "../files/logIndextest.idx"
+
     def setUp(self) -> None:
-        if os.path.exists("../files/logOutput.tsv"):
-            os.remove("../files/logOutput.tsv")
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
         else:
             print('file not found')
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
 
-        self.log = Log()
+        # a new log starts with a placeholder entry at index 0
+        self.log = Log('test')
         self.log.append_to_end(LogEntry(1, 'blue_block_left'))
         self.log.append_to_end(LogEntry(1, 'red_punch_right'))
         self.log.append_to_end(LogEntry(1, 'red_block_left'))
         self.log.append_to_end(LogEntry(2, 'blue_punch_left'))
         self.log.append_to_end(LogEntry(3, 'blue_punch_right'))
 
+    def tearDown(self) -> None:
+        self.log.logfile.close()
+        self.log.indexfile.close()
+        os.remove(self.file_path)
+        os.remove(self.index_path)
+
     def test_add_log_entries(self):
-        self.assertEqual(len(self.log), 5)
-        self.assertEqual(self.log.get_entry(0).command, 'blue_block_left')
+        self.assertEqual(len(self.log), 6)
+        self.assertEqual(self.log.get_entry(1).command, 'blue_block_left')
 
     def test_rollback_log(self):
-        self.log.rollback(3)
+        self.log.rollback(4)
         self.assertEqual(self.log.get_entry(-1).command, 'red_block_left')
 
+    def test_rollback_truncates_file(self):
+        self.log.rollback(4)
+        self.log.append_to_end(LogEntry(4, 'red_punch_left'))
+        self.log.make_durable()
+        reloaded = Log('test')
+        self.assertEqual([e.command for e in reloaded.log[3:]], ['red_block_left', 'red_punch_left'])
+        self.assertEqual(reloaded.offsets, self.log.offsets)
+        with open(self.index_path, 'rb') as index_file:
+            self.assertEqual(len(index_file.read()), 8 * len(reloaded))
+
+    def test_compact_keeps_absolute_indices(self):
+        self.log.compact(3)
+        self.assertEqual(self.log.snapshot_index, 3)
+        self.assertEqual(len(self.log), 6)
+        self.assertIsNone(self.log.get_entry(2))
+        self.assertEqual(self.log.get_entry(3).term, 1)
+        self.assertEqual(self.log.get_entry(4).command, 'blue_punch_left')
+        reloaded = Log('test')
+        self.assertEqual(reloaded.snapshot_index, 3)
+        self.assertEqual(reloaded.get_entry(5).command, 'blue_punch_right')
+
+    def test_reset_to_unknown_snapshot_drops_log(self):
+        self.log.reset_to_snapshot(40, 7)
+        self.assertEqual(len(self.log), 41)
+        self.assertEqual(self.log.get_entry(40).term, 7)
+        self.assertFalse(self.log.idx_exist(5))
+
+    def test_entries_string_is_capped(self):
+        entries, count = self.log.get_entries_string(1, max_entries=3)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.log.parse_entries_to_list(entries)[-1].command, 'red_block_left')
+        entries, count = self.log.get_entries_string(1, max_bytes=40)
+        self.assertEqual(count, 2)
+        entries, count = self.log.get_entries_string(1, max_bytes=1)
+        self.assertEqual(count, 1)
+
+    def test_term_boundaries(self):
+        self.assertEqual(self.log.first_index_of_term(3), 1)
+        self.assertEqual(self.log.first_index_of_term(4), 4)
+        self.assertEqual(self.log.last_index_of_term(1), 3)
+        self.assertIsNone(self.log.last_index_of_term(4))
+
+    def test_reload_after_sync(self):
+        self.log.make_durable()
+        reloaded = Log('test')
+        self.assertEqual([str(e) for e in reloaded.log], [str(e) for e in self.log.log])
+
+    def test_torn_tail_is_discarded(self):
+        self.log.make_durable()
+        with open(self.file_path, 'ab') as log_file:
+            log_file.write(b'4\tred_punch_le')  # crash in the middle of a write
+        reloaded = Log('test')
+        self.assertEqual(len(reloaded), 6)
+        reloaded.append_to_end(LogEntry(4, 'red_punch_left'))
+        reloaded.make_durable()
+        self.assertEqual(Log('test').get_entry(-1).command, 'red_punch_left')
+
+    def test_legacy_csv_log_is_read(self):
+        self.log.logfile.close()
+        with open(self.file_path, 'wb') as log_file:
+            log_file.write(b'TERM\tCOMMAND\r\n0\tnull\r\n1\tblue_block_left\r\n2\tred_punch_right\r\n')
+        os.remove(self.index_path)
+        legacy = Log('test')
+        self.assertEqual([(e.term, e.command) for e in legacy.log],
+            [(0, 'null'), (1, 'blue_block_left'), (2, 'red_punch_right')])
+        legacy.append_to_end(LogEntry(2, 'red_block_left'))
+        legacy.make_durable()
+        self.assertEqual(Log('test').get_entry(-1).command, 'red_block_left')
+
+    def test_readers_never_see_a_half_compacted_log(self):
+        for i in range(6, 200):
+            self.log.append_to_end(LogEntry(3, f'c{i}'))
+        wrong = []
+        done = threading.Event()
+        def read():
+            while not done.is_set():
+                for i in range(150, 200):
+                    entry = self.log.get_entry(i)
+                    if entry is None or entry.command != f'c{i}':
+                        wrong.append((i, entry))
+        reader = threading.Thread(target=read)
+        reader.start()
+        for index in range(10, 150, 5):
+            self.log.compact(index)
+        done.set()
+        reader.join()
+        self.assertEqual(wrong, [])
+
 
 def suite():
     suite = unittest.TestSuite()
-    suite.addTest(TestLog.test_add_log_entries())
-    suite.addTest(TestLog.test_rollback_log())
+    suite.addTest(TestLog('test_add_log_entries'))
+    suite.addTest(TestLog('test_rollback_log'))
+    suite.addTest(TestLog('test_rollback_truncates_file'))
+    suite.addTest(TestLog('test_compact_keeps_absolute_indices'))
+    suite.addTest(TestLog('test_reset_to_unknown_snapshot_drops_log'))
+    suite.addTest(TestLog('test_entries_string_is_capped'))
+    suite.addTest(TestLog('test_term_boundaries'))
+    suite.addTest(TestLog('test_reload_after_sync'))
+    suite.addTest(TestLog('test_torn_tail_is_discarded'))
+    suite.addTest(TestLog('test_legacy_csv_log_is_read'))
+    suite.addTest(TestLog('test_readers_never_see_a_half_compacted_log'))
     return suite
 
 
 if __name__ == '__main__':
-    runner = unittest.TextTestRunner
-    runner.run(suite())
\ No newline at end of file
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
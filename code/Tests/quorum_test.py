@@ -0,0 +1,36 @@
+import unittest
+from QuorumTracker import QuorumTracker
+
+
+class TestQuorumTracker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.quorum = QuorumTracker(['1', '2', '3', '4'])
+
+    def test_burst_commits_at_once(self):
+        self.quorum.update('1', 40)
+        self.assertEqual(self.quorum.majority_index(40), 0)
+        self.quorum.update('3', 40)
+        self.assertEqual(self.quorum.majority_index(40), 40)
+
+    def test_majority_is_third_highest_of_five(self):
+        for peer, index in zip(['1', '2', '3', '4'], [3, 9, 7, 1]):
+            self.quorum.update(peer, index)
+        self.assertEqual(self.quorum.majority_index(12), 7)
+
+    def test_match_index_never_decreases(self):
+        self.quorum.update('2', 10)
+        self.quorum.update('2', 4)
+        self.assertEqual(self.quorum.match_index['2'], 10)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestQuorumTracker('test_burst_commits_at_once'))
+    suite.addTest(TestQuorumTracker('test_majority_is_third_highest_of_five'))
+    suite.addTest(TestQuorumTracker('test_match_index_never_decreases'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
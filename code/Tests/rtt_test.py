@@ -0,0 +1,39 @@
+import unittest
+from RttEstimator import RttEstimator
+
+
+class TestRttEstimator(unittest.TestCase):
+    def test_first_sample(self):
+        estimator = RttEstimator()
+        self.assertEqual(estimator.rto(), 0.0)
+        estimator.record(0.1)
+        self.assertAlmostEqual(estimator.srtt, 0.1)
+        self.assertAlmostEqual(estimator.rto(), 0.3)
+
+    def test_steady_samples_narrow_the_bound(self):
+        estimator = RttEstimator()
+        for _ in range(50):
+            estimator.record(0.02)
+        self.assertAlmostEqual(estimator.srtt, 0.02)
+        self.assertLess(estimator.rto(), 0.021)
+
+    def test_spike_widens_the_bound(self):
+        estimator = RttEstimator()
+        for _ in range(50):
+            estimator.record(0.02)
+        steady = estimator.rto()
+        estimator.record(0.2)
+        self.assertGreater(estimator.rto(), steady + 0.1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestRttEstimator('test_first_sample'))
+    suite.addTest(TestRttEstimator('test_steady_samples_narrow_the_bound'))
+    suite.addTest(TestRttEstimator('test_spike_widens_the_bound'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -1,38 +1,402 @@
-from code.robot_logic import *
-import unittest
+import unittest, glob, json, os, tempfile, threading
+from time import monotonic, sleep
+from types import SimpleNamespace
+from ConsensusModule import LogEntry
+from Messenger import FanoutStats
+from Transport import PollStats
+from Command import Command
+from server_logic import Server, ApplyStats, MatchRegistry, RaftNode
+import Transport
 
 
-class TestServerMethods(unittest.TestCase):
+class Outbox:
+    """stands in for the node's Messenger and keeps everything sent"""
+
+    def __init__(self):
+        self.sent = []
+        # read by the status print of the apply loop
+        self.transport = SimpleNamespace(poll_stats=PollStats())
+        self.fanout = FanoutStats()
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+    def send(self, message: dict, destination: str, flush: bool = False):
+        self.sent.append((destination, message))
+
+    def to(self, peer: str, message_type: str) -> list:
+        return [m for d, m in self.sent if d == peer and m['messageType'] == message_type]
+
+
+class StubNode:
+    def __init__(self):
+        self.messenger = Outbox()
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    A follower Server for node '0' on the local transport, with its timers
+    stopped, so a test appends entries itself and applies them.
+    """
+    group = 950
+
     def setUp(self) -> None:
-        self.robot_blue = Robot('blue')
-        self.robot_red = Robot('red')
-        self.server = Server('leader')
+        # each test gets its own group, so its own log and snapshot files
+        ServerTestCase.group += 1
+        self.remove_files()
+        self.transport = os.environ.get('RAFT_TRANSPORT')
+        os.environ['RAFT_TRANSPORT'] = 'local'
+        self.server = Server('0', group=self.group, node=StubNode())
+        self.cm = self.server.cm
+        self.cm.election_timer.stop_timer()
+
+    def tearDown(self) -> None:
+        self.server.turn_off_leader_queue()
+        self.server.stop()
+        self.server.log_checker.join()
+        self.cm.election_timer.stop_timer()
+        self.cm.heartbeat.stop_timer()
+        self.cm.log.logfile.close()
+        self.cm.log.indexfile.close()
+        self.remove_files()
+        if self.transport is None:
+            del os.environ['RAFT_TRANSPORT']
+        else:
+            os.environ['RAFT_TRANSPORT'] = self.transport
+
+    def remove_files(self):
+        for path in glob.glob(f'../files/*0-{self.group}.*'):
+            os.remove(path)
 
+    def append(self, *commands):
+        for command in commands:
+            self.cm.log.append_to_end(LogEntry(1, command.encode()))
+
+    def logged(self) -> list:
+        return [self.cm.log.get_entry(i).command for i in range(1, len(self.cm.log))]
+
+    def run_on_loop(self, *events):
+        """post (callback, args, lane) events behind a held loop, then let them all run"""
+        release, done = threading.Event(), threading.Event()
+        self.cm.loop.post(release.wait, 1)
+        for callback, args, lane in events:
+            self.cm.loop.post(callback, *args, lane=lane)
+        self.cm.loop.post(done.set, lane='client')  # the client lane runs last
+        release.set()
+        self.assertTrue(done.wait(1))
+
+
+class TestServerMethods(ServerTestCase):
     def test_update_status_blocked(self):
-        self.robot_blue.block_with_left()
-        # self.robot_red.punch_with_right()
+        self.append(Command('client-blue', 'block_left', 1), Command('client-red', 'punch_right', 1))
+        self.server.apply_committed(2)
+        self.assertEqual(self.server.matches.get(0).game_state, 'red_blocked')
+
+    def test_restore_snapshot(self):
+        match = {'blue_status': 'block_left', 'red_status': 'punch_right', 'game_state': 'red_blocked'}
+        self.server.restore_snapshot({'lastIncludedIndex': 7, 'lastIncludedTerm': 1,
+            'state': {'matches': {'3': match}, 'lastApplied': 7}})
+        self.assertEqual(self.server.lastApplied, 7)
+        self.assertEqual(len(self.server.matches), 1)
+        self.assertEqual(self.server.matches.get(3).state(), match)
+
+    def test_restore_snapshot_from_before_matches(self):
+        self.server.restore_snapshot({'lastIncludedIndex': 4, 'lastIncludedTerm': 1,
+            'state': {'blue_status': 'punch_left', 'red_status': '', 'game_state': 'ongoing',
+                'lastApplied': 4}})
+        self.assertEqual(self.server.lastApplied, 4)
+        self.assertEqual(self.server.matches.get(0).server_logic.blue_status, 'punch_left')
+
+
+class TestApply(ServerTestCase):
+    def test_committed_entries_apply_in_one_pass_in_log_order(self):
+        # the blue block must be applied before the red punch it stops
+        self.append(Command('client-blue', 'block_left', 1), Command('client-red', 'punch_right', 1),
+            Command('client-red', 'block_left', 1, match=2), Command('client-blue', 'punch_right', 1, match=2))
+        self.server.apply_committed(4)
+        self.assertEqual(self.server.lastApplied, 4)
+        self.assertEqual(self.server.matches.get(0).game_state, 'red_blocked')
+        self.assertEqual(self.server.matches.get(2).game_state, 'blue_blocked')
+        self.assertEqual((self.server.apply_stats.batches, self.server.apply_stats.entries), (1, 4))
+
+    def test_nothing_past_commit_index_is_applied(self):
+        self.append(Command('client-blue', 'block_left', 1), Command('client-red', 'punch_right', 1))
+        self.server.apply_committed(1)
+        self.assertEqual(self.server.lastApplied, 1)
+        self.assertEqual(self.server.matches.get(0).server_logic.red_status, '')
+        self.server.apply_committed(1)  # nothing new, so no batch
+        self.assertEqual(self.server.apply_stats.batches, 1)
+
+    def test_exit_ends_the_match(self):
+        self.append(Command('client-blue', 'block_left', 1, match=5), Command('client-red', 'exit', 1, match=5))
+        self.server.apply_committed(2)
+        self.assertEqual(len(self.server.matches), 0)
+
+    def test_apply_loop_wakes_on_commit(self):
+        self.append(Command('client-blue', 'block_left', 1), Command('client-red', 'punch_right', 1))
+        self.cm.set_commit_index(2)
+        deadline = monotonic() + 1
+        while self.server.lastApplied < 2 and monotonic() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.server.lastApplied, 2)
+
+
+class TestMatches(ServerTestCase):
+    def test_each_match_keeps_its_own_state(self):
+        self.append(Command('client-blue', 'block_left', 1, match=1), Command('client-red', 'punch_left', 1, match=2),
+            Command('client-red', 'punch_right', 2, match=1))
+        self.server.apply_committed(3)
+        one, two = self.server.matches.get(1), self.server.matches.get(2)
+        self.assertEqual((one.server_logic.blue_status, one.server_logic.red_status), ('block_left', 'punch_right'))
+        self.assertEqual((two.server_logic.blue_status, two.server_logic.red_status), ('', 'punch_left'))
+        self.assertEqual(one.game_state, 'red_blocked')
+        self.assertEqual(two.game_state, 'ongoing')
 
+    def test_leader_answers_on_the_match_queues(self):
+        self.server.messenger = Outbox()
+        self.cm.election_state = 'leader'
+        self.append(Command('client-blue', 'block_left', 1), Command('client-blue', 'block_left', 1, match=4),
+            Command('client-red', 'exit', 1, match=4))
+        self.server.apply_committed(3)
+        self.assertEqual([destination for destination, _ in self.server.messenger.sent],
+            ['client-blue', 'client-blue-4', 'client-blue-4'])
+        self.assertEqual(self.server.messenger.sent[-1][1], {'msg': 'exit'})
+
+    def test_lookup_starts_a_match_and_exit_ends_it(self):
+        matches = self.server.matches
+        self.assertIs(matches.get(7), matches.get(7))
+        self.assertEqual(matches.get(7).endpoint('client-red'), 'client-red-7')
+        self.assertEqual(matches.get(0).endpoint('client-red'), 'client-red')
+        matches.end(7)
+        matches.end(7)  # ending twice is harmless
+        self.assertEqual(len(matches), 1)
+
+    def test_state_survives_snapshot_and_restore(self):
+        self.append(Command('client-blue', 'block_left', 1, match=1), Command('client-red', 'punch_right', 1, match=1),
+            Command('client-red', 'block_right', 1, match=3))
+        self.server.apply_committed(3)
+        state = self.server.snapshot_state()
+        # through the snapshot file format and into a fresh registry
+        restored = MatchRegistry(self.cm)
+        restored.restore(json.loads(json.dumps(state))['matches'])
+        self.assertEqual(sorted(restored.matches), [1, 3])
+        for match_id in (1, 3):
+            self.assertEqual(restored.get(match_id).state(), self.server.matches.get(match_id).state())
+        self.server.matches.end(1)
+        self.server.restore_snapshot({'state': state})
+        self.assertEqual(self.server.matches.get(1).game_state, 'red_blocked')
+        self.assertEqual(self.server.lastApplied, 3)
+
+
+class TestReturnedCommands(ServerTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server.messenger = Outbox()
+        self.commands = [Command('client-red', 'block_left', seq).encode() for seq in range(3)]
+
+    def test_follower_holds_them_until_it_hears_from_a_leader(self):
+        self.cm.term = 2
+        self.server.return_client_command(self.commands[0])
+        self.server.return_client_command(self.commands[1])
+        self.assertEqual(self.server.messenger.sent, [])  # nobody may be reading the leader queue yet
+        self.cm.receive_message(append_entries(self.group, 2))
+        self.assertEqual(self.server.messenger.sent, [(f'leader-{self.group}', {'messageType': 'ReturnedCommands',
+            'group': self.group, 'term': 2, 'commands': ';'.join(self.commands[:2])})])
+        self.assertEqual(self.server.returned, [])
+
+    def test_leader_puts_returned_commands_ahead_of_its_backlog(self):
+        self.cm.term, self.cm.election_state = 1, 'leader'
+        newer = {'messageType': 'ClientCommand', 'command': self.commands[2]}
+        returned = {'messageType': 'ReturnedCommands', 'group': self.group, 'term': 1,
+            'commands': ';'.join(self.commands[:2])}
+        self.run_on_loop(
+            (self.server.handle_incoming_message, (newer,), 'consensus'),
+            (self.server.handle_incoming_message, (returned,), 'consensus'))
+        self.assertEqual(self.logged(), self.commands)
+
+    def test_leader_of_a_later_term_logs_its_own_returns_first(self):
+        self.cm.term, self.cm.election_state = 2, 'leader'
+        self.run_on_loop(
+            (self.cm.add_client_command_to_log, (self.commands[0], 1), 'client'),
+            (self.cm.add_client_command_to_log, (self.commands[1], 2), 'client'))
+        self.assertEqual(self.logged(), self.commands[:2])
+        self.assertEqual(self.cm.returned_commands, 1)
+
+    def test_commands_wait_out_a_leadership_transfer(self):
+        self.cm.term, self.cm.election_state = 1, 'leader'
+        self.cm.transfer_target = '1'
+        self.run_on_loop((self.cm.add_client_command_to_log, (self.commands[0], 1), 'client'))
+        self.assertEqual(self.server.returned, self.commands[:1])
+        self.assertEqual(self.server.messenger.sent, [])
+        self.run_on_loop((self.cm.abort_transfer, (), 'consensus'))
+        self.assertEqual(self.logged(), self.commands[:1])
+
+    def test_transfer_hands_them_to_the_target_before_timeout_now(self):
+        self.cm.term, self.cm.election_state = 1, 'leader'
+        self.cm.transfer_target = '1'
+        self.run_on_loop(
+            (self.cm.add_client_command_to_log, (self.commands[0], 1), 'client'),
+            (self.cm.add_client_command_to_log, (self.commands[1], 1), 'client'))
+        self.cm.send_timeout_now()
+        sent = [(destination, m['messageType']) for destination, m in self.cm.messenger.sent]
+        self.assertEqual(sent, [('1', 'ReturnedCommands'), ('1', 'TimeoutNowRPC')])
+        self.assertEqual(self.cm.messenger.sent[0][1]['commands'], ';'.join(self.commands[:2]))
+        self.assertEqual(self.server.returned, [])
+
+    def test_target_logs_handed_over_commands_first(self):
+        self.cm.term = 1
+        handed = {'messageType': 'ReturnedCommands', 'group': self.group, 'term': 1,
+            'commands': ';'.join(self.commands[:2])}
+        self.cm.receive_message(handed)
+        self.assertEqual(self.server.returned, self.commands[:2])
+        newer = {'messageType': 'ClientCommand', 'command': self.commands[2]}
+        self.cm.term = 2
+        self.run_on_loop(
+            (self.cm.set_leader, (), 'consensus'),
+            (self.server.handle_incoming_message, (newer,), 'consensus'))
+        self.cm.heartbeat.stop_timer()
+        self.assertEqual(self.logged(), self.commands)
+
+
+def append_entries(group: int, term: int, entries: list = ()) -> dict:
+    return {
+        'messageType': 'AppendEntriesRPC', 'group': group, 'term': term, 'leaderID': '1',
+        'prevLogIndex': 0, 'prevLogTerm': 0, 'prevLogCommand': '',
+        'entries': ';'.join(entry.serialized for entry in entries),
+        'leaderCommit': 0, 'nextIndex': 1, 'sentAt': 0, 'heartbeatInterval': 50
+    }
+
+
+class TestRaftNode(unittest.TestCase):
     """
-    def test_update_status_punch(self):
-        msg_dict_red = {'id': 'client-red', 'state': 'punch-left'}
-        msg_dict_blue = {'id': 'client-blue', 'state': 'punch-right'}
-        self.server.handle_incoming_message(msg_dict_red)
-        self.server.handle_incoming_message(msg_dict_blue)
-
-    def test_update_status_exit(self):
-        msg_dict_red = {'id': 'client-red', 'state': 'punch-left'}
-        msg_dict_blue = {'id': 'client-blue', 'state': 'exit'}
-        self.server.handle_incoming_message(msg_dict_red)
-        self.server.handle_incoming_message(msg_dict_blue)
+    Node '0' hosting two groups, run in a scratch directory since groups are
+    numbered from 0 and would share the files of a real node '0'. Its TCP
+    listener is on a free port, and what the groups send is collected.
     """
 
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.scratch = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.scratch.name, 'work'))
+        os.chdir(os.path.join(self.scratch.name, 'work'))
+        self.transport = os.environ.get('RAFT_TRANSPORT')
+        os.environ['RAFT_TRANSPORT'] = 'tcp'
+        self.addresses = dict(Transport.tcp_addresses)
+        for endpoint in ('0', 'leader', 'leader-1'):
+            Transport.tcp_addresses[endpoint] = ('127.0.0.1', 0)
+        self.node = RaftNode('0', 2)
+        self.outbox = Outbox()
+        for cm in self.node.groups.values():
+            cm.election_timer.stop_timer()
+            cm.messenger = self.outbox
+
+    def tearDown(self) -> None:
+        self.node.messenger.off()
+        for server in self.node.servers:
+            server.turn_off_leader_queue()
+            server.stop()
+            server.log_checker.join()
+            server.cm.election_timer.stop_timer()
+            server.cm.heartbeat.stop_timer()
+            server.cm.log.logfile.close()
+            server.cm.log.indexfile.close()
+        os.chdir(self.cwd)
+        self.scratch.cleanup()
+        Transport.tcp_addresses.clear()
+        Transport.tcp_addresses.update(self.addresses)
+        if self.transport is None:
+            del os.environ['RAFT_TRANSPORT']
+        else:
+            os.environ['RAFT_TRANSPORT'] = self.transport
+
+    def settle(self):
+        """wait until every group's loop has run what was posted to it"""
+        for cm in self.node.groups.values():
+            done = threading.Event()
+            cm.loop.post(done.set)
+            done.wait(1)
+
+    def test_messages_go_to_their_group(self):
+        self.node.handle_incoming_message(append_entries(1, 2, [LogEntry(2, Command('client-red', 'block_left', 1, match=1).encode())]))
+        self.node.handle_incoming_message(append_entries(7, 3))  # no such group here
+        self.settle()
+        zero, one = self.node.groups[0], self.node.groups[1]
+        self.assertEqual((one.term, len(one.log)), (2, 2))
+        self.assertEqual((zero.term, len(zero.log)), (0, 1))
+
+    def test_batch_end_syncs_and_replies_for_every_group(self):
+        for group in (0, 1):
+            self.node.handle_incoming_message(append_entries(group, 1, [LogEntry(1, Command('client-red', 'block_left', 1).encode())]))
+        self.settle()
+        self.assertEqual(self.outbox.sent, [])  # replies wait for the end of the batch
+        self.node.handle_batch_end()
+        self.settle()
+        replies = self.outbox.to('1', 'AppendReply')
+        self.assertEqual(sorted(reply['group'] for reply in replies), [0, 1])
+        self.assertTrue(all(reply['success'] and reply['match'] == 1 for reply in replies))
+        self.assertEqual([cm.log.durable_index for cm in self.node.groups.values()], [1, 1])
+
+    def test_heartbeat_tick_sends_only_its_own_group(self):
+        for cm in self.node.groups.values():
+            cm.term = 1
+            cm.set_leader()
+            cm.heartbeat.stop_timer()
+        self.settle()
+        self.outbox.sent.clear()
+        for cm in self.node.groups.values():
+            for peer in cm.peers:
+                cm.last_sent[peer] = 0.0
+        self.node.groups[1].send_heartbeat()
+        heartbeats = [m for _, m in self.outbox.sent if m['messageType'] == 'AppendEntriesRPC']
+        self.assertEqual(len(heartbeats), 4)
+        self.assertEqual({m['group'] for m in heartbeats}, {1})
+
+
+class TestApplyStats(unittest.TestCase):
+    def test_batches_are_counted(self):
+        stats = ApplyStats()
+        stats.record(3, 0.002)
+        stats.record(1, 0.004)
+        self.assertEqual((stats.batches, stats.entries, stats.max_lag), (2, 4, 3))
+        self.assertEqual(stats.mean_lag(), 2.0)
+        self.assertAlmostEqual(stats.mean_latency(), 0.003)
+        self.assertEqual(stats.max_latency, 0.004)
+
+    def test_no_batches_yet(self):
+        stats = ApplyStats()
+        self.assertEqual((stats.mean_lag(), stats.mean_latency()), (0.0, 0.0))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestServerMethods('test_update_status_blocked'))
-    #suite.addTest(TestServerMethods('test_update_status_punch'))
-    #suite.addTest(TestServerMethods('test_update_status_exit'))
+    suite.addTest(TestServerMethods('test_restore_snapshot'))
+    suite.addTest(TestServerMethods('test_restore_snapshot_from_before_matches'))
+    suite.addTest(TestApply('test_committed_entries_apply_in_one_pass_in_log_order'))
+    suite.addTest(TestApply('test_nothing_past_commit_index_is_applied'))
+    suite.addTest(TestApply('test_exit_ends_the_match'))
+    suite.addTest(TestApply('test_apply_loop_wakes_on_commit'))
+    suite.addTest(TestMatches('test_each_match_keeps_its_own_state'))
+    suite.addTest(TestMatches('test_leader_answers_on_the_match_queues'))
+    suite.addTest(TestMatches('test_lookup_starts_a_match_and_exit_ends_it'))
+    suite.addTest(TestMatches('test_state_survives_snapshot_and_restore'))
+    suite.addTest(TestReturnedCommands('test_follower_holds_them_until_it_hears_from_a_leader'))
+    suite.addTest(TestReturnedCommands('test_leader_puts_returned_commands_ahead_of_its_backlog'))
+    suite.addTest(TestReturnedCommands('test_leader_of_a_later_term_logs_its_own_returns_first'))
+    suite.addTest(TestReturnedCommands('test_commands_wait_out_a_leadership_transfer'))
+    suite.addTest(TestReturnedCommands('test_transfer_hands_them_to_the_target_before_timeout_now'))
+    suite.addTest(TestReturnedCommands('test_target_logs_handed_over_commands_first'))
+    suite.addTest(TestRaftNode('test_messages_go_to_their_group'))
+    suite.addTest(TestRaftNode('test_batch_end_syncs_and_replies_for_every_group'))
+    suite.addTest(TestRaftNode('test_heartbeat_tick_sends_only_its_own_group'))
+    suite.addTest(TestApplyStats('test_batches_are_counted'))
+    suite.addTest(TestApplyStats('test_no_batches_yet'))
+    return suite
 
 
 if __name__ == '__main__':
-    runner = unittest.TextTestRunner
-    runner.run(suite())
\ No newline at end of file
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,85 @@
+import unittest, time
+from TimerScheduler import TimerScheduler
+from ElectionTimer import Election_Timer
+from Heartbeat import Heartbeat
+
+
+class FakeNode:
+    def __init__(self):
+        self.id = 'test'
+        self.election_state = 'leader'
+        self.elections = 0
+        self.heartbeats = 0
+
+    def campaign(self):
+        self.elections += 1
+
+    def send_heartbeat(self):
+        self.heartbeats += 1
+
+
+class TestTimerScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.scheduler = TimerScheduler()
+        self.fired = []
+
+    def test_fires_in_deadline_order(self):
+        self.scheduler.schedule(0.06, lambda: self.fired.append('late'))
+        self.scheduler.schedule(0.02, lambda: self.fired.append('early'))
+        time.sleep(0.15)
+        self.assertEqual(self.fired, ['early', 'late'])
+        self.assertEqual(self.scheduler.jitter.count, 2)
+
+    def test_cancelled_timer_does_not_fire(self):
+        handle = self.scheduler.schedule(0.02, lambda: self.fired.append('x'))
+        handle.cancel()
+        time.sleep(0.06)
+        self.assertEqual(self.fired, [])
+
+
+class TestElectionTimer(unittest.TestCase):
+    def test_restart_postpones_election(self):
+        node = FakeNode()
+        timer = Election_Timer(0.05, node)  # fires after 0.05 - 0.15 s
+        for _ in range(5):
+            time.sleep(0.03)
+            timer.restart_timer()
+        self.assertEqual(node.elections, 0)
+        time.sleep(0.2)
+        self.assertGreaterEqual(node.elections, 1)
+        timer.stop_timer()
+
+    def test_stop_prevents_election(self):
+        node = FakeNode()
+        timer = Election_Timer(0.05, node)
+        timer.stop_timer()
+        time.sleep(0.2)
+        self.assertEqual(node.elections, 0)
+
+
+class TestHeartbeat(unittest.TestCase):
+    def test_beats_until_stopped(self):
+        node = FakeNode()
+        heartbeat = Heartbeat(0.16, node)  # beats every 0.02 s
+        heartbeat.restart_timer()
+        time.sleep(0.11)
+        heartbeat.stop_timer()
+        beats = node.heartbeats
+        self.assertGreaterEqual(beats, 3)
+        time.sleep(0.06)
+        self.assertEqual(node.heartbeats, beats)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestTimerScheduler('test_fires_in_deadline_order'))
+    suite.addTest(TestTimerScheduler('test_cancelled_timer_does_not_fire'))
+    suite.addTest(TestElectionTimer('test_restart_postpones_election'))
+    suite.addTest(TestElectionTimer('test_stop_prevents_election'))
+    suite.addTest(TestHeartbeat('test_beats_until_stopped'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,320 @@
+import unittest, time, io, contextlib, socket, threading, base64
+from types import SimpleNamespace
+from unittest import mock
+from Messenger import Messenger
+import Transport, Codec
+
+
+class Collector:
+    def __init__(self):
+        self.received = []
+
+    def handle_incoming_message(self, msg: dict):
+        self.received.append(msg)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestLocalTransport(unittest.TestCase):
+    def setUp(self) -> None:
+        self.target = Collector()
+        self.receiver = Messenger('0', self.target, transport='local')
+        self.sender = Messenger('1', Collector(), run=False, transport='local')
+
+    def tearDown(self) -> None:
+        self.receiver.off()
+
+    def test_messages_arrive_in_order(self):
+        for i in range(20):
+            self.sender.send({'messageType': 'test', 'n': str(i)}, '0')
+        wait_for(lambda: len(self.target.received) == 20)
+        self.assertEqual([m['n'] for m in self.target.received], [str(i) for i in range(20)])
+
+    def test_off_stops_delivery(self):
+        target = Collector()
+        receiver = Messenger('2', target, run=False, transport='local')
+        self.sender.send({'messageType': 'test'}, '2')
+        time.sleep(0.3)
+        self.assertEqual(target.received, [])
+        receiver.on()
+        wait_for(lambda: len(target.received) == 1)
+        receiver.off()
+        self.assertEqual(len(target.received), 1)
+
+
+class TestDelivery(unittest.TestCase):
+    def test_bad_message_is_skipped(self):
+        class Picky(Collector):
+            def handle_incoming_message(self, msg: dict):
+                if msg['n'] == 'bad':
+                    raise KeyError('command')
+                super().handle_incoming_message(msg)
+        target = Picky()
+        receiver = Messenger('3', target, run=False, transport='local')
+        old_version = bytearray(Codec.encode({'n': 'old'}))
+        old_version[0] ^= 0xff
+        frames = [Codec.encode({'n': '0'}), bytes(old_version), b'\x00',
+            Codec.encode({'n': 'bad'}), Codec.encode({'n': '1'})]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            receiver.deliver(frames)
+        self.assertEqual([m['n'] for m in target.received], ['0', '1'])
+
+
+class TestSendBatching(unittest.TestCase):
+    count = 0
+
+    def setUp(self) -> None:
+        # local queues outlive a test, so give every test its own endpoint
+        TestSendBatching.count += 1
+        self.endpoint = f'batch-{self.count}'
+        self.target = Collector()
+        self.receiver = Messenger(self.endpoint, self.target, transport='local')
+        self.sender = Messenger('4', Collector(), run=False, transport='local', batch_window=0.05)
+
+    def tearDown(self) -> None:
+        self.receiver.off()
+
+    def test_window_coalesces_in_order(self):
+        batches = []
+        send_batch = self.sender.transport.send_batch
+        self.sender.transport.send_batch = lambda msgs, dest: (batches.append(len(msgs)), send_batch(msgs, dest))
+        for i in range(5):
+            self.sender.send({'n': str(i)}, self.endpoint)
+        wait_for(lambda: len(self.target.received) == 5)
+        self.assertEqual(batches, [5])
+        self.assertEqual([m['n'] for m in self.target.received], [str(i) for i in range(5)])
+
+    def test_flush_sends_immediately(self):
+        self.sender.send({'n': '0'}, self.endpoint)
+        self.sender.send({'n': '1'}, self.endpoint, flush=True)
+        wait_for(lambda: len(self.target.received) == 2, timeout=0.04)
+        self.assertEqual([m['n'] for m in self.target.received], ['0', '1'])
+
+    def test_slow_sends_fan_out_in_parallel(self):
+        sent = []
+        def slow_send_batch(msgs, dest):
+            time.sleep(0.2)
+            sent.append(dest)
+        self.sender.transport.send_batch = slow_send_batch
+        start = time.monotonic()
+        for peer in ['0', '1', '2', '3']:
+            self.sender.send({'n': peer}, peer)
+        wait_for(lambda: len(sent) == 4)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(self.sender.fanout.count, 4)
+
+    def test_split_batch_respects_limits(self):
+        transport = Transport.LocalTransport('split')
+        transport.max_batch_count = 3
+        transport.max_batch_bytes = 10
+        messages = [b'12345'] * 5
+        self.assertEqual([len(c) for c in transport.split_batch(messages)], [2, 2, 1])
+
+
+class TestTCPTransport(unittest.TestCase):
+    def setUp(self) -> None:
+        Transport.tcp_addresses['client-red'] = ('127.0.0.1', 0)
+        self.target = Collector()
+        self.receiver = Messenger('client-red', self.target, run=False, transport='tcp')
+        self.receiver.on()
+        # port 0 asked the OS for a free port, point senders at it
+        Transport.tcp_addresses['client-red'] = self.receiver.transport.listener.getsockname()
+        self.sender = Messenger('leader', Collector(), run=False, transport='tcp')
+
+    def tearDown(self) -> None:
+        self.receiver.off()
+
+    def test_messages_arrive_in_order(self):
+        for i in range(20):
+            self.sender.send({'msg': str(i)}, 'client-red')
+        wait_for(lambda: len(self.target.received) == 20)
+        self.assertEqual([m['msg'] for m in self.target.received], [str(i) for i in range(20)])
+
+    def test_off_then_on_rebinds_the_address(self):
+        self.sender.send({'msg': '0'}, 'client-red', flush=True)
+        wait_for(lambda: len(self.target.received) == 1)
+        self.receiver.off()
+        self.assertEqual(self.receiver.transport.accepted, set())
+        # the connection the sender opened was closed on our side too
+        connection = self.sender.transport.connections['client-red']
+        connection.settimeout(1)
+        self.assertEqual(connection.recv(1), b'')
+        self.receiver.on()  # the same port, so no EADDRINUSE
+        sender = Messenger('leader', Collector(), run=False, transport='tcp')
+        sender.send({'msg': '1'}, 'client-red', flush=True)
+        wait_for(lambda: len(self.target.received) == 2)
+        self.assertEqual([m['msg'] for m in self.target.received], ['0', '1'])
+
+    def test_cached_connection_follows_a_new_leader(self):
+        Transport.tcp_addresses['leader'] = ('127.0.0.1', 0)
+        old_leader = Messenger('leader', Collector(), run=False, transport='tcp')
+        old_leader.on()
+        Transport.tcp_addresses['leader'] = old_leader.transport.listener.getsockname()
+        client = Messenger('client-red', Collector(), run=False, transport='tcp')
+        client.send({'msg': '0'}, 'leader', flush=True)
+        wait_for(lambda: len(old_leader.target.received) == 1)
+        old_leader.off()
+        # another node takes over the leader address, somewhere else
+        Transport.tcp_addresses['leader'] = ('127.0.0.1', 0)
+        new_leader = Messenger('leader', Collector(), run=False, transport='tcp')
+        new_leader.on()
+        Transport.tcp_addresses['leader'] = new_leader.transport.listener.getsockname()
+        try:
+            time.sleep(0.05)  # let the old leader's FIN reach the client
+            client.send({'msg': '1'}, 'leader', flush=True)
+            wait_for(lambda: len(new_leader.target.received) == 1)
+            self.assertEqual([m['msg'] for m in new_leader.target.received], ['1'])
+        finally:
+            new_leader.off()
+
+    def test_unknown_destination_is_reported_and_skipped(self):
+        Transport.tcp_addresses.pop('leader-9', None)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.sender.send({'msg': 'lost'}, 'leader-9')
+            wait_for(lambda: 'leader-9' in output.getvalue())
+            self.sender.send({'msg': '0'}, 'client-red')
+            wait_for(lambda: len(self.target.received) == 1)
+        self.assertIn("Unknown destination 'leader-9', message dropped", output.getvalue())
+        self.assertEqual([m['msg'] for m in self.target.received], ['0'])
+
+
+class TestTCPSends(unittest.TestCase):
+    def setUp(self) -> None:
+        self.timeout = Transport.tcp_send_timeout
+        Transport.tcp_send_timeout = 0.2
+        # accepts connections (in the kernel) but never reads from them
+        self.stalled = socket.socket()
+        self.stalled.bind(('127.0.0.1', 0))
+        self.stalled.listen()
+        Transport.tcp_addresses['client-blue'] = self.stalled.getsockname()
+        self.transport = Transport.TCPTransport('leader')
+
+    def tearDown(self) -> None:
+        Transport.tcp_send_timeout = self.timeout
+        for conn in self.transport.connections.values():
+            conn.close()
+        self.stalled.close()
+
+    def test_stalled_peer_times_out(self):
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.transport.send(b'x' * 64_000_000, 'client-blue')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertNotIn('client-blue', self.transport.connections)
+
+    def test_slow_destination_does_not_hold_up_others(self):
+        receiver = Messenger('client-red', Collector(), run=False, transport='tcp')
+        Transport.tcp_addresses['client-red'] = ('127.0.0.1', 0)
+        receiver.on()
+        Transport.tcp_addresses['client-red'] = receiver.transport.listener.getsockname()
+        slow = threading.Thread(target=self.transport.send, args=(b'x' * 64_000_000, 'client-blue'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            slow.start()
+            time.sleep(0.05)
+            start = time.monotonic()
+            self.transport.send(Codec.encode({'n': '0'}), 'client-red')
+            sent_in = time.monotonic() - start
+            slow.join()
+        receiver.off()
+        self.assertLess(sent_in, 0.1)
+
+class StubSQS:
+    '''stands in for a boto3 SQS client, serving queued bodies in order'''
+    def __init__(self):
+        self.queued = []
+        self.receives = []
+        self.deleted = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        self.receives.append((MaxNumberOfMessages, WaitTimeSeconds))
+        batch, self.queued = self.queued[:MaxNumberOfMessages], self.queued[MaxNumberOfMessages:]
+        if not batch:
+            return {}
+        return {'Messages': [{'Body': body, 'ReceiptHandle': handle} for handle, body in batch]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.append([entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append([ReceiptHandle])
+
+
+class TestSQSTransport(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sqs = StubSQS()
+        # boto3 need not be installed, the transport only calls boto3.client
+        patcher = mock.patch.object(Transport, 'boto3', SimpleNamespace(client=lambda name: self.sqs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = Transport.SQSTransport('0')
+
+    def queue(self, count: int, start: int = 0):
+        for i in range(start, start + count):
+            body = base64.b64encode(Codec.encode({'n': str(i)})).decode()
+            self.sqs.queued.append((f'handle-{i}', body))
+
+    def test_batch_is_capped_at_max_messages(self):
+        self.queue(Transport.sqs_max_messages + 3)
+        first = self.transport.receive()
+        second = self.transport.receive()
+        self.assertEqual([Codec.decode(m)['n'] for m in first], [str(i) for i in range(Transport.sqs_max_messages)])
+        self.assertEqual([Codec.decode(m)['n'] for m in second], ['10', '11', '12'])
+        self.assertEqual(self.sqs.receives, [(Transport.sqs_max_messages, Transport.sqs_wait_seconds)] * 2)
+
+    def test_deletes_only_received_handles(self):
+        self.queue(4)
+        self.transport.receive()
+        self.assertEqual(self.sqs.deleted, [[f'handle-{i}' for i in range(4)]])
+        self.queue(2, start=4)
+        self.transport.receive()
+        self.transport.receive()  # empty, nothing to delete
+        self.assertEqual(self.sqs.deleted, [[f'handle-{i}' for i in range(4)], ['handle-4', 'handle-5']])
+
+    def test_poll_stats_count_polls_and_messages(self):
+        self.queue(Transport.sqs_max_messages + 2)
+        for _ in range(3):
+            self.transport.receive()
+        stats = self.transport.poll_stats
+        self.assertEqual((stats.requests, stats.messages, stats.empty_polls), (3, Transport.sqs_max_messages + 2, 1))
+        self.assertAlmostEqual(stats.empty_poll_ratio(), 1 / 3)
+
+    def test_single_message_poll(self):
+        self.transport.batch_receive = False
+        self.queue(2)
+        self.assertEqual([Codec.decode(m)['n'] for m in self.transport.receive()], ['0'])
+        self.assertEqual(self.sqs.receives, [(1, 0)])
+        self.assertEqual(self.sqs.deleted, [['handle-0']])
+        self.assertEqual(self.transport.poll_stats.messages, 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestLocalTransport('test_messages_arrive_in_order'))
+    suite.addTest(TestLocalTransport('test_off_stops_delivery'))
+    suite.addTest(TestDelivery('test_bad_message_is_skipped'))
+    suite.addTest(TestSendBatching('test_window_coalesces_in_order'))
+    suite.addTest(TestSendBatching('test_flush_sends_immediately'))
+    suite.addTest(TestSendBatching('test_slow_sends_fan_out_in_parallel'))
+    suite.addTest(TestSendBatching('test_split_batch_respects_limits'))
+    suite.addTest(TestTCPTransport('test_messages_arrive_in_order'))
+    suite.addTest(TestTCPTransport('test_off_then_on_rebinds_the_address'))
+    suite.addTest(TestTCPTransport('test_cached_connection_follows_a_new_leader'))
+    suite.addTest(TestTCPTransport('test_unknown_destination_is_reported_and_skipped'))
+    suite.addTest(TestTCPSends('test_stalled_peer_times_out'))
+    suite.addTest(TestTCPSends('test_slow_destination_does_not_hold_up_others'))
+    suite.addTest(TestSQSTransport('test_batch_is_capped_at_max_messages'))
+    suite.addTest(TestSQSTransport('test_deletes_only_received_handles'))
+    suite.addTest(TestSQSTransport('test_poll_stats_count_polls_and_messages'))
+    suite.addTest(TestSQSTransport('test_single_message_poll'))
+    return suite
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
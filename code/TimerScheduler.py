@@ -0,0 +1,153 @@
+from time import monotonic
+from threading import Thread, Condition, Lock
+from AsyncRuntime import use_asyncio, shared_loop, on_loop, call_soon
+import heapq, itertools, traceback
+
+class TimerHandle:
+	'''A scheduled callback. cancel() stops it from firing if it has not yet.'''
+
+	def __init__(self, deadline: float, callback, scheduler):
+		self.deadline = deadline
+		self.callback = callback
+		self.scheduler = scheduler
+		self.cancelled = False
+
+	def cancel(self):
+		with self.scheduler.ready:
+			if not self.cancelled:
+				self.cancelled = True
+				self.scheduler.cancelled_count += 1
+
+
+class JitterStats:
+	'''How late timers fired compared to their deadline, in seconds'''
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, lateness: float):
+		self.count += 1
+		self.total += lateness
+		self.max = max(self.max, lateness)
+
+	def mean(self) -> float:
+		return self.total / self.count if self.count else 0.0
+
+	def __str__(self):
+		return f'{self.count} fired, mean {self.mean()*1000:.2f} ms late, max {self.max*1000:.2f} ms'
+
+
+class TimerScheduler:
+	'''
+	One thread serving every timer in the process. Deadlines sit in a heap
+	ordered by time.monotonic(); the thread sleeps on a condition variable
+	until the earliest one is due, so nothing runs while no timer is due.
+	Callbacks run on the scheduler thread and should return quickly.
+
+	methods:
+		schedule(delay, callback) -> TimerHandle : run callback after delay seconds
+		jitter : JitterStats for every timer fired so far
+	'''
+
+	def __init__(self):
+		self.heap = []
+		self.sequence = itertools.count()  # breaks ties between equal deadlines
+		self.ready = Condition()
+		self.cancelled_count = 0
+		self.jitter = JitterStats()
+		Thread(
+			target=self.run,
+			name='Timer Scheduler Thread',
+			daemon=True
+			).start()
+
+	def schedule(self, delay: float, callback) -> TimerHandle:
+		handle = TimerHandle(monotonic() + delay, callback, self)
+		with self.ready:
+			heapq.heappush(self.heap, (handle.deadline, next(self.sequence), handle))
+			if self.heap[0][2] is handle:  # new earliest deadline, wake the thread
+				self.ready.notify()
+			# cancelled timers are left in the heap, prune them now and then
+			if self.cancelled_count > 64 and self.cancelled_count > len(self.heap) // 2:
+				self.heap = [item for item in self.heap if not item[2].cancelled]
+				heapq.heapify(self.heap)
+				self.cancelled_count = 0
+		return handle
+
+	def next_due(self) -> TimerHandle:
+		with self.ready:
+			while True:
+				while self.heap and self.heap[0][2].cancelled:
+					heapq.heappop(self.heap)
+					self.cancelled_count -= 1
+				if not self.heap:
+					self.ready.wait()
+					continue
+				delay = self.heap[0][0] - monotonic()
+				if delay <= 0:
+					return heapq.heappop(self.heap)[2]
+				self.ready.wait(delay)
+
+	def run(self):
+		while True:
+			handle = self.next_due()
+			self.jitter.record(monotonic() - handle.deadline)
+			try:
+				handle.callback()
+			except Exception:
+				traceback.print_exc()
+
+
+class AsyncioScheduler:
+	'''
+	TimerScheduler for the asyncio runtime (see AsyncRuntime.py): every
+	timer is a call_at() on the runtime's loop, which keeps the deadline
+	heap itself, and callbacks run on the loop. The loop's clock is
+	time.monotonic(), so deadlines mean the same as with TimerScheduler.
+
+	methods:
+		schedule(delay, callback) -> TimerHandle : run callback after delay seconds
+		jitter : JitterStats for every timer fired so far
+	'''
+
+	def __init__(self):
+		self.loop = shared_loop()
+		self.ready = Lock()  # guards cancelled_count for TimerHandle.cancel()
+		self.cancelled_count = 0
+		self.jitter = JitterStats()
+
+	def schedule(self, delay: float, callback) -> TimerHandle:
+		handle = TimerHandle(monotonic() + delay, callback, self)
+		if on_loop():
+			self.arm(handle)
+		else:
+			call_soon(self.arm, handle)
+		return handle
+
+	def arm(self, handle: TimerHandle):
+		self.loop.call_at(handle.deadline, self.fire, handle)
+
+	def fire(self, handle: TimerHandle):
+		if handle.cancelled:
+			with self.ready:
+				self.cancelled_count -= 1
+			return
+		self.jitter.record(monotonic() - handle.deadline)
+		try:
+			handle.callback()
+		except Exception:
+			traceback.print_exc()
+
+
+scheduler = None
+scheduler_lock = Lock()
+
+def shared_scheduler():
+	'''the process-wide scheduler, started on first use'''
+	global scheduler
+	with scheduler_lock:
+		if scheduler is None:
+			scheduler = AsyncioScheduler() if use_asyncio() else TimerScheduler()
+		return scheduler
@@ -0,0 +1,587 @@
+from threading import Thread, Lock
+from queue import Queue, Empty
+from AsyncRuntime import call_soon, to_thread
+import socket, select, struct, base64, json, time, os, asyncio
+
+try:
+	import boto3, botocore
+except ImportError:  # only the SQS backend needs the AWS SDK
+	boto3 = None
+
+node_names = ['0', '1', '2', '3', '4', 'leader', 'client-blue', 'client-red']
+
+message_queue_URLs = {
+	'0': 'https://sqs.us-east-1.amazonaws.com/622058021374/0.fifo',
+	'1': 'https://sqs.us-east-1.amazonaws.com/622058021374/1.fifo',
+	'2': 'https://sqs.us-east-1.amazonaws.com/622058021374/2.fifo',
+	'3': 'https://sqs.us-east-1.amazonaws.com/622058021374/3.fifo',
+	'4': 'https://sqs.us-east-1.amazonaws.com/622058021374/4.fifo',
+	'leader': 'https://sqs.us-east-1.amazonaws.com/622058021374/leader.fifo',
+	'client-blue': 'https://sqs.us-east-1.amazonaws.com/622058021374/client-blue.fifo',
+	'client-red': 'https://sqs.us-east-1.amazonaws.com/622058021374/client-red.fifo'
+	}
+
+tcp_addresses = {name: ('127.0.0.1', 5100 + i) for i, name in enumerate(node_names)}
+
+# seconds a TCP connect or one batch's send may take before the peer is
+# treated as unreachable, so a dead or stalled peer cannot hold up a sender
+tcp_send_timeout = 1.0
+
+# how long a receive() call may block before handing control back to the
+# Messenger loop (so on/off changes are noticed)
+receive_wait = 0.1
+
+# most messages one local or TCP receive() returns, so a backlog reaches the
+# Messenger's target in slices it can push back on (see Messenger.wait_for_room)
+receive_limit = 256
+
+# SQS long polling: seconds a receive call waits for messages (0-20) and how
+# many messages one call may return (1-10)
+sqs_wait_seconds = 2
+sqs_max_messages = 10
+
+
+def load_endpoints(path: str):
+	'''
+	Override the endpoint tables from a JSON file of the form
+	{"sqs": {"0": "https://..."}, "tcp": {"0": "host:port"}}.
+	Either section may be left out.
+	'''
+	with open(path, 'r') as config_file:
+		config = json.load(config_file)
+	message_queue_URLs.update(config.get('sqs', {}))
+	for name, address in config.get('tcp', {}).items():
+		host, port = address.rsplit(':', 1)
+		tcp_addresses[name] = (host, int(port))
+
+
+def make_transport(id: str, kind: str = None):
+	'''
+	Build a transport backend for endpoint id by name: 'sqs' (default), 'local' or 'tcp'.
+	If no name is given the RAFT_TRANSPORT environment variable is used, and
+	RAFT_ENDPOINTS may point at a JSON endpoint file (see load_endpoints).
+	'''
+	if kind is None:
+		kind = os.environ.get('RAFT_TRANSPORT', 'sqs')
+		if os.environ.get('RAFT_ENDPOINTS'):
+			load_endpoints(os.environ['RAFT_ENDPOINTS'])
+	if kind == 'sqs':
+		return SQSTransport(id)
+	elif kind == 'local':
+		return LocalTransport(id)
+	elif kind == 'tcp':
+		return TCPTransport(id)
+	raise ValueError(f'unknown transport: {kind}')
+
+
+class PollStats:
+	'''Counts receive calls and the messages they returned'''
+
+	def __init__(self):
+		self.requests = 0
+		self.messages = 0
+		self.empty_polls = 0
+
+	def record(self, count: int):
+		self.requests += 1
+		self.messages += count
+		if count == 0:
+			self.empty_polls += 1
+
+	def messages_per_request(self) -> float:
+		return self.messages / self.requests if self.requests else 0.0
+
+	def empty_poll_ratio(self) -> float:
+		return self.empty_polls / self.requests if self.requests else 0.0
+
+	def __str__(self):
+		return (f'{self.requests} polls, {self.messages} messages, '
+			f'{self.messages_per_request():.2f} msgs/poll, '
+			f'{self.empty_poll_ratio():.1%} empty')
+
+
+class Transport:
+	'''
+	Interface between Messenger and the network. A transport moves encoded
+	messages (bytes, see Codec.py) between the endpoints named in node_names,
+	on behalf of the endpoint id it was built for.
+
+	methods:
+		open() : start accepting messages addressed to id
+		close() : stop accepting messages
+		send(message: bytes, destination: str) : deliver a message
+		send_batch(messages: list, destination: str) : deliver several
+			messages in order, split to fit max_batch_count/max_batch_bytes
+		receive() -> list : messages received since last call, in order.
+			Blocks for at most a short wait and may return an empty list.
+
+	coroutines, for the asyncio runtime (see AsyncRuntime.py):
+		open_async(), close_async() : as open() and close()
+		send_batch_async(messages: list, destination: str) : as send_batch()
+		receive_async() -> list : waits until at least one message arrived
+	A backend without a native version runs the blocking call on the
+	runtime's executor.
+	'''
+
+	# limits on a single batch sent with send_chunk(), None means unlimited
+	max_batch_count = None
+	max_batch_bytes = None
+
+	def __init__(self, id: str):
+		self.id = id
+		self.poll_stats = PollStats()
+		self.pending_receive = None
+
+	def open(self):
+		pass
+
+	def close(self):
+		pass
+
+	def send(self, message: bytes, destination: str):
+		raise NotImplementedError
+
+	def send_batch(self, messages: list, destination: str):
+		for chunk in self.split_batch(messages):
+			self.send_chunk(chunk, destination)
+
+	def send_chunk(self, messages: list, destination: str):
+		for message in messages:
+			self.send(message, destination)
+
+	def message_size(self, message: bytes) -> int:
+		return len(message)
+
+	def split_batch(self, messages: list):
+		'''yield consecutive runs of messages that fit in one batch'''
+		chunk, chunk_bytes = [], 0
+		for message in messages:
+			size = self.message_size(message) if self.max_batch_bytes else 0
+			if chunk and (
+					(self.max_batch_count and len(chunk) == self.max_batch_count)
+					or (self.max_batch_bytes and chunk_bytes + size > self.max_batch_bytes)):
+				yield chunk
+				chunk, chunk_bytes = [], 0
+			chunk.append(message)
+			chunk_bytes += size
+		if chunk:
+			yield chunk
+
+	def receive(self) -> list:
+		raise NotImplementedError
+
+	async def open_async(self):
+		self.open()
+
+	async def close_async(self):
+		self.close()
+
+	async def send_batch_async(self, messages: list, destination: str):
+		await to_thread(self.send_batch, messages, destination)
+
+	async def receive_async(self) -> list:
+		while True:
+			# a receive cut short by close is picked up by the next call,
+			# since whatever it returns is already off the queue
+			if self.pending_receive is None:
+				self.pending_receive = asyncio.ensure_future(to_thread(self.receive))
+			messages = await asyncio.shield(self.pending_receive)
+			self.pending_receive = None
+			if messages:
+				return messages
+
+
+class SQSTransport(Transport):
+	'''
+	Amazon SQS FIFO queues, one per endpoint, listed in message_queue_URLs.
+	By default receive() long-polls for up to sqs_max_messages at a time and
+	deletes them with a single batch call. batch_receive=False restores the
+	old one-message short poll. Batches are sent with send_message_batch,
+	which takes at most 10 messages and 256 KiB per call. SQS bodies must be
+	text, so encoded messages are carried base64 encoded.
+	'''
+
+	max_batch_count = 10
+	max_batch_bytes = 256 * 1024
+
+	def __init__(self, id: str, batch_receive: bool = True):
+		if boto3 is None:
+			raise ImportError('the SQS transport requires boto3: pip install boto3')
+		super().__init__(id)
+		self.sqs = boto3.client('sqs') # make a new SQS object
+		self.incoming_queue_URL = message_queue_URLs[id] # store URL of queue for self
+		self.msg_count = 0
+		self.batch_receive = batch_receive
+
+	def receive(self) -> list:
+		if self.batch_receive:
+			return self.receive_batch()
+		# response stores results of receive call from SQS
+		response = self.sqs.receive_message(
+			QueueUrl=self.incoming_queue_URL,
+			MaxNumberOfMessages=1,
+			WaitTimeSeconds=0
+		)
+
+		# check if a message was received. if no message, try again
+		if 'Messages' not in response:
+			self.poll_stats.record(0)
+			return []
+		self.poll_stats.record(1)
+		message = response['Messages'][0]['Body']
+
+		# this receipt handle is required to delete the  message from queue
+		receipt_handle = response['Messages'][0]['ReceiptHandle']
+		# delete the message after receiving
+		try:
+			self.sqs.delete_message(
+				QueueUrl=self.incoming_queue_URL,
+				ReceiptHandle=receipt_handle
+			)
+		except botocore.exceptions.ClientError:
+			print("Receipt Handle Expired")
+		return [base64.b64decode(message)]
+
+	def receive_batch(self) -> list:
+		'''long-poll for several messages, then acknowledge them in one call'''
+		response = self.sqs.receive_message(
+			QueueUrl=self.incoming_queue_URL,
+			MaxNumberOfMessages=sqs_max_messages,
+			WaitTimeSeconds=sqs_wait_seconds
+		)
+		received = response.get('Messages', [])
+		self.poll_stats.record(len(received))
+		if not received:
+			return []
+
+		# FIFO queues hand back a batch in send order
+		try:
+			result = self.sqs.delete_message_batch(
+				QueueUrl=self.incoming_queue_URL,
+				Entries=[
+					{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+					for i, message in enumerate(received)
+				]
+			)
+			for failure in result.get('Failed', []):
+				print("Could not delete message: ", failure.get('Message', failure['Code']))
+		except botocore.exceptions.ClientError:
+			print("Receipt Handle Expired")
+		return [base64.b64decode(message['Body']) for message in received]
+
+	def deduplication_id(self) -> str:
+		# identical messages (e.g. two empty heartbeats) are still distinct
+		# sends, so content-based deduplication must not drop them
+		self.msg_count += 1
+		return '{}.{}.{}'.format(self.id, self.msg_count, time.time_ns())
+
+	def message_size(self, message: bytes) -> int:
+		return 4 * ((len(message) + 2) // 3)  # base64 length
+
+	def send_chunk(self, messages: list, destination: str):
+		if len(messages) == 1:
+			self.send(messages[0], destination)
+			return
+		response = self.sqs.send_message_batch(
+			QueueUrl=message_queue_URLs[destination],
+			Entries=[
+				{
+					'Id': str(i),
+					'MessageGroupId': 'queue',
+					'MessageDeduplicationId': self.deduplication_id(),
+					'MessageBody': base64.b64encode(message).decode()
+				}
+				for i, message in enumerate(messages)
+			]
+		)
+		for failure in response.get('Failed', []):
+			print("Could not send message: ", failure.get('Message', failure['Code']))
+
+	def send(self, message: bytes, destination: str):
+		# response stores confirmation data from SQS
+		response = self.sqs.send_message(
+			QueueUrl=message_queue_URLs[destination],
+			MessageGroupId='queue',
+			MessageDeduplicationId=self.deduplication_id(),
+			MessageBody=base64.b64encode(message).decode()
+		)
+
+
+def take_all(incoming: Queue, messages: list = None) -> list:
+	'''add what is already queued to messages, up to receive_limit in all'''
+	messages = [] if messages is None else messages
+	while len(messages) < receive_limit:
+		try:
+			messages.append(incoming.get_nowait())
+		except Empty:
+			break
+	return messages
+
+
+def drain_queue(incoming: Queue) -> list:
+	'''wait briefly for one message, then take what else is already queued'''
+	try:
+		messages = [incoming.get(timeout=receive_wait)]
+	except Empty:
+		return []
+	return take_all(incoming, messages)
+
+
+# endpoint id -> Queue, shared by every LocalTransport in the process
+local_queues = {}
+local_queues_lock = Lock()
+# endpoint id -> asyncio.Event set when a message is put in its Queue
+local_arrivals = {}
+
+def local_queue(id: str) -> Queue:
+	with local_queues_lock:
+		if id not in local_queues:
+			local_queues[id] = Queue()
+		return local_queues[id]
+
+
+class LocalTransport(Transport):
+	'''
+	In-process queues. Every node and client must live in the same process,
+	which makes this backend useful for tests and benchmarks.
+	'''
+
+	def __init__(self, id: str):
+		super().__init__(id)
+		self.incoming = local_queue(id)
+
+	def send(self, message: bytes, destination: str):
+		local_queue(destination).put(message)
+		arrived = local_arrivals.get(destination)
+		if arrived is not None:
+			call_soon(arrived.set)
+
+	def receive(self) -> list:
+		messages = drain_queue(self.incoming)
+		self.poll_stats.record(len(messages))
+		return messages
+
+	async def send_batch_async(self, messages: list, destination: str):
+		self.send_batch(messages, destination)  # a put never blocks
+
+	async def receive_async(self) -> list:
+		arrived = local_arrivals.setdefault(self.id, asyncio.Event())
+		while True:
+			arrived.clear()
+			messages = take_all(self.incoming)
+			if messages:
+				self.poll_stats.record(len(messages))
+				return messages
+			await arrived.wait()
+
+
+class TCPTransport(Transport):
+	'''
+	Length-prefixed frames over persistent TCP connections. Each endpoint
+	listens on its address in tcp_addresses; outgoing connections are opened
+	on first use and kept for later sends. On the asyncio runtime the same
+	frames travel over asyncio streams, with no accept or read threads.
+	'''
+
+	header = struct.Struct('!I')
+
+	def __init__(self, id: str):
+		super().__init__(id)
+		self.incoming = Queue()
+		self.listener = None
+		self.accepted = set()  # connections peers opened to us, closed with the listener
+		self.accepted_lock = Lock()
+		self.connections = {}
+		self.send_locks = {}  # one per destination, a slow peer only holds up its own sends
+		self.send_locks_lock = Lock()
+		# asyncio runtime
+		self.server = None
+		self.arrivals = asyncio.Queue()
+		self.writers = {}
+		self.readers = {}  # the other half of each writer, only read to notice the peer closing
+		self.accepted_writers = set()
+
+	def open(self):
+		if self.listener is not None:
+			return
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(tcp_addresses[self.id])
+		self.listener.listen()
+		Thread(
+			target=self.accept_connections,
+			args=(self.listener,),
+			name='TCP Accept Thread'+self.id,
+			daemon=True
+			).start()
+
+	def close(self):
+		'''
+		Stop listening and drop the connections peers opened to us, so they
+		reconnect to whoever binds the address next (e.g. the new leader)
+		'''
+		with self.accepted_lock:
+			listener, self.listener = self.listener, None
+			accepted, self.accepted = self.accepted, set()
+		if listener is not None:
+			try:
+				listener.shutdown(socket.SHUT_RDWR)  # wakes the thread blocked in accept()
+			except OSError:
+				pass
+			listener.close()
+		for conn in accepted:
+			try:
+				conn.shutdown(socket.SHUT_RDWR)  # wakes its read thread, which closes it
+			except OSError:
+				pass
+
+	def accept_connections(self, listener: socket.socket):
+		while True:
+			try:
+				conn, _ = listener.accept()
+			except OSError:  # listener closed
+				return
+			with self.accepted_lock:
+				if self.listener is not listener:  # closed while accepting
+					conn.close()
+					return
+				self.accepted.add(conn)
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			Thread(
+				target=self.read_frames,
+				args=(conn,),
+				name='TCP Read Thread'+self.id,
+				daemon=True
+				).start()
+
+	def read_exactly(self, conn: socket.socket, size: int) -> bytes:
+		data = b''
+		while len(data) < size:
+			chunk = conn.recv(size - len(data))
+			if not chunk:
+				raise ConnectionError('connection closed')
+			data += chunk
+		return data
+
+	def read_frames(self, conn: socket.socket):
+		with conn:
+			try:
+				while True:
+					length, = self.header.unpack(self.read_exactly(conn, self.header.size))
+					self.incoming.put(self.read_exactly(conn, length))
+			except (ConnectionError, OSError):
+				pass
+			with self.accepted_lock:
+				self.accepted.discard(conn)
+
+	def peer_closed(self, conn: socket.socket) -> bool:
+		'''
+		True if the peer has closed conn, e.g. the old leader when it let go
+		of the leader address. Writes to such a socket still succeed, and the
+		data is lost, so a cached connection is checked before every send.
+		Peers never write back, so a readable socket means EOF or an error.
+		'''
+		try:
+			readable, _, _ = select.select([conn], [], [], 0)
+			return bool(readable) and conn.recv(1, socket.MSG_PEEK) == b''
+		except (OSError, ValueError):  # reset, or already closed
+			return True
+
+	def connect(self, destination: str) -> socket.socket:
+		conn = socket.create_connection(tcp_addresses[destination], timeout=tcp_send_timeout)
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return conn
+
+	def frame(self, message: bytes) -> bytes:
+		return self.header.pack(len(message)) + message
+
+	def send(self, message: bytes, destination: str):
+		self.send_frames(self.frame(message), destination)
+
+	def send_chunk(self, messages: list, destination: str):
+		self.send_frames(b''.join(self.frame(message) for message in messages), destination)
+
+	def send_lock(self, destination: str) -> Lock:
+		with self.send_locks_lock:
+			return self.send_locks.setdefault(destination, Lock())
+
+	def send_frames(self, frames: bytes, destination: str):
+		with self.send_lock(destination):
+			# one retry on a fresh connection in case the old one went stale
+			for attempt in range(2):
+				conn = self.connections.get(destination)
+				if conn is not None and self.peer_closed(conn):
+					conn.close()
+					conn = None
+				try:
+					if conn is None:
+						conn = self.connect(destination)
+						self.connections[destination] = conn
+					conn.sendall(frames)
+					return
+				except OSError:  # including a timeout, which may leave half a frame behind
+					if conn is not None:
+						conn.close()
+					self.connections.pop(destination, None)
+			print(f'Could not reach {destination}, message dropped')
+
+	def receive(self) -> list:
+		messages = drain_queue(self.incoming)
+		self.poll_stats.record(len(messages))
+		return messages
+
+	async def open_async(self):
+		if self.server is None:
+			host, port = tcp_addresses[self.id]
+			self.server = await asyncio.start_server(self.read_stream, host, port)
+
+	async def close_async(self):
+		if self.server is not None:
+			self.server.close()
+			self.server = None
+		for writer in self.accepted_writers:
+			writer.close()
+		self.accepted_writers = set()
+
+	async def read_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.accepted_writers.add(writer)
+		try:
+			while True:
+				length, = self.header.unpack(await reader.readexactly(self.header.size))
+				self.arrivals.put_nowait(await reader.readexactly(length))
+		except (asyncio.IncompleteReadError, OSError):
+			pass
+		self.accepted_writers.discard(writer)
+		writer.close()
+
+	async def send_batch_async(self, messages: list, destination: str):
+		frames = b''.join(self.frame(message) for message in messages)
+		# one retry on a fresh connection in case the old one went stale
+		for attempt in range(2):
+			writer = self.writers.get(destination)
+			if writer is not None and self.readers[destination].at_eof():  # see peer_closed()
+				writer.close()
+				writer = None
+			try:
+				if writer is None:
+					host, port = tcp_addresses[destination]
+					reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), tcp_send_timeout)
+					writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+					self.writers[destination] = writer
+					self.readers[destination] = reader
+				writer.write(frames)
+				await asyncio.wait_for(writer.drain(), tcp_send_timeout)
+				return
+			except OSError:  # including a timeout
+				if writer is not None:
+					writer.close()
+				self.writers.pop(destination, None)
+		print(f'Could not reach {destination}, message dropped')
+
+	async def receive_async(self) -> list:
+		messages = [await self.arrivals.get()]
+		while not self.arrivals.empty() and len(messages) < receive_limit:
+			messages.append(self.arrivals.get_nowait())
+		self.poll_stats.record(len(messages))
+		return messages
@@ -6,8 +6,8 @@ class UI:
     """
     UI that runs game on client side and passes through appropriate messages.
     """
-    def __init__(self, color):
-        self.robot = Robot(color, self)
+    def __init__(self, color, match: int = 0):
+        self.robot = Robot(color, self, match)
         self.running_game = True
         self.color = color
         #self.server = Server('leader')
@@ -67,5 +67,6 @@ red = '''
 
 if __name__ == '__main__':
     color = sys.argv[1]
-    ui = UI(color)
+    match = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    ui = UI(color, match)
     ui.start()
@@ -1,5 +1,6 @@
-import threading
 from Messenger import Messenger
+from Command import Command, client_endpoint, group_of, leader_endpoint, group_count
+from TimerScheduler import shared_scheduler
 from server_logic import Server
 
 
@@ -21,21 +22,29 @@ class Robot:
     :var game_state: Overall robot state in game (won, lost, blocked, failed, exit)
     :var blocked: Boolean to check whether robot is blocked from punching (True) or not (False)
     :var timer: Timer to set when robot is blocked from punching
+    :var match: id of the match this robot plays in
+    :var client: 'client-red' or 'client-blue'
     :var _id: messenger queue id
+    :var leader: queue of the leader of the Raft group carrying this match
     :var messenger: Handles incoming messages and sends messages.
     """
-    def __init__(self, color, ui):
+    def __init__(self, color, ui, match: int = 0):
         """
         Robot constructor.
         Starts a listener for its own thread.
         :param color: identifies which robot is being used.
+        :param match: match to play in; match 0 uses the plain client queues
         """
         self.color = color
         self.action_state = ''
         self.game_state = ''
         self.blocked = False
         self.timer = None
-        self._id = 'client-' + self.color
+        self.seq = 0  # numbers this robot's commands
+        self.match = match
+        self.client = 'client-' + self.color
+        self._id = client_endpoint(self.client, self.match)
+        self.leader = leader_endpoint(group_of(self.match, group_count()))
         self.messenger = Messenger(self._id, self)
         self.ui = ui
 
@@ -88,14 +97,11 @@ class Robot:
     def start_timer_secs(self, seconds):
         """
         Set timer for n seconds.
-        Starts a thread that sleeps until time is over.
-        Once it wakes up, it calls the function to perform.
+        The shared timer scheduler calls the function to perform once time is over.
         :param seconds: Number of seconds timer should run.
         :return:
         """
-        new_timer = threading.Timer(seconds, self.timer_action)
-        new_timer.start()
-        self.timer = new_timer
+        self.timer = shared_scheduler().schedule(seconds, self.timer_action)
 
     def stop_game(self):
         """
@@ -165,11 +171,13 @@ class Robot:
 
     def send_to_leader(self):
         """
-        Send message to server, i.e., leader queue.
+        Send message to server, i.e., the leader queue of this match's group.
         :return:
         """
-        msg_dictionary = {'_id': self._id, 'state': self.action_state}
-        self.messenger.send(msg_dictionary, "leader")
+        self.seq += 1
+        command = Command(self.client, self.action_state, self.seq, self.match)
+        msg_dictionary = {'messageType': 'ClientCommand', 'command': command.encode()}
+        self.messenger.send(msg_dictionary, self.leader)
 
 winMessage = ''' 
  /$$     /$$ /$$$$$$  /$$   /$$
@@ -2,9 +2,106 @@ import sys
 sys.path.append('..')
 from Messenger import Messenger
 from ConsensusModule import *
-from threading import Thread
-from time import sleep
-import random
+from Command import client_endpoint, leader_endpoint, group_count
+from AsyncRuntime import use_asyncio, spawn, to_thread
+from threading import Thread, Lock, Event
+from time import monotonic
+import random, traceback
+
+# seconds between status file updates while nothing is committed
+status_interval = 0.3
+
+
+class ApplyStats:
+    """
+    Apply loop metrics: lag is how many committed entries were waiting
+    (commitIndex - lastApplied) when a batch started, latency how long
+    the batch took to apply.
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.entries = 0
+        self.max_lag = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, lag: int, latency: float):
+        self.batches += 1
+        self.entries += lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def mean_lag(self) -> float:
+        return self.entries / self.batches if self.batches else 0.0
+
+    def mean_latency(self) -> float:
+        return self.total_latency / self.batches if self.batches else 0.0
+
+    def __str__(self):
+        return (f'{self.batches} batches, lag mean {self.mean_lag():.1f} max {self.max_lag}, '
+            f'latency mean {self.mean_latency()*1000:.2f} ms max {self.max_latency*1000:.2f} ms')
+
+
+class Match:
+    """
+    One game between a red and a blue robot: its ServerLogic, game state
+    and the queues its robots listen on.
+    """
+
+    def __init__(self, match_id: int, consensus_module):
+        self.id = match_id
+        self.server_logic = ServerLogic(consensus_module)
+        self.game_state = ''
+
+    def endpoint(self, client: str) -> str:
+        """queue of a robot in this match; match 0 uses the plain client queues"""
+        return client_endpoint(client, self.id)
+
+    def state(self) -> dict:
+        return {
+            'blue_status': self.server_logic.blue_status,
+            'red_status': self.server_logic.red_status,
+            'game_state': self.game_state
+        }
+
+    def restore(self, state: dict):
+        self.server_logic.set_blue_status(state['blue_status'])
+        self.server_logic.set_red_status(state['red_status'])
+        self.game_state = state['game_state']
+
+
+class MatchRegistry:
+    """
+    Live matches by match id. A match starts with its first command and is
+    dropped once a robot exits, so lookups stay O(1) however many games the
+    log is carrying.
+    """
+
+    def __init__(self, consensus_module):
+        self.cm = consensus_module
+        self.matches = {}
+
+    def __len__(self):
+        return len(self.matches)
+
+    def get(self, match_id: int) -> Match:
+        match = self.matches.get(match_id)
+        if match is None:
+            match = self.matches[match_id] = Match(match_id, self.cm)
+        return match
+
+    def end(self, match_id: int):
+        self.matches.pop(match_id, None)
+
+    def state(self) -> dict:
+        return {str(match_id): match.state() for match_id, match in self.matches.items()}
+
+    def restore(self, state: dict):
+        self.matches = {}
+        for match_id, match_state in state.items():
+            self.get(int(match_id)).restore(match_state)
 
 
 class Server:
@@ -14,95 +111,255 @@ class Server:
     This is running on every node and keeps track of overall game status.
     """
 
-    def __init__(self, nodeID):
+    def __init__(self, nodeID, snapshot_every: int = 1000, group: int = 0, node=None):
+        """
+        :param snapshot_every: snapshot the game state and compact the log
+            once this many entries have been applied since the last snapshot
+        :param group: Raft group whose matches this server plays, see RaftNode
+        :param node: RaftNode hosting the group, None for a single-group node
+        """
         self.id = nodeID
-        self.messenger = Messenger(id='leader', target=self, run=False)
-        self.game_state = ''
+        self.group = group
+        self.messenger = Messenger(id=leader_endpoint(group), target=self, run=False)
         self.log = ''
-        self.cm = ConsensusModule(id=self.id, peer_count=5, server=self)  # ConsensusModule() set to "leader" for testing purposes
-        self.server_logic = ServerLogic(self.cm)
+        self.cm = ConsensusModule(id=self.id, peer_count=5, server=self, group=group, node=node)
+        self.matches = MatchRegistry(self.cm)
         self.lastApplied = 0
+        self.snapshot_every = snapshot_every
+        self.apply_lock = Lock()
+        self.apply_stats = ApplyStats()
+        self.returned = []  # commands waiting for a leader, see return_client_command
+        self.running = True  # cleared by stop()
+        if self.cm.snapshot is not None:
+            self.restore_snapshot(self.cm.snapshot)
 
-        self.log_checker = Thread(
-            target=self.check_for_committed_commands,
-            name='Server: Check for new log entries to apply',
-            daemon=True
-        ).start()
+        if use_asyncio():
+            self.log_checker = spawn(self.check_for_committed_commands_async())
+        else:
+            self.log_checker = Thread(
+                target=self.check_for_committed_commands,
+                name=f'Server: Check for new log entries to apply{group}',
+                daemon=True
+            )
+            self.log_checker.start()
 
     def turn_on_leader_queue(self):
         self.messenger.on()
+        self.release_returned_commands()
 
     def turn_off_leader_queue(self):
         self.messenger.off()
 
     def check_for_committed_commands(self):
-        print_count = 0
-        while True:
-            print_count += 1
-            if self.lastApplied < self.cm.commitIndex:
-                self.lastApplied += 1
-                command = self.cm.get_command(self.lastApplied)
-                self.update_status(command)
-                self.check_game_status()
-            if print_count > 5:
-                self.cm.simulation_print()
-                print_count = 0
-            sleep(0.05)
+        """
+        Apply loop: sleeps until the consensus module commits something, then
+        applies every entry up to commitIndex in one pass.
+        """
+        last_print = monotonic()
+        while self.running:
+            commit_index = self.cm.wait_for_commit(self.lastApplied, timeout=status_interval)
+            self.apply_committed(commit_index)
+            if monotonic() - last_print >= status_interval:
+                try:
+                    self.cm.simulation_print()  # only reads, so it stays off the event loop
+                except Exception:  # a status file is not worth the apply loop
+                    traceback.print_exc()
+                last_print = monotonic()
+
+    async def check_for_committed_commands_async(self):
+        """The apply loop as a coroutine on the asyncio runtime's loop."""
+        last_print = monotonic()
+        while self.running:
+            commit_index = await self.cm.wait_for_commit_async(self.lastApplied, timeout=status_interval)
+            self.apply_committed(commit_index)
+            if monotonic() - last_print >= status_interval:
+                try:
+                    await to_thread(self.cm.simulation_print)  # file writes would hold up the loop
+                except Exception:
+                    traceback.print_exc()
+                last_print = monotonic()
+
+    def stop(self):
+        """end the apply loop, which notices within status_interval seconds"""
+        self.running = False
+
+    def apply_committed(self, commit_index: int):
+        """apply every entry up to commit_index in one pass"""
+        with self.apply_lock:
+            if self.lastApplied < commit_index:
+                start = monotonic()
+                lag = commit_index - self.lastApplied
+                while self.lastApplied < commit_index:
+                    self.lastApplied += 1
+                    command = self.cm.get_command(self.lastApplied)
+                    match = self.matches.get(command.match)
+                    self.update_status(match, command)
+                    self.check_game_status(match)
+                    if command.action == 'exit':
+                        self.matches.end(command.match)
+                if self.lastApplied - self.cm.log.snapshot_index >= self.snapshot_every:
+                    self.cm.loop.post(self.cm.take_snapshot, self.snapshot_state())
+                self.apply_stats.record(lag, monotonic() - start)
 
 
+    def snapshot_state(self) -> dict:
+        return {
+            'matches': self.matches.state(),
+            'lastApplied': self.lastApplied
+        }
+
+    def restore_snapshot(self, snapshot: dict):
+        """Replace the game state with a snapshot's, e.g. one sent by the leader."""
+        state = snapshot['state']
+        with self.apply_lock:
+            if 'matches' in state:
+                self.matches.restore(state['matches'])
+            else:  # taken before there was more than one match
+                self.matches.restore({'0': state})
+            self.lastApplied = state['lastApplied']
+
     def handle_incoming_message(self, msg):
-        received_msg = str(msg)
-        self.cm.add_client_command_to_log(received_msg)
-        #print(received_msg)
-        #self.update_status(received_msg)
+        if msg.get('_id') == 'admin':  # sent by transfer_leadership.py
+            self.cm.loop.post(self.cm.transfer_leadership, msg.get('transfer'))
+            return
+        if msg.get('messageType') == 'ReturnedCommands':
+            # read by the old leader before anything waiting here, so they go first
+            self.cm.loop.post(self.log_client_commands, msg['commands'].split(';'), self.cm.term,
+                kind='ReturnedCommands', lane='client', first=True)
+            return
+        if 'command' not in msg:
+            print('Dropped a message on the leader queue with no command:', msg)
+            return
+        # already a Command.encode() string, so it goes into the log unchanged.
+        # The term it was read in lets the consensus module refuse it if
+        # leadership changed while it waited in the client lane
+        self.cm.loop.post(self.cm.add_client_command_to_log, msg['command'], self.cm.term,
+            kind='ClientCommand', lane='client')
         #self.check_game_status()
 
-    def update_status(self, received_msg):
+    def log_client_commands(self, commands: list, term: int):
+        for command in commands:
+            self.cm.add_client_command_to_log(command, term)
+
+    def return_client_command(self, command: str):
+        """
+        Consensus loop: hold a command this node read as leader but can no
+        longer log, behind any held before it, until someone leads again.
+        """
+        self.returned.append(command)
+        if self.cm.election_state == 'leader':
+            self.release_returned_commands()
+
+    def release_returned_commands(self):
+        """
+        Consensus loop, once there may be a leader to take the held commands:
+        this node leading again puts them back at the head of its client lane;
+        a follower that has heard from the leader of its term sends them to
+        the leader queue, whose reader puts them at the head of its own lane.
+        Either way they keep the order they were read in. Mid-transfer they
+        go to the target with TimeoutNow (see send_timeout_now).
         """
-        Updates game status.
+        if not self.returned:
+            return
+        if self.cm.election_state == 'leader':
+            if self.cm.transfer_target is not None:
+                return
+            self.cm.loop.post(self.log_client_commands, self.returned, self.cm.term,
+                kind='ReturnedCommands', lane='client', first=True)
+        else:
+            self.messenger.send(self.cm.make_message('returned commands', commands=self.returned),
+                leader_endpoint(self.group), flush=True)
+        self.returned = []
+
+    def take_returned_commands(self) -> list:
+        """the held commands, for a leader handing over to hand on as well"""
+        returned, self.returned = self.returned, []
+        return returned
+
+    def wait_for_room(self):
+        """
+        Messenger interface: stop reading the leader queue while the client
+        lane of the consensus module's mailbox is full, so a flood of client
+        commands waits in the queue instead of in memory.
+        """
+        return self.cm.loop.wait_for_room('client')
+
+    def update_status(self, match: Match, command):
+        """
+        Updates the status of the command's match.
         Checks whether the received message came from red or blue client,
         server logic is updated and performed accordingly.
         Finally, message is sent to appropriate client.
         :return:
         """
-        if received_msg['_id'] == 'client-red':
-            self.server_logic.set_red_status(received_msg['state'])
-            if not received_msg['state'] == 'exit':
-                self.game_state, msg_to_send = self.server_logic.logic_after_commit(received_msg['_id'])
+        if command.client == 'client-red':
+            match.server_logic.set_red_status(command.action)
+            if not command.action == 'exit':
+                match.game_state, msg_to_send = match.server_logic.logic_after_commit(command.client)
                 if self.cm.election_state == 'leader':
-                    self.messenger.send(msg_to_send, 'client-red')
+                    self.messenger.send(msg_to_send, match.endpoint('client-red'))
             else:
                 if self.cm.election_state == 'leader':
                     msg_to_send = {'msg': 'exit'}
-                    self.messenger.send(msg_to_send, 'client-blue')
-        elif received_msg['_id'] == 'client-blue':
-            self.server_logic.set_blue_status(received_msg['state'])
-            if not received_msg['state'] == 'exit':
-                self.game_state, msg_to_send = self.server_logic.logic_after_commit(received_msg['_id'])
+                    self.messenger.send(msg_to_send, match.endpoint('client-blue'))
+        elif command.client == 'client-blue':
+            match.server_logic.set_blue_status(command.action)
+            if not command.action == 'exit':
+                match.game_state, msg_to_send = match.server_logic.logic_after_commit(command.client)
                 if self.cm.election_state == 'leader':
-                    self.messenger.send(msg_to_send, 'client-blue')
+                    self.messenger.send(msg_to_send, match.endpoint('client-blue'))
             else:
                 if self.cm.election_state == 'leader':
                     msg_to_send = {'msg': 'exit'}
-                    self.messenger.send(msg_to_send, 'client-red')
+                    self.messenger.send(msg_to_send, match.endpoint('client-red'))
 
-    def check_game_status(self):
+    def check_game_status(self, match: Match):
         if self.cm.election_state == 'leader':
 
-            if self.game_state == 'blue_won':
+            if match.game_state == 'blue_won':
                 msg_to_send = {'msg': 'lost'}
-                self.messenger.send(msg_to_send, 'client-red')
-            elif self.game_state == 'red_won':
+                self.messenger.send(msg_to_send, match.endpoint('client-red'))
+            elif match.game_state == 'red_won':
                 msg_to_send = {'msg': 'lost'}
-                self.messenger.send(msg_to_send, 'client-blue')
-            elif self.game_state == 'blue_blocked':
+                self.messenger.send(msg_to_send, match.endpoint('client-blue'))
+            elif match.game_state == 'blue_blocked':
                 msg_to_send = {'msg': 'blocked_punch'}
-                self.messenger.send(msg_to_send, 'client-red')
-            elif self.game_state == 'red_blocked':
+                self.messenger.send(msg_to_send, match.endpoint('client-red'))
+            elif match.game_state == 'red_blocked':
                 msg_to_send = {'msg': 'blocked_punch'}
-                self.messenger.send(msg_to_send, 'client-blue')
+                self.messenger.send(msg_to_send, match.endpoint('client-blue'))
+
+
+
+class RaftNode:
+    """
+    A node hosting several independent Raft groups (multi-Raft), so the
+    matches are not all serialized through one leader and one log. Matches
+    are spread over the groups by Command.group_of(); each group has its own
+    Server, log, elections and leader queue, so its leader can sit on any
+    node. What is per node is shared: one Messenger on the node's queue (one
+    transport, receive loop and sender pool), the files directory and the
+    TimerScheduler. Each group's heartbeat timer sends only that group's
+    heartbeats; the Messenger's batch window lets those that come due
+    together reach a peer in one send.
+    """
+
+    def __init__(self, nodeID, groups: int, snapshot_every: int = 1000):
+        self.id = nodeID
+        self.messenger = Messenger(id=self.id, target=self, run=False)
+        self.servers = [Server(nodeID, snapshot_every, group=group, node=self) for group in range(groups)]
+        self.groups = {server.group: server.cm for server in self.servers}
+        self.messenger.on()
 
+    def handle_incoming_message(self, message: dict):
+        cm = self.groups.get(message.get('group'))
+        if cm is not None:
+            cm.handle_incoming_message(message)
 
+    def handle_batch_end(self):
+        """one fsync per group log for a whole receive batch, then the replies go out"""
+        for cm in self.groups.values():
+            cm.handle_batch_end()
 
 class ServerLogic:
     """
@@ -175,4 +432,9 @@ class ServerLogic:
 
 if __name__ == '__main__':
     arg = sys.argv[1]
-    s = Server(arg)
\ No newline at end of file
+    groups = group_count()
+    if groups == 1:
+        s = Server(arg)
+    else:
+        node = RaftNode(arg, groups)
+    Event().wait()  # every other thread is a daemon, keep the node alive
\ No newline at end of file
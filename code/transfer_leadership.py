@@ -0,0 +1,33 @@
+import sys
+from Messenger import Messenger
+from Command import leader_endpoint
+
+
+class Admin:
+    """
+    Asks the current leader to hand leadership to another node, e.g. before
+    restarting the leader for a deploy. The request goes to the leader queue
+    of the Raft group, which only that group's leader reads.
+    """
+
+    def __init__(self):
+        # never receives, 'leader' only names the queue this messenger sends from
+        self.messenger = Messenger(id='leader', target=self, run=False)
+
+    def handle_incoming_message(self, msg):
+        pass
+
+    def transfer(self, target: str = '', group: int = 0):
+        """
+        :param target: node ID to hand leadership to, '' lets the leader
+            pick its most up to date follower
+        :param group: Raft group whose leader should step aside
+        """
+        self.messenger.send({'_id': 'admin', 'transfer': target}, leader_endpoint(group), flush=True)
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else ''
+    group = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    Admin().transfer(target, group)
+    print('asked the leader to transfer leadership to', target or 'its most up to date follower')
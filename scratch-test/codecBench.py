@@ -0,0 +1,46 @@
+import sys
+sys.path.append('../code')
+import Codec
+import timeit
+
+# compares the binary codec with the old SQS MessageAttributes format, where
+# every field was a string wrapped in {'DataType': 'String', 'StringValue': ...}
+
+entry = "12\t{'_id': 'client-red', 'state': 'punch_left'}"
+append_entries = {
+	'messageType': 'AppendEntriesRPC', 'group': 0, 'leaderID': '2', 'term': 12,
+	'entries': ';'.join([entry] * 50), 'prevLogIndex': 1040, 'prevLogTerm': 12,
+	'prevLogCommand': "{'_id': 'client-blue', 'state': 'block_left'}",
+	'leaderCommit': 1039, 'nextIndex': 1041, 'sentAt': 81234567890, 'heartbeatInterval': 500
+	}
+append_reply = {
+	'messageType': 'AppendReply', 'group': 0, 'senderID': '1', 'term': 12, 'match': 1090, 'success': True,
+	'conflictTerm': -1, 'conflictIndex': 0, 'sentAt': 81234567890
+	}
+
+def format_for_SQS(message: dict) -> dict:
+	return {key: {'DataType': 'String', 'StringValue': str(value)} for key, value in message.items()}
+
+def reduce_message(SQSmessage: dict) -> dict:
+	msg = {key: value['StringValue'] for key, value in SQSmessage.items()}
+	# the handlers then re-parsed every numeric field
+	for key in ('term', 'prevLogIndex', 'prevLogTerm', 'leaderCommit', 'nextIndex', 'match'):
+		if key in msg:
+			msg[key] = int(msg[key])
+	return msg
+
+def attribute_size(SQSmessage: dict) -> int:
+	# SQS counts attribute names, data types and values
+	return sum(len(key) + len('String') + len(value['StringValue']) for key, value in SQSmessage.items())
+
+for name, message in [('AppendEntries (50 entries)', append_entries), ('AppendReply', append_reply)]:
+	old = format_for_SQS(message)
+	new = Codec.encode(message)
+	n = 20000
+	old_encode = timeit.timeit(lambda: format_for_SQS(message), number=n) / n * 1e6
+	old_decode = timeit.timeit(lambda: reduce_message(old), number=n) / n * 1e6
+	new_encode = timeit.timeit(lambda: Codec.encode(message), number=n) / n * 1e6
+	new_decode = timeit.timeit(lambda: Codec.decode(new), number=n) / n * 1e6
+	print(name)
+	print(f'\tattributes: {attribute_size(old):6d} bytes  encode {old_encode:.2f} us  decode {old_decode:.2f} us')
+	print(f'\tcodec:      {len(new):6d} bytes ({4 * ((len(new) + 2) // 3)} as SQS base64)  encode {new_encode:.2f} us  decode {new_decode:.2f} us')
@@ -0,0 +1,22 @@
+import sys
+sys.path.append('../code')
+from Command import Command
+import ast, timeit
+
+# compares the old log command, str() of the client's message dict parsed
+# back with ast.literal_eval at apply time, with the Command encoding
+
+message = {'_id': 'client-red', 'state': 'punch_left'}
+command = Command('client-red', 'punch_left', 1234)
+old = str(message)
+new = command.encode()
+
+n = 100000
+old_encode = timeit.timeit(lambda: str(message), number=n) / n * 1e6
+old_decode = timeit.timeit(lambda: ast.literal_eval(old), number=n) / n * 1e6
+new_encode = timeit.timeit(lambda: command.encode(), number=n) / n * 1e6
+new_decode = timeit.timeit(lambda: Command.decode(new), number=n) / n * 1e6
+
+print('log command per entry')
+print(f'\tstr(dict):  {len(old):3d} bytes  encode {old_encode:.2f} us  decode {old_decode:.2f} us')
+print(f'\tCommand:    {len(new):3d} bytes  encode {new_encode:.2f} us  decode {new_decode:.2f} us')